@@ -38,6 +38,9 @@ INSTALLED_APPS = [
 # Middleware
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "portfolios.middleware.QueryBudgetMiddleware",     # Server-Timing + presupuesto de queries
+    "django.middleware.gzip.GZipMiddleware",          # gzip (también streaming)
+    "portfolios.middleware.BrotliMiddleware",         # br si el cliente lo acepta y hay `brotli`
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -45,6 +48,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "portfolios.middleware.EasterEggHeaderMiddleware",  # header X-Mat-Egg
+    "portfolios.middleware.ProfilerMiddleware",         # ?profile=1 / X-Profile (sólo staff)
 ]
 
 ROOT_URLCONF = "config.urls"
@@ -76,9 +80,25 @@ DATABASES = {
         "PASSWORD": os.getenv("POSTGRES_PASSWORD", "postgres"),
         "HOST": os.getenv("POSTGRES_HOST", "db"),
         "PORT": os.getenv("POSTGRES_PORT", "5432"),
+        # conexiones persistentes por thread/worker (segundos; 0 = una por request, None = sin límite)
+        "CONN_MAX_AGE": None if os.getenv("DB_CONN_MAX_AGE") == "none" else int(os.getenv("DB_CONN_MAX_AGE", "60")),
+        "CONN_HEALTH_CHECKS": os.getenv("DB_CONN_HEALTH_CHECKS", "1") == "1",
+        # detrás de pgbouncer en modo transaction los cursores server-side no sirven
+        "DISABLE_SERVER_SIDE_CURSORS": os.getenv("DB_DISABLE_SERVER_SIDE_CURSORS", "0") == "1",
+        "OPTIONS": {},
     }
 }
 
+# Pool de psycopg 3 (DB_POOL=1): reemplaza a CONN_MAX_AGE, que debe quedar en 0
+if os.getenv("DB_POOL", "0") == "1":
+    DATABASES["default"]["CONN_MAX_AGE"] = 0
+    DATABASES["default"]["OPTIONS"]["pool"] = {
+        "min_size": int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+        "max_size": int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+        "timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),  # espera máxima por una conexión libre
+        "max_idle": float(os.getenv("DB_POOL_MAX_IDLE", "300")),
+    }
+
 # Static
 STATIC_URL = "static/"
 
@@ -92,3 +112,63 @@ REST_FRAMEWORK = {
 
 # Easter egg (usado por portfolios.middleware.EasterEggHeaderMiddleware)
 EASTER_EGG_MSG = os.getenv("EASTER_EGG_MSG", "")
+
+# Cache de /metrics (portfolios.cache): locmem | file | django | none
+PORTFOLIOS_METRICS_CACHE = {
+    "BACKEND": os.getenv("METRICS_CACHE_BACKEND", "locmem"),
+    "LOCATION": os.getenv("METRICS_CACHE_LOCATION", ""),  # directorio (file) o alias de CACHES (django)
+    "MAX_ENTRIES": int(os.getenv("METRICS_CACHE_MAX_ENTRIES", "256")),
+    "TTL": int(os.getenv("METRICS_CACHE_TTL", "3600")),  # segundos; 0 = sin expiración
+}
+
+# Tope de puntos por respuesta de /metrics (LTTB sobre V_t, ver portfolios.sampling); 0 = sin tope.
+# Un max_points del request nunca lo supera.
+PORTFOLIOS_METRICS_MAX_POINTS = int(os.getenv("METRICS_MAX_POINTS", "0"))
+
+# Aritmética del cálculo en línea de V_t / w_{i,t} (selectors.compute_timeseries_weights_and_value):
+# float64 (matrices NumPy, error relativo acotado en selectors.float64_error_bounds) | decimal (exacto)
+PORTFOLIOS_NUMERIC_BACKEND = os.getenv("NUMERIC_BACKEND", "float64")
+
+# Snapshot de precios mapeado en memoria (portfolios.pricestore, `manage.py price_store`).
+# LOCATION debe ser compartido por web y worker; vacío = BASE_DIR/var/price-store.
+PORTFOLIOS_PRICE_STORE = {
+    "ENABLED": os.getenv("PRICE_STORE", "0") == "1",
+    "LOCATION": os.getenv("PRICE_STORE_LOCATION", ""),
+}
+
+# Nombres de assets en memoria por proceso (portfolios.assets): se invalidan con post_save/post_delete
+# de Asset y load_datos. TTL acota el atraso de renombres hechos en otro proceso (0 = sin expiración);
+# CACHE = alias de CACHES compartido para propagar invalidaciones entre procesos (vacío = sólo TTL).
+PORTFOLIOS_ASSET_REGISTRY = {
+    "TTL": int(os.getenv("ASSET_REGISTRY_TTL", "300")),
+    "CACHE": os.getenv("ASSET_REGISTRY_CACHE", ""),
+}
+
+# Presupuesto de queries por request (portfolios.middleware.QueryBudgetMiddleware).
+# 0 = sin límite; ACTION: log (warning en "portfolios.queries") | raise (la request falla).
+# Las vistas pueden ajustar su propio presupuesto con el atributo `query_budget`.
+PORTFOLIOS_QUERY_BUDGET = {
+    "MAX_QUERIES": int(os.getenv("QUERY_BUDGET_MAX_QUERIES", "50")),
+    "MAX_DB_MS": float(os.getenv("QUERY_BUDGET_MAX_DB_MS", "0")),
+    "ACTION": os.getenv("QUERY_BUDGET_ACTION", "log"),
+}
+
+# Instrumentación (portfolios.instrumentation): spans/contadores en /metrics/prometheus.
+# PROFILING habilita el profiler por request para staff (portfolios.middleware.ProfilerMiddleware).
+PORTFOLIOS_INSTRUMENTATION = {
+    "ENABLED": os.getenv("INSTRUMENTATION", "0") == "1",
+    "PROFILING": os.getenv("PROFILING", "0") == "1",
+}
+
+# Cola de jobs en la DB (portfolios.jobs, `manage.py run_worker`).
+# ASYNC_REFRESH=1: trades/cargas de precios encolan el refresh de valorizaciones en vez de hacerlo en línea.
+PORTFOLIOS_JOBS = {
+    "ASYNC_REFRESH": os.getenv("JOBS_ASYNC_REFRESH", "0") == "1",
+    # precalentar /metrics sólo sirve si la cache es compartida (file/django): con locmem llenaría la del worker
+    "WARM_AFTER_REFRESH": os.getenv(
+        "JOBS_WARM_CACHE", "1" if PORTFOLIOS_METRICS_CACHE["BACKEND"] in ("file", "django") else "0"
+    ) == "1",
+    "MAX_ATTEMPTS": int(os.getenv("JOBS_MAX_ATTEMPTS", "5")),
+    "BACKOFF_BASE": float(os.getenv("JOBS_BACKOFF_BASE", "5")),    # segundos; se duplica por intento
+    "BACKOFF_MAX": float(os.getenv("JOBS_BACKOFF_MAX", "600")),
+}
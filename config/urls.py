@@ -3,17 +3,27 @@ URL configuration for config project.
 """
 
 from django.contrib import admin
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.urls import path, include
 
+from portfolios.instrumentation import enabled as instrumentation_enabled, registry
+
 
 def healthz(_request):
     # pequeño guiño para troubleshooting rápido
     return JsonResponse({"status": "ok", "note": "si llegaste acá, te debo un café ☕"})
 
 
+def prometheus_metrics(_request):
+    # registro por proceso: con varios workers cada scrape ve el worker que atendió
+    if not instrumentation_enabled():
+        raise Http404("Instrumentación deshabilitada (INSTRUMENTATION=1)")
+    return HttpResponse(registry.render_prometheus(), content_type="text/plain; version=0.0.4")
+
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("portfolios.api.urls")),  # endpoints de la app
     path("healthz/", healthz),                     # chequeo simple
+    path("metrics/prometheus", prometheus_metrics),  # spans y contadores (opt-in)
 ]
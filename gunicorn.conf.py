@@ -0,0 +1,17 @@
+# gunicorn.conf.py — servidor ASGI de producción (DJANGO_SERVER=asgi en .env)
+#   gunicorn config.asgi:application -c gunicorn.conf.py
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+# cada worker es un event loop: con vistas async atiende muchas requests concurrentes,
+# así que alcanza con ~1 worker por core (2*cores+1 es la regla para workers sync)
+workers = int(os.getenv("WEB_CONCURRENCY") or multiprocessing.cpu_count() + 1)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+graceful_timeout = 30
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+# recicla workers de a poco para acotar fragmentación de memoria (pandas/numpy)
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = 200
+accesslog = "-"
@@ -1,5 +1,13 @@
 from django.contrib import admin
-from .models import Asset, Portfolio, Price, InitialWeight, Holding, Trade
+from .assets import get_asset_registry
+from .models import Asset, Portfolio, Price, InitialWeight, Holding, Trade, PortfolioDailyValuation, Job
+
+
+class AssetNameMixin:
+    """Columna "asset" desde el registro de nombres en memoria: el listado no hace JOIN con Asset."""
+    @admin.display(description="asset", ordering="asset__name")
+    def asset_name(self, obj):
+        return get_asset_registry().legend([obj.asset_id])[obj.asset_id]
 
 
 @admin.register(Asset)
@@ -15,27 +23,41 @@ class PortfolioAdmin(admin.ModelAdmin):
 
 
 @admin.register(Price)
-class PriceAdmin(admin.ModelAdmin):
-    list_display = ("id", "asset", "date", "price")
+class PriceAdmin(AssetNameMixin, admin.ModelAdmin):
+    list_display = ("id", "asset_name", "date", "price")
     list_filter = ("asset", "date")
     date_hierarchy = "date"
 
 
 @admin.register(InitialWeight)
-class InitialWeightAdmin(admin.ModelAdmin):
-    list_display = ("id", "portfolio", "asset", "weight")
+class InitialWeightAdmin(AssetNameMixin, admin.ModelAdmin):
+    list_display = ("id", "portfolio", "asset_name", "weight")
     list_filter = ("portfolio", "asset")
 
 
 @admin.register(Holding)
-class HoldingAdmin(admin.ModelAdmin):
-    list_display = ("id", "portfolio", "asset", "quantity", "effective_from")
+class HoldingAdmin(AssetNameMixin, admin.ModelAdmin):
+    list_display = ("id", "portfolio", "asset_name", "quantity", "effective_from")
     list_filter = ("portfolio", "asset")
     date_hierarchy = "effective_from"
 
 
 @admin.register(Trade)
-class TradeAdmin(admin.ModelAdmin):
-    list_display = ("id", "portfolio", "asset", "trade_date", "amount_usd", "created_at")
+class TradeAdmin(AssetNameMixin, admin.ModelAdmin):
+    list_display = ("id", "portfolio", "asset_name", "trade_date", "amount_usd", "created_at")
     list_filter = ("portfolio", "asset")
     date_hierarchy = "trade_date"
+
+
+@admin.register(PortfolioDailyValuation)
+class PortfolioDailyValuationAdmin(admin.ModelAdmin):
+    list_display = ("id", "portfolio", "date", "value", "updated_at")
+    list_filter = ("portfolio",)
+    date_hierarchy = "date"
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "kind", "portfolio", "status", "attempts", "run_after", "locked_by", "updated_at")
+    list_filter = ("kind", "status")
+    search_fields = ("dedupe_key", "last_error")
@@ -0,0 +1,74 @@
+# portfolios/analytics.py
+"""
+Estadísticas de desempeño sobre la matriz de valorización (ver /api/portfolios/<id>/analytics).
+
+Todo se calcula vectorizado sobre fechas × assets con los precios P_{i,t} (forward-fill dentro
+del rango) y las cantidades c_{i,t}. El retorno de cada día usa las cantidades del día anterior,
+así los trades (aportes/retiros) no cuentan como rentabilidad (time-weighted):
+
+    r_t = Σ_i c_{i,t-1}·P_{i,t} / V_{t-1} - 1,   V_{t-1} = Σ_i c_{i,t-1}·P_{i,t-1}
+    contrib_{i,t} = c_{i,t-1}·(P_{i,t} - P_{i,t-1}) / V_{t-1}     (Σ_i contrib_{i,t} = r_t)
+"""
+import numpy as np
+import pandas as pd
+
+PERIODS_PER_YEAR = 252
+SERIES_COLUMNS = ["return", "cumulative", "volatility", "drawdown"]
+
+
+def performance(px: pd.DataFrame, qty: pd.DataFrame, window: int = 21,
+                periods_per_year: int = PERIODS_PER_YEAR) -> dict:
+    """
+    px, qty: fechas × asset_id alineados (NaN = sin precio / sin tramo vigente).
+    Devuelve series por fecha (return, cumulative, volatility anualizada en ventana móvil de
+    `window` retornos, drawdown), contribución acumulada por asset y un resumen.
+    """
+    if len(px) < 2:
+        empty = pd.Series(dtype=float)
+        return {"series": pd.DataFrame(columns=SERIES_COLUMNS), "contribution": empty,
+                "summary": _summary(empty, empty, periods_per_year)}
+    prices = px.ffill().to_numpy()
+    c_prev = np.nan_to_num(qty.to_numpy()[:-1])
+    v_prev = np.nansum(c_prev * prices[:-1], axis=1)
+    pnl = np.nan_to_num(c_prev * (prices[1:] - prices[:-1]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        contrib = np.where(v_prev[:, None] > 0, pnl / v_prev[:, None], np.nan)
+    valid = v_prev > 0  # sin posiciones el día anterior no hay retorno
+    r = pd.Series(contrib[valid].sum(axis=1), index=px.index[1:][valid])
+
+    wealth = wealth_index(r, px.index[0])
+    drawdown = wealth / wealth.cummax() - 1
+    volatility = r.rolling(window, min_periods=window).std(ddof=1) * np.sqrt(periods_per_year)
+    series = pd.DataFrame({"return": r, "cumulative": wealth.iloc[1:] - 1, "volatility": volatility,
+                           "drawdown": drawdown.iloc[1:]}, columns=SERIES_COLUMNS)
+    contribution = pd.Series(contrib[valid].sum(axis=0), index=px.columns)
+    return {"series": series, "contribution": contribution, "summary": _summary(r, wealth, periods_per_year)}
+
+
+def wealth_index(r: pd.Series, base_date) -> pd.Series:
+    """Riqueza acumulada con base 1 en base_date (el primer día del rango, que también puede ser el pico)."""
+    return pd.concat([pd.Series([1.0], index=[base_date]), (1 + r).cumprod()])
+
+
+def returns_summary(r: pd.Series, base_date, periods_per_year: int = PERIODS_PER_YEAR) -> dict:
+    """Resumen (retorno total/anualizado, volatilidad, max drawdown) de una serie de retornos."""
+    return _summary(r, wealth_index(r, base_date), periods_per_year)
+
+
+def _summary(r: pd.Series, wealth: pd.Series, periods_per_year: int) -> dict:
+    if r.empty:
+        return {"total_return": None, "annualized_return": None, "annualized_volatility": None,
+                "max_drawdown": None, "max_drawdown_peak": None, "max_drawdown_trough": None, "periods": 0}
+    total = float(wealth.iloc[-1] - 1)
+    drawdown = wealth / wealth.cummax() - 1
+    trough = drawdown.idxmin()
+    in_drawdown = drawdown.loc[trough] < 0
+    return {
+        "total_return": total,
+        "annualized_return": float((1 + total) ** (periods_per_year / len(r)) - 1),
+        "annualized_volatility": float(r.std(ddof=1) * np.sqrt(periods_per_year)) if len(r) > 1 else None,
+        "max_drawdown": float(drawdown.loc[trough]),
+        "max_drawdown_peak": wealth.loc[:trough].idxmax() if in_drawdown else None,
+        "max_drawdown_trough": trough if in_drawdown else None,
+        "periods": len(r),
+    }
@@ -0,0 +1,88 @@
+"""Formatos de salida de /metrics además del JSON por filas."""
+import importlib.util
+import io
+import json
+
+OUTPUTS = {
+    "json": "application/json",                 # filas: [{"date", "weights": {...}}], [{"date", "value"}]
+    "columnar": "application/json",             # {"dates": [...], "values": [...], "weights": {asset: [...]}}
+    "ndjson": "application/x-ndjson",           # streaming, una línea por fecha
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+BINARY_OUTPUTS = ("arrow", "parquet")
+# cómo se identifican los assets en los weights: nombres repetidos en cada fecha, o ids + una leyenda
+# {"assets": {id: nombre}} (los formatos binarios ya nombran cada columna una sola vez: siempre nombres)
+ASSET_KEYS = ("names", "ids")
+
+
+def pyarrow_available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def format_series(w_map, v_map, assets):
+    """Formato original por filas (repite los nombres de assets en cada fecha)."""
+    weights_series = [
+        {"date": d, "weights": {assets.get(a_id, str(a_id)): float(w) for a_id, w in inner.items()}}
+        for d, inner in sorted(w_map.items())
+    ]
+    values_series = [{"date": d, "value": float(v)} for d, v in sorted(v_map.items())]
+    return {"weights": weights_series, "values": values_series}
+
+
+def legend_series(render, w_map, v_map, assets):
+    """render con los weights por asset_id y los nombres una sola vez: {"assets": {id: nombre}, ...}."""
+    return {"assets": assets, **render(w_map, v_map, {a_id: a_id for a_id in assets})}
+
+
+def columnar_series(w_map, v_map, assets):
+    """Un arreglo de fechas, uno de valores y uno por asset (null si el asset no participa ese día)."""
+    dates = sorted(v_map)
+    asset_ids = sorted({a_id for inner in w_map.values() for a_id in inner})
+    weights = {
+        assets.get(a_id, str(a_id)): [_float_or_none(w_map[d].get(a_id)) for d in dates]
+        for a_id in asset_ids
+    }
+    return {"dates": dates, "values": [float(v_map[d]) for d in dates], "weights": weights}
+
+
+def iter_ndjson(w_map, v_map, assets, ids: bool = False, legend: bool = True):
+    """
+    Genera una línea JSON por fecha: el primer byte sale sin serializar toda la serie.
+    Con ids=True la primera línea es la leyenda {"assets": {id: nombre}} (si legend) y los weights
+    van por id.
+    """
+    if ids and legend:
+        yield json.dumps({"assets": assets}, separators=(",", ":")) + "\n"
+        assets = {a_id: a_id for a_id in assets}
+    for d in sorted(v_map):
+        row = {
+            "date": d.isoformat(),
+            "value": float(v_map[d]),
+            "weights": {assets.get(a_id, str(a_id)): float(w) for a_id, w in w_map[d].items()},
+        }
+        yield json.dumps(row, separators=(",", ":")) + "\n"
+
+
+def binary_series(w_map, v_map, assets, output: str) -> bytes:
+    """Tabla Arrow (date, value, una columna de weight por asset) como Arrow IPC stream o Parquet."""
+    import pyarrow as pa
+
+    cols = columnar_series(w_map, v_map, assets)
+    table = pa.table({
+        "date": pa.array(cols["dates"], type=pa.date32()),
+        "value": pa.array(cols["values"], type=pa.float64()),
+        **{name: pa.array(ws, type=pa.float64()) for name, ws in cols["weights"].items()},
+    })
+    sink = io.BytesIO()
+    if output == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(table, sink)
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue()
+
+
+def _float_or_none(w):
+    return None if w is None else float(w)
@@ -1,3 +1,4 @@
+from decimal import Decimal
 from rest_framework import serializers
 from ..models import Asset
 
@@ -13,3 +14,41 @@ class AssetSerializer(serializers.ModelSerializer):
     class Meta:
         model = Asset
         fields = ("id", "name", "ticker")
+
+class ScenarioTradeSerializer(serializers.Serializer):
+    asset = serializers.CharField()  # nombre o id
+    date = serializers.DateField()
+    amount_usd = serializers.DecimalField(max_digits=20, decimal_places=2)
+
+class PriceOverrideSerializer(serializers.Serializer):
+    asset = serializers.CharField()
+    date = serializers.DateField()
+    price = serializers.DecimalField(max_digits=20, decimal_places=8, min_value=Decimal("0"))
+
+class ScenarioSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=100)
+    trades = ScenarioTradeSerializer(many=True, required=False, default=list)
+    price_overrides = PriceOverrideSerializer(many=True, required=False, default=list)
+
+class SimulateRequestSerializer(serializers.Serializer):
+    MAX_SCENARIOS = 200
+
+    fecha_inicio = serializers.DateField()
+    fecha_fin = serializers.DateField()
+    scenarios = ScenarioSerializer(many=True, allow_empty=False)
+    output = serializers.ChoiceField(choices=["json", "columnar"], default="json")
+    max_points = serializers.IntegerField(min_value=3, required=False)
+
+    def validate(self, data):
+        if data["fecha_fin"] < data["fecha_inicio"]:
+            raise serializers.ValidationError("fecha_fin debe ser >= fecha_inicio")
+        names = [s["name"] for s in data["scenarios"]]
+        if len(names) > self.MAX_SCENARIOS:
+            raise serializers.ValidationError(f"A lo más {self.MAX_SCENARIOS} escenarios por request")
+        if len(set(names)) != len(names) or "base" in names:
+            raise serializers.ValidationError("Los nombres de escenario deben ser únicos y distintos de 'base'")
+        for s in data["scenarios"]:
+            for row in (*s["trades"], *s["price_overrides"]):
+                if row["date"] > data["fecha_fin"]:
+                    raise serializers.ValidationError(f"{s['name']}: fecha {row['date']} posterior a fecha_fin")
+        return data
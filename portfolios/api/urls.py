@@ -1,7 +1,15 @@
 from django.urls import path
-from .views import PortfolioMetricsApi, PortfolioChartsView
+from .views import (
+    AsyncPortfolioMetricsApi, PortfolioAnalyticsApi, PortfolioBatchMetricsApi, PortfolioChartsView, PortfolioMetricsApi,
+    PortfolioSimulateApi,
+)
 
 urlpatterns = [
+    path("portfolios/metrics", PortfolioBatchMetricsApi.as_view(), name="portfolio-batch-metrics"),
     path("portfolios/<int:portfolio_id>/metrics", PortfolioMetricsApi.as_view(), name="portfolio-metrics"),
+    path("portfolios/<int:portfolio_id>/metrics/async", AsyncPortfolioMetricsApi.as_view(),
+         name="portfolio-metrics-async"),
+    path("portfolios/<int:portfolio_id>/analytics", PortfolioAnalyticsApi.as_view(), name="portfolio-analytics"),
+    path("portfolios/<int:portfolio_id>/simulate", PortfolioSimulateApi.as_view(), name="portfolio-simulate"),
     path("portfolios/<int:portfolio_id>/charts",  PortfolioChartsView.as_view(), name="portfolio-charts"),
 ]
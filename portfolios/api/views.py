@@ -1,33 +1,394 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from asgiref.sync import sync_to_async
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
+from django.utils.http import parse_etags
 from django.views import View
 
-from ..models import Portfolio, Asset
-from ..selectors import compute_timeseries_weights_and_value
+from ..analytics import performance
+from ..assets import get_asset_registry
+from ..cache import etag_for, get_metrics_cache, metrics_cache_key
+from ..instrumentation import instrumented, span
+from .formats import (
+    ASSET_KEYS, BINARY_OUTPUTS, OUTPUTS, binary_series, columnar_series, format_series, iter_ndjson, legend_series,
+    pyarrow_available,
+)
+from .serializers import SimulateRequestSerializer
+from ..models import Portfolio
+from ..sampling import FREQS, default_max_points, is_sampled, sample_frame, sample_indices
+from ..selectors import (
+    acompute_timeseries_weights_and_value, aget_daily_valuations, compute_batch_valuation_frames,
+    compute_timeseries_weights_and_value, frame_to_maps, get_daily_valuations, get_valuation_inputs, numeric_backend,
+)
+from ..simulation import ScenarioError, simulate_scenarios
+
+def parse_date_range(request):
+    """(start, end, None) o (None, None, mensaje de error para el 400)."""
+    try:
+        start = datetime.strptime(request.GET.get("fecha_inicio"), "%Y-%m-%d").date()
+        end = datetime.strptime(request.GET.get("fecha_fin"), "%Y-%m-%d").date()
+    except Exception:
+        return None, None, "Parámetros inválidos: use YYYY-MM-DD"
+    if end < start:
+        return None, None, "fecha_fin debe ser >= fecha_inicio"
+    return start, end, None
+
+def parse_output(request):
+    """(output, None) o (None, (mensaje, status))."""
+    output = request.GET.get("output", "json")
+    if output not in OUTPUTS:
+        return None, (f"output debe ser uno de {sorted(OUTPUTS)}", 400)
+    if output in BINARY_OUTPUTS and not pyarrow_available():
+        return None, (f"output={output} requiere pyarrow instalado", 406)
+    return output, None
+
+def parse_sampling(request):
+    """(freq, max_points, None) o (None, None, mensaje). max_points nunca supera el tope configurado."""
+    freq = request.GET.get("freq", "daily")
+    if freq not in FREQS:
+        return None, None, f"freq debe ser uno de {list(FREQS)}"
+    cap = default_max_points()
+    raw = request.GET.get("max_points")
+    if raw is None:
+        return freq, cap, None
+    try:
+        max_points = int(raw)
+    except ValueError:
+        max_points = 0
+    if max_points < 3:
+        return None, None, "max_points debe ser un entero >= 3"
+    return freq, min(max_points, cap) if cap else max_points, None
+
+def parse_asset_keys(request):
+    """(asset_keys, None) o (None, mensaje). ids: weights por asset_id y una leyenda {"assets": {id: nombre}}."""
+    asset_keys = request.GET.get("assets", "names")
+    if asset_keys not in ASSET_KEYS:
+        return None, f"assets debe ser uno de {list(ASSET_KEYS)}"
+    return asset_keys, None
+
+def not_modified(request, etag: str) -> bool:
+    # comparación débil: GZip/Brotli entregan el ETag como W/"..."
+    if_none_match = {e.removeprefix("W/") for e in parse_etags(request.headers.get("If-None-Match", ""))}
+    return etag in if_none_match or "*" in if_none_match
+
+@instrumented("metrics.load_series")
+def load_series(portfolio: Portfolio, start, end, freq: str = "daily", max_points: int | None = None):
+    """
+    (w_map, v_map, {asset_id: name}) del portafolio en el rango, muestreado según freq/max_points.
+    Los nombres salen del registro en memoria (portfolios.assets), sólo de los assets de la serie.
+    """
+    # serie materializada (range scan, sólo las fechas muestreadas); fallback al cálculo en línea
+    materialized = get_daily_valuations(portfolio, start, end, freq, max_points)
+    if materialized is None:
+        materialized = compute_timeseries_weights_and_value(portfolio, start, end, freq=freq, max_points=max_points)
+    w_map, v_map = materialized
+    return w_map, v_map, get_asset_registry().legend(_series_asset_ids(w_map))
+
+def _series_asset_ids(w_map):
+    return {a_id for inner in w_map.values() for a_id in inner}
+
+# output=ndjson sin muestreo se valoriza y se envía por ventanas de estos días
+NDJSON_WINDOW_DAYS = 92
+
+def ndjson_windows(start, end, freq: str = "daily", max_points: int | None = None):
+    """
+    Ventanas [lo, hi] en que se calcula una respuesta ndjson. Con muestreo (freq ≠ daily o
+    max_points menor que el rango) hace falta la serie completa para elegir las fechas: una sola.
+    """
+    if is_sampled(freq, max_points, start, end):
+        return [(start, end)]
+    step = timedelta(days=NDJSON_WINDOW_DAYS)
+    windows, lo = [], start
+    while lo <= end:
+        windows.append((lo, min(lo + step - timedelta(days=1), end)))
+        lo += step
+    return windows
+
+def iter_metrics_ndjson(portfolio: Portfolio, start, end, freq: str = "daily", max_points: int | None = None,
+                        ids: bool = False):
+    """
+    Cuerpo de output=ndjson: cada ventana se carga (load_series) recién cuando se pidió la anterior,
+    así las primeras filas salen antes de valorizar todo el rango.
+    """
+    sent = set()
+    for n, (lo, hi) in enumerate(ndjson_windows(start, end, freq, max_points)):
+        yield from _ndjson_window(load_series(portfolio, lo, hi, freq, max_points), ids, sent, n == 0)
+
+async def aiter_metrics_ndjson(portfolio: Portfolio, start, end, freq: str = "daily",
+                               max_points: int | None = None, ids: bool = False):
+    """iter_metrics_ndjson con ORM async (StreamingHttpResponse bajo ASGI espera un iterador async)."""
+    sent = set()
+    for n, (lo, hi) in enumerate(ndjson_windows(start, end, freq, max_points)):
+        for line in _ndjson_window(await aload_series(portfolio, lo, hi, freq, max_points), ids, sent, n == 0):
+            yield line
+
+def _ndjson_window(series, ids: bool, sent: set, first: bool):
+    # con ids, cada ventana manda en su leyenda sólo los assets que aún no salieron
+    w_map, v_map, assets = series
+    if ids:
+        assets = {a_id: name for a_id, name in assets.items() if a_id not in sent}
+        sent.update(assets)
+    return iter_ndjson(w_map, v_map, assets, ids=ids, legend=first or bool(assets))
+
+def build_metrics_payload(portfolio: Portfolio, start, end, output: str = "json", freq: str = "daily",
+                          max_points: int | None = None, asset_keys: str = "names"):
+    return render_series(*load_series(portfolio, start, end, freq, max_points), output, asset_keys)
+
+@instrumented("metrics.format")
+def render_series(w_map, v_map, assets, output: str = "json", asset_keys: str = "names"):
+    if output in BINARY_OUTPUTS:
+        return binary_series(w_map, v_map, assets, output)
+    render = columnar_series if output == "columnar" else format_series
+    if asset_keys == "ids":
+        return legend_series(render, w_map, v_map, assets)
+    return render(w_map, v_map, assets)
 
 class PortfolioMetricsApi(APIView):
-    """GET /api/portfolios/<id>/metrics?fecha_inicio=YYYY-MM-DD&fecha_fin=YYYY-MM-DD"""
+    """
+    GET /api/portfolios/<id>/metrics?fecha_inicio=YYYY-MM-DD&fecha_fin=YYYY-MM-DD[&output=...][&freq=...][&max_points=N]
+        [&assets=names|ids]
+    output: json (default) | columnar | ndjson (streaming) | arrow | parquet
+    freq: daily (default) | weekly | monthly (último día de cada período); max_points: LTTB sobre V_t
+    assets: names (default, nombres en cada fecha) | ids (weights por id + leyenda "assets" una vez)
+    """
+    # materializado: portfolio + range scan (+ nombres si el registro está frío); en línea: + tramos y precios
+    query_budget = {"MAX_QUERIES": 8}
+
+    def get(self, request, portfolio_id: int):
+        portfolio = get_object_or_404(Portfolio, id=portfolio_id)
+        start, end, error = parse_date_range(request)
+        if error:
+            return Response({"detail": error}, status=400)
+        output, error = parse_output(request)
+        if error:
+            return Response({"detail": error[0]}, status=error[1])
+        freq, max_points, error = parse_sampling(request)
+        if error:
+            return Response({"detail": error}, status=400)
+        asset_keys, error = parse_asset_keys(request)
+        if error:
+            return Response({"detail": error}, status=400)
+
+        # la llave incluye data_version (datos del portafolio) y la versión de los nombres de assets:
+        # el ETag cambia apenas cambia cualquiera de los dos
+        key = metrics_cache_key(portfolio, start, end, output, numeric_backend(), freq, max_points, asset_keys,
+                                get_asset_registry().version)
+        headers = {"ETag": etag_for(key), "Cache-Control": "no-cache"}
+        if not_modified(request, headers["ETag"]):
+            return Response(status=304, headers=headers)
+
+        if output == "ndjson":
+            # streaming: no pasa por la cache de respuestas; se valoriza por ventanas a medida que se envía
+            response = StreamingHttpResponse(
+                iter_metrics_ndjson(portfolio, start, end, freq, max_points, ids=asset_keys == "ids"),
+                content_type=OUTPUTS[output])
+        else:
+            payload = get_metrics_cache().get_or_compute(
+                key, lambda: build_metrics_payload(portfolio, start, end, output, freq, max_points, asset_keys)
+            )
+            if output not in BINARY_OUTPUTS:
+                return Response(payload, headers=headers)
+            response = HttpResponse(payload, content_type=OUTPUTS[output])
+        for k, v in headers.items():
+            response[k] = v
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if isinstance(response, Response):
+            # DRF serializa al renderizar: se mide acá para separarlo de la carga y el formato
+            with span("metrics.render"):
+                response.render()
+        return response
+
+class AsyncPortfolioMetricsApi(View):
+    """
+    GET /api/portfolios/<id>/metrics/async — mismo contrato que PortfolioMetricsApi, con ORM async.
+    Bajo ASGI (gunicorn + UvicornWorker, ver gunicorn.conf.py) las queries no ocupan un thread
+    del worker mientras esperan a la DB. Es una View de Django: APIView de DRF no soporta async.
+    """
+    query_budget = PortfolioMetricsApi.query_budget
+
+    async def get(self, request, portfolio_id: int):
+        portfolio = await Portfolio.objects.filter(id=portfolio_id).afirst()
+        if portfolio is None:
+            return JsonResponse({"detail": "No encontrado."}, status=404)
+        start, end, error = parse_date_range(request)
+        if error:
+            return JsonResponse({"detail": error}, status=400)
+        output, error = parse_output(request)
+        if error:
+            return JsonResponse({"detail": error[0]}, status=error[1])
+        freq, max_points, error = parse_sampling(request)
+        if error:
+            return JsonResponse({"detail": error}, status=400)
+        asset_keys, error = parse_asset_keys(request)
+        if error:
+            return JsonResponse({"detail": error}, status=400)
+
+        registry = get_asset_registry()
+        version = await sync_to_async(lambda: registry.version)()
+        key = metrics_cache_key(portfolio, start, end, output, numeric_backend(), freq, max_points, asset_keys, version)
+        headers = {"ETag": etag_for(key), "Cache-Control": "no-cache"}
+        if not_modified(request, headers["ETag"]):
+            return HttpResponse(status=304, headers=headers)
+
+        cache = get_metrics_cache()
+        if output == "ndjson":
+            return StreamingHttpResponse(
+                aiter_metrics_ndjson(portfolio, start, end, freq, max_points, ids=asset_keys == "ids"),
+                content_type=OUTPUTS[output], headers=headers)
+        payload = await cache.aget(key)
+        if payload is None:
+            payload = render_series(*await aload_series(portfolio, start, end, freq, max_points), output, asset_keys)
+            await cache.aset(key, payload)
+        if output in BINARY_OUTPUTS:
+            return HttpResponse(payload, content_type=OUTPUTS[output], headers=headers)
+        return JsonResponse(payload, encoder=DjangoJSONEncoder, headers=headers)
+
+async def aload_series(portfolio: Portfolio, start, end, freq: str = "daily", max_points: int | None = None):
+    """load_series con ORM async."""
+    materialized = await aget_daily_valuations(portfolio, start, end, freq, max_points)
+    if materialized is None:
+        materialized = await acompute_timeseries_weights_and_value(portfolio, start, end, freq, max_points)
+    w_map, v_map = materialized
+    assets = await sync_to_async(get_asset_registry().legend)(_series_asset_ids(w_map))
+    return w_map, v_map, assets
+
+class PortfolioBatchMetricsApi(APIView):
+    """GET /api/portfolios/metrics?ids=1,2,3|all&fecha_inicio=YYYY-MM-DD&fecha_fin=YYYY-MM-DD"""
+    # constante en la cantidad de portafolios: portafolios + tramos + precios (+ nombres si el registro está frío)
+    query_budget = {"MAX_QUERIES": 6}
+
+    def get(self, request):
+        start, end, error = parse_date_range(request)
+        if error:
+            return Response({"detail": error}, status=400)
+        raw_ids = request.GET.get("ids", "all").strip()
+        portfolios = Portfolio.objects.order_by("id")
+        if raw_ids != "all":
+            try:
+                ids = [int(i) for i in raw_ids.split(",") if i.strip()]
+            except ValueError:
+                return Response({"detail": "ids debe ser una lista de enteros separada por comas o 'all'"}, status=400)
+            portfolios = portfolios.filter(id__in=ids)
+        portfolios = list(portfolios.values_list("id", "name"))
+
+        # una lectura de holdings + una de precios compartida por todos los portafolios;
+        # siempre float64 (matriz de precios compartida), sin importar PORTFOLIOS_NUMERIC_BACKEND
+        frames = compute_batch_valuation_frames([p_id for p_id, _ in portfolios], start, end)
+        asset_ids = {a_id for x, _ in frames.values() for a_id in x.columns}
+        assets = get_asset_registry().legend(asset_ids)
+        return Response({"portfolios": [
+            {"id": p_id, "name": name, **format_series(*frame_to_maps(*frames[p_id]), assets)}
+            for p_id, name in portfolios
+        ]})
+
+class PortfolioAnalyticsApi(APIView):
+    """
+    GET /api/portfolios/<id>/analytics?fecha_inicio=YYYY-MM-DD&fecha_fin=YYYY-MM-DD[&window=21][&max_points=N]
+    Retornos diarios time-weighted, retorno acumulado, volatilidad móvil anualizada (window retornos),
+    drawdown, contribución por asset y resumen (ver portfolios.analytics). Siempre float64.
+    """
+    # portfolio + tramos + precios (+ nombres si el registro está frío)
+    query_budget = {"MAX_QUERIES": 5}
+
     def get(self, request, portfolio_id: int):
         portfolio = get_object_or_404(Portfolio, id=portfolio_id)
+        start, end, error = parse_date_range(request)
+        if error:
+            return Response({"detail": error}, status=400)
+        try:
+            window = int(request.GET.get("window", 21))
+        except ValueError:
+            window = 0
+        if window < 2:
+            return Response({"detail": "window debe ser un entero >= 2"}, status=400)
+        _, max_points, error = parse_sampling(request)
+        if error:
+            return Response({"detail": error}, status=400)
+
+        # misma cache y versión de datos que /metrics: un trade o carga de precios la invalida
+        key = metrics_cache_key(portfolio, start, end, "analytics", window, max_points, get_asset_registry().version)
+        headers = {"ETag": etag_for(key), "Cache-Control": "no-cache"}
+        if not_modified(request, headers["ETag"]):
+            return Response(status=304, headers=headers)
+        payload = get_metrics_cache().get_or_compute(
+            key, lambda: build_analytics_payload(portfolio, start, end, window, max_points)
+        )
+        return Response(payload, headers=headers)
+
+@instrumented("analytics.build")
+def build_analytics_payload(portfolio: Portfolio, start, end, window: int = 21, max_points: int | None = None):
+    result = performance(*get_valuation_inputs(portfolio, start, end), window=window)
+    series = result["series"]
+    if max_points and len(series) > max_points:
+        dates = list(series.index)
+        series = series.iloc[sample_indices(dates, series["cumulative"].to_numpy(), "daily", max_points)]
+    assets = get_asset_registry().legend(result["contribution"].index)
+    rows = series.astype(object).where(series.notna(), None)
+    return {
+        "window": window,
+        "summary": result["summary"],
+        "contribution": {assets.get(a_id, str(a_id)): float(c) for a_id, c in result["contribution"].items()},
+        "series": [{"date": d, **row} for d, row in zip(rows.index, rows.to_dict("records"))],
+    }
+
+def resolve_assets(refs) -> dict:
+    """{referencia (nombre o id como texto): asset_id o None}; una referencia desconocida recarga el registro."""
+    registry = get_asset_registry()
+    resolved = _resolve(refs, registry.names())
+    if None in resolved.values():  # puede haberlo creado otro proceso
+        resolved = _resolve(refs, registry.reload())
+    return resolved
+
+def _resolve(refs, names):
+    by_name = {name: a_id for a_id, name in names.items()}
+    return {ref: by_name.get(ref) or (int(ref) if ref.isdigit() and int(ref) in names else None) for ref in refs}
+
+class PortfolioSimulateApi(APIView):
+    """
+    POST /api/portfolios/<id>/simulate — escenarios what-if sin escribir en la DB (ver portfolios.simulation).
+    Body: {"fecha_inicio", "fecha_fin", "scenarios": [{"name", "trades": [{"asset", "date", "amount_usd"}],
+           "price_overrides": [{"asset", "date", "price"}]}], "output": json|columnar, "max_points": N}
+    Respuesta: {"base": serie sin cambios, "scenarios": {nombre: serie}}. Siempre float64.
+    """
+    # portfolio + tramos + precios (+ nombres si el registro está frío), sin importar la cantidad de escenarios
+    query_budget = {"MAX_QUERIES": 5}
+
+    def post(self, request, portfolio_id: int):
+        portfolio = get_object_or_404(Portfolio, id=portfolio_id)
+        serializer = SimulateRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        data = serializer.validated_data
+
+        refs = {row["asset"] for s in data["scenarios"] for f in ("trades", "price_overrides") for row in s[f]}
+        resolved = resolve_assets(refs)
+        unknown = sorted(ref for ref, a_id in resolved.items() if a_id is None)
+        if unknown:
+            return Response({"detail": f"Assets inexistentes: {unknown}"}, status=400)
+        scenarios = [{"name": s["name"], **{
+            field: [{**row, "asset_id": resolved[row["asset"]]} for row in s[field]]
+            for field in ("trades", "price_overrides")
+        }} for s in data["scenarios"]]
+
         try:
-            start = datetime.strptime(request.GET.get("fecha_inicio"), "%Y-%m-%d").date()
-            end = datetime.strptime(request.GET.get("fecha_fin"), "%Y-%m-%d").date()
-        except Exception:
-            return Response({"detail": "Parámetros inválidos: use YYYY-MM-DD"}, status=400)
-        if end < start:
-            return Response({"detail": "fecha_fin debe ser >= fecha_inicio"}, status=400)
-
-        w_map, v_map = compute_timeseries_weights_and_value(portfolio, start, end)
-        assets = {a.id: a.name for a in Asset.objects.all()}
-
-        weights_series = [
-            {"date": d, "weights": {assets.get(a_id, str(a_id)): float(w) for a_id, w in inner.items()}}
-            for d, inner in sorted(w_map.items())
-        ]
-        values_series = [{"date": d, "value": float(v)} for d, v in sorted(v_map.items())]
-        return Response({"weights": weights_series, "values": values_series})
+            frames = simulate_scenarios(portfolio, data["fecha_inicio"], data["fecha_fin"], scenarios)
+        except ScenarioError as exc:
+            return Response({"detail": str(exc), "errors": {
+                name: [{field: idx, "error": msg} for field, idx, msg in rows] for name, rows in exc.errors.items()
+            }}, status=400)
+        render = columnar_series if data["output"] == "columnar" else format_series
+        max_points = min(filter(None, (data.get("max_points"), default_max_points())), default=None)
+        assets = get_asset_registry().legend({a_id for x, _ in frames.values() for a_id in x.columns})
+        series = {name: render(*frame_to_maps(*sample_frame(*frame, "daily", max_points)), assets)
+                  for name, frame in frames.items()}
+        base = series.pop("base")
+        return Response({"base": base, "scenarios": series})
 
 class PortfolioChartsView(View):
     template_name = "portfolios/charts.html"
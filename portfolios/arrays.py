@@ -0,0 +1,66 @@
+# portfolios/arrays.py
+"""
+Lecturas de Price a arreglos tipados para el camino de valorización.
+
+Las filas se leen con values_list (precio casteado a float en la DB, sin Decimal ni instancias
+del modelo) y se acumulan en tres array.array paralelos: ordinal de fecha int32, asset_id int32
+y precio float64, 16 bytes por fila en vez de una tupla con date + Decimal por fila. La matriz
+fechas × assets se arma con un scatter de NumPy, sin pivot.
+"""
+from array import array
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+
+
+class PriceArrays:
+    """Filas de Price como arreglos paralelos: dates (ordinales int32), asset_ids (int32), prices (float64)."""
+    __slots__ = ("dates", "asset_ids", "prices")
+
+    def __init__(self, dates: np.ndarray, asset_ids: np.ndarray, prices: np.ndarray):
+        self.dates = dates
+        self.asset_ids = asset_ids
+        self.prices = prices
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    @classmethod
+    def from_queryset(cls, qs, chunk_size: int = 20000) -> "PriceArrays":
+        """Lee (date, asset_id, price) de un queryset de Price en streaming (iterator), sin orden."""
+        dates, asset_ids, prices = array("i"), array("i"), array("d")
+        rows = (qs.order_by().annotate(price_f=Cast("price", FloatField()))
+                .values_list("date", "asset_id", "price_f").iterator(chunk_size=chunk_size))
+        for d, a_id, price in rows:
+            dates.append(d.toordinal())
+            asset_ids.append(a_id)
+            prices.append(price)
+        return cls(np.frombuffer(dates, dtype=np.intc), np.frombuffer(asset_ids, dtype=np.intc),
+                   np.frombuffer(prices, dtype=np.float64))
+
+    def scatter(self, out: np.ndarray, dates: np.ndarray, asset_ids: np.ndarray) -> int:
+        """
+        Escribe los precios en out (len(dates) × len(asset_ids), ambos ordenados) y devuelve
+        cuántos entraron; filas de fechas o assets fuera de los ejes se ignoran.
+        """
+        if not len(self) or not len(dates) or not len(asset_ids):
+            return 0
+        rows = np.minimum(np.searchsorted(dates, self.dates), len(dates) - 1)
+        cols = np.minimum(np.searchsorted(asset_ids, self.asset_ids), len(asset_ids) - 1)
+        ok = (dates[rows] == self.dates) & (asset_ids[cols] == self.asset_ids)
+        out[rows[ok], cols[ok]] = self.prices[ok]
+        return int(ok.sum())
+
+    def to_frame(self) -> pd.DataFrame:
+        """DataFrame float64 fechas × asset_id (NaN = sin precio), con los mismos labels que el snapshot."""
+        if not len(self):
+            return pd.DataFrame(dtype=float)
+        dates = np.unique(self.dates)
+        asset_ids = np.unique(self.asset_ids)
+        out = np.full((len(dates), len(asset_ids)), np.nan)
+        self.scatter(out, dates, asset_ids)
+        return pd.DataFrame(out, index=pd.Index([date.fromordinal(int(o)) for o in dates], dtype=object),
+                            columns=pd.Index(asset_ids.astype(np.int64)), copy=False)
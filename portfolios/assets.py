@@ -0,0 +1,97 @@
+# portfolios/assets.py
+"""
+Registro de nombres de assets por proceso (id → name), compartido por la API, los charts y el admin.
+
+Se carga con una query la primera vez y queda en memoria. Se invalida al confirmar la transacción
+de un post_save/post_delete de Asset (ver receivers) y al final de load_datos. Para que otros procesos se enteren:
+  - un id desconocido fuerza una recarga (assets creados por otro proceso),
+  - TTL (renombres hechos en otro proceso, a lo más TTL segundos de atraso),
+  - con CACHE = alias de CACHES compartido (redis, memcached, db), invalidate() publica una
+    generación nueva que todos los procesos comparan en cada lectura.
+version es un hash de los nombres: entra en las llaves de cache de respuestas con nombres.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .instrumentation import incr
+from .models import Asset
+
+GENERATION_KEY = "portfolios:asset-registry:generation"
+
+
+def registry_config() -> dict:
+    return {"TTL": 300, "CACHE": "", **getattr(settings, "PORTFOLIOS_ASSET_REGISTRY", {})}
+
+
+class AssetRegistry:
+    def __init__(self, ttl: float = 300, cache_alias: str = "", clock=time.monotonic):
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+        self.clock = clock
+        self._names = None
+        self._version = ""
+        self._loaded_at = 0.0
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def names(self) -> dict:
+        """{asset_id: name} de todos los assets (sin query mientras esté vigente)."""
+        generation = self._shared_generation()
+        with self._lock:
+            stale = (self._names is None or generation != self._generation
+                     or (self.ttl and self.clock() - self._loaded_at >= self.ttl))
+        return self._load(generation) if stale else self._names
+
+    def ids(self) -> dict:
+        """{name: asset_id}."""
+        return {name: a_id for a_id, name in self.names().items()}
+
+    @property
+    def version(self) -> str:
+        self.names()
+        return self._version
+
+    def legend(self, asset_ids) -> dict:
+        """{asset_id: name} sólo de asset_ids; un id que no está recarga una vez (str(id) si no existe)."""
+        asset_ids = sorted(set(asset_ids))
+        names = self.names()
+        if any(a_id not in names for a_id in asset_ids):
+            names = self.reload()
+        return {a_id: names.get(a_id, str(a_id)) for a_id in asset_ids}
+
+    def reload(self) -> dict:
+        """Vuelve a leer los nombres (p. ej. ante un asset desconocido, creado en otro proceso)."""
+        return self._load(self._shared_generation())
+
+    def invalidate(self):
+        with self._lock:
+            self._names = None
+        if self.cache_alias:
+            caches[self.cache_alias].set(GENERATION_KEY, time.time_ns(), None)
+
+    def _load(self, generation):
+        names = dict(Asset.objects.values_list("id", "name"))
+        version = hashlib.sha1(repr(sorted(names.items())).encode()).hexdigest()[:12]
+        with self._lock:
+            self._names, self._version = names, version
+            self._loaded_at, self._generation = self.clock(), generation
+        incr("asset_registry_loads")
+        return names
+
+    def _shared_generation(self):
+        return caches[self.cache_alias].get(GENERATION_KEY) if self.cache_alias else None
+
+
+_registry = None
+
+def get_asset_registry() -> AssetRegistry:
+    """Instancia por proceso desde settings.PORTFOLIOS_ASSET_REGISTRY."""
+    global _registry
+    config = registry_config()
+    if _registry is None or (_registry.ttl, _registry.cache_alias) != (config["TTL"], config["CACHE"]):
+        _registry = AssetRegistry(config["TTL"], config["CACHE"])
+    return _registry
@@ -0,0 +1,179 @@
+# portfolios/backtest.py
+"""
+Backtest de rebalanceo periódico a los InitialWeight sobre la historia de Price (`manage.py backtest`).
+
+Calendarios: monthly / quarterly (al cierre del último día con precio de cada mes / trimestre),
+threshold (cuando algún |w_{i,t} - w_i| supera el umbral) y none (buy & hold). Entre dos
+rebalanceos las cantidades son constantes, así que el motor trabaja por tramos sobre la matriz
+fechas × assets: en cada rebalanceo fija c = w·V/P, y V_t = Σ_i c_{i,t}·P_{i,t} se calcula al
+final con un solo producto sobre toda la matriz de cantidades. La detección de deriva también es
+vectorizada (ventanas crecientes de filas). No lee ni escribe la DB: sweep() carga precios y
+pesos una vez y reparte las combinaciones de parámetros en un pool de procesos.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from .analytics import returns_summary
+from .assets import get_asset_registry
+from .instrumentation import instrumented
+from .models import InitialWeight, Portfolio
+from .selectors import get_price_frame
+from .services import MissingPricesError
+
+SCHEDULES = ("none", "monthly", "quarterly", "threshold")
+
+
+def load_inputs(portfolio: Portfolio, end: date | None = None):
+    """(px, weights): precios fechas × asset_id desde la inception (forward-fill) y pesos objetivo."""
+    weights = dict(InitialWeight.objects.filter(portfolio=portfolio).values_list("asset_id", "weight"))
+    asset_ids = sorted(weights)
+    end = end or date.max
+    px = get_price_frame(asset_ids, portfolio.inception_date, end)
+    px = px.reindex(columns=asset_ids).dropna(how="all").ffill()
+    w = np.array([float(weights[a_id]) for a_id in asset_ids])
+    missing = [a_id for a_id, wi, p in zip(asset_ids, w, px.iloc[0] if len(px) else []) if wi and np.isnan(p)]
+    if not len(px) or px.index[0] != portfolio.inception_date or missing:
+        names = get_asset_registry().legend(missing or asset_ids)
+        raise MissingPricesError([(names[a_id], portfolio.inception_date) for a_id in (missing or asset_ids)])
+    return px, w
+
+
+def calendar_points(dates, schedule: str) -> np.ndarray:
+    """Índices de rebalanceo del calendario: último día con precio de cada mes/trimestre (sin el último del rango)."""
+    if schedule in ("none", "threshold"):
+        return np.array([], dtype=np.int64)
+    months = np.fromiter((d.year * 12 + d.month - 1 for d in dates), dtype=np.int64, count=len(dates))
+    keys = months if schedule == "monthly" else months // 3
+    return np.flatnonzero(keys[1:] != keys[:-1])
+
+
+def run_backtest(prices: np.ndarray, weights: np.ndarray, v0: float, schedule: str = "monthly",
+                 threshold: float = 0.05, cost_bps: float = 0.0, points: np.ndarray | None = None) -> dict:
+    """
+    Motor puro NumPy. prices: T × N (sin NaN en assets con peso > 0), weights: N.
+    points: índices de rebalanceo del calendario (ver calendar_points). Un rebalanceo en t usa
+    P_t y deja las cantidades nuevas vigentes desde t; el costo (cost_bps sobre el turnover en USD)
+    se descuenta de V_t. Devuelve qty (T × N), values (T), rebalances (índices) y trades (R × N, USD).
+    """
+    if schedule not in SCHEDULES:
+        raise ValueError(f"schedule debe ser uno de {SCHEDULES}")
+    T = len(prices)
+    prices = np.where(np.isnan(prices), 0.0, prices)  # sólo assets con peso 0 pueden venir sin precio
+    held = weights > 0
+    points = np.array([], dtype=np.int64) if points is None else points
+
+    def target(v, row):
+        q = np.zeros_like(weights)
+        q[held] = weights[held] * v / row[held]
+        return q
+
+    qty = np.empty_like(prices)
+    q = target(v0, prices[0])
+    rebalances, trades = [], []
+    start = 0
+    while True:
+        if schedule == "threshold":
+            nxt = _first_drift(prices, q, weights, start + 1, threshold)
+        else:
+            k = np.searchsorted(points, start, side="right")
+            nxt = int(points[k]) if k < len(points) else T
+        qty[start:nxt] = q
+        if nxt >= T:
+            break
+        row = prices[nxt]
+        v = float(row @ q)
+        q_new = target(v, row)
+        if cost_bps:
+            cost = cost_bps / 1e4 * float(np.abs(q_new - q) @ row)
+            q_new = target(v - cost, row)
+        trades.append((q_new - q) * row)
+        rebalances.append(nxt)
+        q, start = q_new, nxt
+    values = np.einsum("ij,ij->i", qty, prices)
+    return {"qty": qty, "values": values, "rebalances": rebalances,
+            "trades": np.array(trades).reshape(len(trades), len(weights))}
+
+
+def _first_drift(prices, q, weights, start, threshold, block: int = 32):
+    """Primer índice ≥ start donde max_i |w_{i,t} - w_i| > threshold (T si nunca), en bloques crecientes."""
+    T = len(prices)
+    while start < T:
+        stop = min(T, start + block)
+        x = prices[start:stop] * q
+        w = x / x.sum(axis=1, keepdims=True)
+        hit = np.flatnonzero(np.abs(w - weights).max(axis=1) > threshold)
+        if len(hit):
+            return start + int(hit[0])
+        start, block = stop, block * 2
+    return T
+
+
+@instrumented("backtest.run")
+def backtest(portfolio: Portfolio, schedule: str = "monthly", threshold: float = 0.05, cost_bps: float = 0.0,
+             end: date | None = None, inputs=None) -> dict:
+    """
+    Backtest de un portafolio: serie V_t, rebalanceos, trades implícitos [(fecha, asset_id, USD)]
+    y resumen (retornos de V_t: el rebalanceo es autofinanciado, los costos restan).
+    """
+    px, w = inputs or load_inputs(portfolio, end)
+    dates = list(px.index)
+    result = run_backtest(px.to_numpy(), w, float(portfolio.initial_value_usd), schedule, threshold, cost_bps,
+                          calendar_points(dates, schedule))
+    values = pd.Series(result["values"], index=px.index)
+    trades = [(dates[t], a_id, float(amount))
+              for t, row in zip(result["rebalances"], result["trades"])
+              for a_id, amount in zip(px.columns, row) if amount]
+    return {
+        "values": values,
+        "rebalances": [dates[t] for t in result["rebalances"]],
+        "trades": trades,
+        "summary": _summary(values, result, cost_bps),
+    }
+
+
+def _summary(values: pd.Series, result: dict, cost_bps: float) -> dict:
+    summary = returns_summary(values.pct_change().iloc[1:], values.index[0])
+    turnover = float(np.abs(result["trades"]).sum())
+    return {**summary, "rebalances": len(result["rebalances"]), "turnover_usd": turnover,
+            "costs_usd": turnover * cost_bps / 1e4}
+
+
+# --- sweep de parámetros ---
+
+_inputs = None
+
+
+def sweep(portfolio: Portfolio, param_sets, end: date | None = None, workers: int = 1) -> list:
+    """
+    Corre muchas combinaciones {schedule, threshold, cost_bps} sobre los mismos precios (leídos una
+    vez). Con workers > 1 se reparten en un pool de procesos; cada worker recibe la matriz una sola
+    vez (initializer) y no toca la DB (requiere el start method 'fork', el default en Linux).
+    Devuelve [{**params, **resumen}] en el orden de param_sets.
+    """
+    px, w = load_inputs(portfolio, end)
+    payload = (px.to_numpy(), w, float(portfolio.initial_value_usd), list(px.index))
+    param_sets = [dict(p) for p in param_sets]
+    workers = min(workers, len(param_sets))
+    if workers <= 1:
+        _sweep_init(payload)
+        return [_sweep_one(p) for p in param_sets]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_sweep_init, initargs=(payload,)) as pool:
+        return list(pool.map(_sweep_one, param_sets, chunksize=max(1, len(param_sets) // (workers * 4))))
+
+
+def _sweep_init(payload):
+    global _inputs
+    _inputs = payload
+
+
+def _sweep_one(params: dict) -> dict:
+    prices, w, v0, dates = _inputs
+    schedule = params.get("schedule", "monthly")
+    cost_bps = params.get("cost_bps", 0.0)
+    result = run_backtest(prices, w, v0, schedule, params.get("threshold", 0.05), cost_bps,
+                          calendar_points(dates, schedule))
+    values = pd.Series(result["values"], index=dates)
+    return {**params, **_summary(values, result, cost_bps)}
@@ -0,0 +1,123 @@
+# portfolios/bench.py
+"""
+Harness de benchmarks (ver `manage.py bench`): universo sintético + medición de latencia,
+queries y memoria pico por operación, con baselines JSON comparables entre commits.
+"""
+import contextlib
+import io
+import time
+import tracemalloc
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+def generate_workbook(path: str, n_assets: int = 20, years: float = 2, start: date = date(2020, 1, 1),
+                      seed: int = 0) -> list:
+    """
+    Escribe un datos.xlsx sintético (hojas Weights y Precios, mismo layout que el original):
+    precios diarios hábiles con paseo aleatorio geométrico y pesos aleatorios para
+    'portafolio 1' y 'portafolio 2'. Devuelve las fechas de precio.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(start, periods=int(years * 261))
+    names = [f"Asset {i:04d}" for i in range(n_assets)]
+    returns = rng.normal(0.0002, 0.01, size=(len(dates), n_assets))
+    prices = 100 * np.exp(np.cumsum(returns, axis=0))
+    df_p = pd.DataFrame(np.round(prices, 6), columns=names)
+    df_p.insert(0, "Dates", dates)
+    df_w = pd.DataFrame({
+        "activos": names,
+        "portafolio 1": rng.dirichlet(np.ones(n_assets)).round(8),
+        "portafolio 2": rng.dirichlet(np.ones(n_assets)).round(8),
+    })
+    with pd.ExcelWriter(path) as xw:
+        df_w.to_excel(xw, sheet_name="Weights", index=False)
+        df_p.to_excel(xw, sheet_name="Precios", index=False)
+    return [d.date() for d in dates]
+
+
+def random_weights(asset_ids, rng) -> dict:
+    w = rng.dirichlet(np.ones(len(asset_ids)))
+    return {a_id: Decimal(str(round(x, 8))) for a_id, x in zip(asset_ids, w)}
+
+
+def generate_trades(asset_ids, dates, t0: date, v0: Decimal, trades_per_month: float, rng):
+    """[(asset_id, date, amount_usd)] ordenados por fecha; montos ±0.1–0.5% de V0, sesgados a compra."""
+    dates = [d for d in dates if d > t0]
+    n = int(round(trades_per_month * len(dates) / 21))
+    picks = sorted(rng.choice(len(dates), size=min(n, len(dates)), replace=False)) if n else []
+    trades = []
+    for i in picks:
+        sign = 1 if rng.random() < 0.7 else -1
+        amount = Decimal(str(round(float(v0) * rng.uniform(0.001, 0.005), 2))) * sign
+        trades.append((int(rng.choice(asset_ids)), dates[i], amount))
+    return trades
+
+
+class Timer:
+    """Acumula muestras (segundos, queries) de una operación y una medición de memoria pico."""
+    def __init__(self, name: str):
+        self.name = name
+        self.times = []
+        self.queries = []
+        self.peak_bytes = None
+
+    def measure(self, fn, *args, **kwargs):
+        """Una muestra de tiempo + queries. Si fn lanza, la muestra no se registra."""
+        with CaptureQueriesContext(connection) as ctx, contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            result = fn(*args, **kwargs)
+            self.times.append(time.perf_counter() - t0)
+        self.queries.append(len(ctx.captured_queries))
+        return result
+
+    def measure_memory(self, fn, *args, **kwargs):
+        """Memoria pico (tracemalloc) en una corrida aparte: tracemalloc distorsiona los tiempos."""
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = fn(*args, **kwargs)
+            self.peak_bytes = max(self.peak_bytes or 0, tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        return result
+
+    def measure_both(self, fn, *args, **kwargs):
+        """Para operaciones que no se pueden repetir (escriben datos): tiempo y memoria juntos."""
+        return self.measure(self.measure_memory, fn, *args, **kwargs)
+
+    def summary(self) -> dict:
+        ms = np.array(self.times) * 1000
+        return {
+            "n": len(ms),
+            "p50_ms": round(float(np.percentile(ms, 50)), 3),
+            "p90_ms": round(float(np.percentile(ms, 90)), 3),
+            "p99_ms": round(float(np.percentile(ms, 99)), 3),
+            "mean_ms": round(float(ms.mean()), 3),
+            "max_ms": round(float(ms.max()), 3),
+            "queries": int(np.median(self.queries)),
+            "peak_kb": None if self.peak_bytes is None else round(self.peak_bytes / 1024, 1),
+        }
+
+
+def compare(results: dict, baseline: dict, threshold: float = 0.2) -> list:
+    """[(benchmark, métrica, antes, ahora, cambio relativo)] de las que empeoraron más de threshold."""
+    regressions = []
+    for name, now in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        for metric in ("p50_ms", "p90_ms", "queries", "peak_kb"):
+            b, n = before.get(metric), now.get(metric)
+            if not b or n is None:
+                continue
+            change = (n - b) / b
+            # las queries son deterministas: cualquier aumento es regresión (típicamente un N+1)
+            if (metric == "queries" and n > b) or (metric != "queries" and change > threshold):
+                regressions.append((name, metric, b, n, change))
+    return regressions
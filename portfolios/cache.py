@@ -0,0 +1,222 @@
+# portfolios/cache.py
+"""
+Cache de respuestas de /metrics con invalidación por versión de datos.
+
+La llave incluye Portfolio.data_version, que sube con cada trade, cambio de holdings
+o carga de precios del portafolio (ver services.refresh_daily_valuations): una entrada
+vieja nunca se vuelve a servir, simplemente deja de ser alcanzable y la expulsa el LRU/TTL.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .instrumentation import incr
+
+_MISSING = object()
+
+
+class LocMemBackend:
+    """LRU en memoria del proceso con TTL."""
+    def __init__(self, max_entries: int = 256, ttl: float = 3600, clock=time.monotonic, **_):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return _MISSING
+            expires_at, value = item
+            if expires_at is not None and expires_at <= self.clock():
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = self.clock() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileBackend:
+    """Un pickle por entrada en un directorio; LRU por mtime (se actualiza en cada hit)."""
+    def __init__(self, location: str = "", max_entries: int = 256, ttl: float = 3600):
+        self.location = location or os.path.join(tempfile.gettempdir(), "portfolios-metrics-cache")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        os.makedirs(self.location, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.location, hashlib.sha1(key.encode()).hexdigest() + ".pkl")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                expires_at, value = pickle.load(fh)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return _MISSING
+        if expires_at is not None and expires_at <= time.time():
+            self._remove(path)
+            return _MISSING
+        os.utime(path)
+        return value
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fh:
+            pickle.dump((expires_at, value), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)  # escritura atómica entre procesos
+        self._evict()
+
+    def _evict(self):
+        entries = [e for e in os.scandir(self.location) if e.name.endswith(".pkl")]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for e in entries[:len(entries) - self.max_entries]:
+            self._remove(e.path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        for e in os.scandir(self.location):
+            if e.name.endswith(".pkl"):
+                self._remove(e.path)
+
+
+class DjangoCacheBackend:
+    """Delegado a un alias de settings.CACHES (la expulsión la maneja ese backend)."""
+    def __init__(self, location: str = "", ttl: float = 3600, **_):
+        from django.core.cache import caches
+        self.cache = caches[location or "default"]
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.cache.get(key, _MISSING)
+
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=self.ttl or None)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class NullBackend:
+    def __init__(self, **_):
+        pass
+
+    def get(self, key):
+        return _MISSING
+
+    def set(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+
+BACKENDS = {
+    "locmem": LocMemBackend,
+    "file": FileBackend,
+    "django": DjangoCacheBackend,
+    "none": NullBackend,
+}
+
+
+class MetricsCache:
+    """Front-end del backend con contadores de hits/misses (por proceso)."""
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        """Valor cacheado o None (cuenta hit/miss)."""
+        value = self.backend.get(key)
+        if value is _MISSING:
+            self.misses += 1
+            incr("metrics_cache_misses")
+            return None
+        self.hits += 1
+        incr("metrics_cache_hits")
+        return value
+
+    def set(self, key: str, value):
+        self.backend.set(key, value)
+
+    async def aget(self, key: str):
+        # el backend 'django' puede ir a red/DB: fuera del event loop
+        return await sync_to_async(self.get)(key)
+
+    async def aset(self, key: str, value):
+        await sync_to_async(self.set)(key, value)
+
+    def get_or_compute(self, key: str, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def stats(self):
+        return {"backend": type(self.backend).__name__, "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        self.backend.clear()
+
+
+def build_metrics_cache(config: dict | None = None) -> MetricsCache:
+    config = config or {}
+    backend = BACKENDS[config.get("BACKEND", "locmem")](
+        location=config.get("LOCATION", ""),
+        max_entries=int(config.get("MAX_ENTRIES", 256)),
+        ttl=float(config.get("TTL", 3600)),
+    )
+    return MetricsCache(backend)
+
+
+_metrics_cache = None
+
+def get_metrics_cache() -> MetricsCache:
+    """Instancia por proceso construida desde settings.PORTFOLIOS_METRICS_CACHE."""
+    global _metrics_cache
+    if _metrics_cache is None:
+        _metrics_cache = build_metrics_cache(getattr(settings, "PORTFOLIOS_METRICS_CACHE", None))
+    return _metrics_cache
+
+
+def metrics_cache_key(portfolio, start, end, *extra) -> str:
+    """portfolio + versión de datos + rango (+ parámetros de formato)."""
+    parts = ["metrics", str(portfolio.id), str(portfolio.data_version), start.isoformat(), end.isoformat()]
+    parts += [str(e) for e in extra]
+    return ":".join(parts)
+
+
+def etag_for(key: str) -> str:
+    return '"%s"' % hashlib.sha1(key.encode()).hexdigest()
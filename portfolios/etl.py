@@ -0,0 +1,197 @@
+# portfolios/etl.py
+"""Helpers de ingesta de precios compartidos por los comandos de carga."""
+import csv
+import io
+from datetime import date
+from decimal import Decimal
+from itertools import islice
+
+import pandas as pd
+from django.db import connection, transaction
+from django.db.models import Max
+
+from .models import Asset, Price
+from .partitions import ensure_price_partitions
+
+DATE_COLS = ("Dates", "Date", "Fecha", "fecha", "date")
+
+
+def pick_sheet(xls: pd.ExcelFile, *cands: str) -> str:
+    """Devuelve el nombre real de la hoja matcheando por lower() y parcial."""
+    names = [s.strip() for s in xls.sheet_names]
+    lower = {s.lower(): s for s in names}
+    # exactos por lower
+    for c in cands:
+        if c.lower() in lower:
+            return lower[c.lower()]
+    # parciales (e.g. "Sheet - weights")
+    for s in names:
+        sl = s.lower()
+        if any(c.lower() in sl for c in cands):
+            return s
+    raise SystemExit(f"No se encontró ninguna hoja entre {cands}. Hojas: {names}")
+
+
+def find_col(df: pd.DataFrame, *cands: str) -> str | None:
+    """Devuelve el nombre real de la columna matcheando por lower(); None si no hay ninguna."""
+    lower = {str(c).strip().lower(): str(c).strip() for c in df.columns}
+    for c in cands:
+        if c.lower() in lower:
+            return lower[c.lower()]
+    return None
+
+
+def pick_col(df: pd.DataFrame, *cands: str) -> str:
+    """Como find_col; fallback: primera columna."""
+    return find_col(df, *cands) or str(df.columns[0]).strip()
+
+
+def melt_prices(df: pd.DataFrame, date_col: str) -> pd.DataFrame:
+    """Hoja ancha (fecha × activo) → largo [date, asset, price], sin celdas vacías."""
+    asset_cols = [c for c in df.columns if c != date_col]
+    long = df.melt(id_vars=[date_col], value_vars=asset_cols, var_name="asset", value_name="price")
+    long = long.dropna(subset=[date_col, "price"])
+    long["date"] = pd.to_datetime(long[date_col]).dt.date
+    return long[["date", "asset", "price"]]
+
+
+def iter_price_chunks(xlsx_path: str, sheet_name: str, chunk_size: int = 5000):
+    """
+    Lee la hoja de precios con openpyxl en modo read-only y genera (asset_names, DataFrame largo)
+    por bloque de 'chunk_size' filas: la memoria queda acotada por el bloque, no por la hoja.
+    """
+    import openpyxl
+
+    wb = openpyxl.load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        rows = wb[sheet_name].iter_rows(values_only=True)
+        header = [str(c).strip() if c is not None else "" for c in next(rows)]
+        date_col = pick_col(pd.DataFrame(columns=header), *DATE_COLS)
+        asset_names = [c for c in header if c and c != date_col]
+        while True:
+            block = list(islice(rows, chunk_size))
+            if not block:
+                break
+            df = pd.DataFrame.from_records(block, columns=header)
+            yield asset_names, melt_prices(df[[date_col, *asset_names]], date_col)
+    finally:
+        wb.close()
+
+
+def ensure_assets(names) -> dict:
+    """{name: Asset}, creando los que falten."""
+    assets = {}
+    for name in names:
+        a, _ = Asset.objects.get_or_create(name=str(name).strip())
+        assets[a.name] = a
+    return assets
+
+
+def _format_price(x) -> str:
+    # repr de float = el mismo texto que producía Decimal(str(x)) en el loader original
+    return repr(float(x))
+
+
+def write_prices(long: pd.DataFrame, asset_ids: dict) -> int:
+    """
+    Inserta precios [date, asset, price] ignorando los (asset, date) existentes.
+    PostgreSQL: COPY a una tabla staging + INSERT ... ON CONFLICT DO NOTHING.
+    Otros motores: bulk_create(ignore_conflicts=True).
+    Devuelve la cantidad de filas procesadas.
+    """
+    if long.empty:
+        return 0
+    ids = long["asset"].map(asset_ids)
+    if connection.vendor == "postgresql":
+        ensure_price_partitions(long["date"].min(), long["date"].max())
+        _copy_merge_prices(zip(ids, long["date"], long["price"]))
+    else:
+        Price.objects.bulk_create(
+            [Price(asset_id=a_id, date=d, price=Decimal(_format_price(p)))
+             for a_id, d, p in zip(ids, long["date"], long["price"])],
+            ignore_conflicts=True, batch_size=5000,
+        )
+    return len(long)
+
+
+def _copy_merge_prices(rows):
+    table = connection.ops.quote_name(Price._meta.db_table)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for a_id, d, p in rows:
+        writer.writerow((a_id, d.isoformat(), _format_price(p)))
+    buf.seek(0)
+
+    copy_sql = "COPY portfolios_price_staging (asset_id, date, price) FROM STDIN WITH (FORMAT csv)"
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS portfolios_price_staging "
+            "(asset_id bigint, date date, price numeric(20, 8))"
+        )
+        cursor.execute("TRUNCATE portfolios_price_staging")
+        raw = cursor.cursor
+        if hasattr(raw, "copy_expert"):  # psycopg2
+            raw.copy_expert(copy_sql, buf)
+        else:  # psycopg 3
+            with raw.copy(copy_sql) as copy:
+                copy.write(buf.getvalue())
+        cursor.execute(
+            f"INSERT INTO {table} (asset_id, date, price, created_at, updated_at) "
+            "SELECT asset_id, date, price, now(), now() FROM portfolios_price_staging "
+            "ON CONFLICT (asset_id, date) DO NOTHING"
+        )
+
+
+def get_max_price_dates(asset_ids) -> dict:
+    """{asset_id: última fecha con precio guardado}."""
+    return dict(Price.objects.filter(asset_id__in=list(asset_ids))
+                .values("asset_id").annotate(m=Max("date")).values_list("asset_id", "m"))
+
+
+def upsert_prices(long: pd.DataFrame, asset_ids: dict, max_dates: dict, only_new: bool = False):
+    """
+    Carga incremental de precios [date, asset, price].
+    Filas posteriores a max_dates[asset_id] se insertan sin mirar la DB; las demás se comparan
+    con lo guardado y sólo las que cambiaron se escriben (bulk_create con update_conflicts).
+    Con only_new=True las filas ≤ max_date se ignoran.
+    Devuelve ({"inserted", "updated", "unchanged"}, {asset_id: primera fecha modificada}).
+    """
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    if long.empty:
+        return counts, {}
+    df = long.assign(asset_id=long["asset"].map(asset_ids))
+    is_new = df["date"] > df["asset_id"].map(max_dates).fillna(date.min)
+    new, old = df[is_new], df[~is_new]
+
+    gaps = changed = old.iloc[0:0]
+    if only_new:
+        counts["unchanged"] = len(old)
+    elif not old.empty:
+        stored = {
+            (a_id, d): p for a_id, d, p in Price.objects
+            .filter(asset_id__in=old["asset_id"].unique().tolist(),
+                    date__gte=old["date"].min(), date__lte=old["date"].max())
+            .values_list("asset_id", "date", "price")
+        }
+        q = Decimal("0.00000001")
+        # None = hueco en la historia guardada, True = precio corregido, False = sin cambios
+        status = pd.Series([
+            None if (a_id, d) not in stored else stored[(a_id, d)] != Decimal(_format_price(p)).quantize(q)
+            for a_id, d, p in zip(old["asset_id"], old["date"], old["price"])
+        ], index=old.index, dtype=object)
+        gaps, changed = old[status.isna()], old[status.eq(True)]
+        counts["unchanged"] = int(status.eq(False).sum())
+
+    to_write = pd.concat([new, gaps, changed])
+    if not to_write.empty:
+        ensure_price_partitions(to_write["date"].min(), to_write["date"].max())
+    Price.objects.bulk_create(
+        [Price(asset_id=a_id, date=d, price=Decimal(_format_price(p)))
+         for a_id, d, p in zip(to_write["asset_id"], to_write["date"], to_write["price"])],
+        update_conflicts=True, unique_fields=["asset", "date"], update_fields=["price", "updated_at"],
+        batch_size=5000,
+    )
+    counts["inserted"] = len(new) + len(gaps)
+    counts["updated"] = len(changed)
+    changes = to_write.groupby("asset_id")["date"].min().to_dict()
+    return counts, changes
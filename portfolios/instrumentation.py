@@ -0,0 +1,94 @@
+# portfolios/instrumentation.py
+"""
+Instrumentación opt-in (settings.PORTFOLIOS_INSTRUMENTATION["ENABLED"]): spans de tiempo por etapa
+y contadores, en un registro por proceso que /metrics/prometheus expone en formato de texto
+de Prometheus. Deshabilitada, span() e incr() no hacen nada más que leer el flag.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def enabled() -> bool:
+    return getattr(settings, "PORTFOLIOS_INSTRUMENTATION", {}).get("ENABLED", False)
+
+
+class Registry:
+    """Histogramas de duración por etapa + contadores (por proceso, thread-safe)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}  # stage -> [conteo por bucket..., +Inf], suma
+        self.counters = {}
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            buckets, total = self.histograms.get(stage) or ([0] * (len(BUCKETS) + 1), 0.0)
+            buckets[bisect_left(BUCKETS, seconds)] += 1
+            self.histograms[stage] = (buckets, total + seconds)
+
+    def incr(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def clear(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            histograms = {k: (list(b), s) for k, (b, s) in self.histograms.items()}
+            counters = dict(self.counters)
+        lines = [
+            "# HELP portfolios_stage_seconds Duración de cada etapa instrumentada.",
+            "# TYPE portfolios_stage_seconds histogram",
+        ]
+        for stage, (buckets, total) in sorted(histograms.items()):
+            cumulative = 0
+            for le, count in zip((*BUCKETS, "+Inf"), buckets):
+                cumulative += count
+                lines.append(f'portfolios_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'portfolios_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'portfolios_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE portfolios_{name}_total counter")
+            lines.append(f"portfolios_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+@contextmanager
+def span(stage: str):
+    """Mide el bloque como una observación de la etapa `stage`."""
+    if not enabled():
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(stage, time.perf_counter() - t0)
+
+
+def instrumented(stage: str):
+    """Decorador equivalente a envolver la función en span(stage)."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def incr(name: str, n: int = 1):
+    if enabled():
+        registry.incr(name, n)
@@ -0,0 +1,232 @@
+# portfolios/jobs.py
+"""
+Cola de trabajos durable sobre la tabla Job, sin broker externo.
+
+- enqueue() fusiona un job con el que ya esté en cola con la misma dedupe_key (coalescing).
+  La llave se conserva mientras el job corre o espera un reintento y se libera en done/failed.
+- claim_jobs() toma jobs listos con SELECT ... FOR UPDATE SKIP LOCKED: varios workers
+  (`manage.py run_worker`, en uno o más procesos/hosts) nunca toman el mismo job.
+- run_job() ejecuta el handler del tipo; si falla, reintenta con backoff exponencial
+  hasta MAX_ATTEMPTS y después lo deja en 'failed'.
+"""
+import logging
+import traceback
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger("portfolios.jobs")
+
+REFRESH_VALUATIONS = "refresh_valuations"
+WARM_CACHE = "warm_cache"
+POST_TRADES = "post_trades"
+
+
+class PermanentJobError(Exception):
+    """El job no tiene arreglo reintentando (p.ej. trades inválidos): pasa directo a 'failed'."""
+
+
+def jobs_config() -> dict:
+    return {"ASYNC_REFRESH": False, "WARM_AFTER_REFRESH": False, "MAX_ATTEMPTS": 5,
+            "BACKOFF_BASE": 5, "BACKOFF_MAX": 600, **getattr(settings, "PORTFOLIOS_JOBS", {})}
+
+
+# --- encolado ---
+
+def _merge_refresh(old: dict, new: dict) -> dict:
+    # None = historia completa: gana sobre cualquier fecha
+    dates = [old.get("from_date"), new.get("from_date")]
+    return {"from_date": None if None in dates else min(dates)}
+
+
+def _merge_warm(old: dict, new: dict) -> dict:
+    ranges = [list(r) for r in old.get("ranges", [])]
+    ranges += [list(r) for r in new.get("ranges", []) if list(r) not in ranges]
+    return {"ranges": ranges}
+
+
+MERGERS = {REFRESH_VALUATIONS: _merge_refresh, WARM_CACHE: _merge_warm}
+
+
+def enqueue(kind: str, portfolio_id: int | None = None, payload: dict | None = None, delay: float = 0) -> Job:
+    """
+    Encola un job. Los tipos con merger (refresh, warmup) se fusionan con el job en cola del
+    mismo portafolio en lugar de duplicarse; los jobs ya tomados por un worker no se tocan (el
+    nuevo espera a que terminen, ver claim_jobs).
+    """
+    payload = payload or {}
+    run_after = timezone.now() + timedelta(seconds=delay)
+    merge = MERGERS.get(kind)
+    if merge is None or portfolio_id is None:
+        return Job.objects.create(kind=kind, portfolio_id=portfolio_id, payload=payload, run_after=run_after)
+
+    key = f"{kind}:{portfolio_id}"
+    for _ in range(3):  # carrera con otro enqueue de la misma llave: el índice único decide
+        try:
+            with transaction.atomic():
+                job = Job.objects.select_for_update().filter(dedupe_key=key, status=Job.QUEUED).first()
+                if job is None:
+                    return Job.objects.create(kind=kind, portfolio_id=portfolio_id, payload=payload,
+                                              dedupe_key=key, run_after=run_after)
+                job.payload = merge(job.payload, payload)
+                job.run_after = min(job.run_after, run_after)
+                job.save(update_fields=["payload", "run_after", "updated_at"])
+                return job
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"No se pudo encolar {key}")
+
+
+def enqueue_on_commit(kind: str, portfolio_id: int | None = None, payload: dict | None = None):
+    """enqueue() cuando la transacción actual confirma (inmediato en autocommit)."""
+    transaction.on_commit(lambda: enqueue(kind, portfolio_id, payload))
+
+
+# --- worker ---
+
+def claim_jobs(worker_id: str, limit: int = 1, stale_after: float = 600) -> list:
+    """
+    Toma hasta `limit` jobs listos (run_after ≤ ahora) y los marca 'running'. Jobs 'running'
+    cuyo lock tiene más de stale_after segundos (worker caído) vuelven a la cola. Un job cuya
+    dedupe_key tiene otro job corriendo espera a que ese termine: nunca corren dos refresh
+    del mismo portafolio a la vez.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        for job in Job.objects.select_for_update(skip_locked=True).filter(
+                status=Job.RUNNING, locked_at__lt=now - timedelta(seconds=stale_after)):
+            _requeue(job, now)
+        running_keys = Job.objects.filter(status=Job.RUNNING, dedupe_key__isnull=False).values("dedupe_key")
+        # skip_locked: jobs bloqueados por otro worker se saltan en vez de esperar
+        ids = list(Job.objects.select_for_update(skip_locked=True)
+                   .filter(status=Job.QUEUED, run_after__lte=now)
+                   .exclude(dedupe_key__in=running_keys)
+                   .order_by("run_after", "id")
+                   .values_list("id", flat=True)[:limit])
+        # la dedupe_key se conserva mientras corre: un enqueue nuevo crea otro job que espera a éste
+        Job.objects.filter(id__in=ids).update(
+            status=Job.RUNNING, locked_by=worker_id, locked_at=now, attempts=F("attempts") + 1,
+        )
+    return list(Job.objects.filter(id__in=ids).order_by("run_after", "id"))
+
+
+def _requeue(job: Job, run_after):
+    """
+    Devuelve un job tomado a la cola. Si mientras corría se encoló otro con la misma llave,
+    el reintento se fusiona en ése (payload, run_after y attempts) y éste queda 'failed'.
+    """
+    for _ in range(3):  # carrera con un enqueue de la misma llave: el índice único decide
+        try:
+            with transaction.atomic():
+                pending = None
+                if job.dedupe_key:
+                    pending = Job.objects.select_for_update().filter(dedupe_key=job.dedupe_key,
+                                                                     status=Job.QUEUED).first()
+                if pending is None:
+                    job.status, job.run_after = Job.QUEUED, run_after
+                else:
+                    pending.payload = MERGERS[job.kind](pending.payload, job.payload)
+                    pending.run_after = min(pending.run_after, run_after)
+                    pending.attempts = max(pending.attempts, job.attempts)
+                    pending.save(update_fields=["payload", "run_after", "attempts", "updated_at"])
+                    job.status, job.dedupe_key = Job.FAILED, None
+                    job.last_error = f"reintento fusionado en {pending}\n{job.last_error}"[:4000]
+                job.locked_by, job.locked_at = "", None
+                job.save(update_fields=["status", "dedupe_key", "run_after", "last_error", "locked_by",
+                                        "locked_at", "updated_at"])
+                return
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"No se pudo reencolar {job}")
+
+
+def run_job(job: Job) -> bool:
+    """Ejecuta un job tomado; True si terminó bien."""
+    try:
+        HANDLERS[job.kind](job)
+    except Exception as exc:
+        config = jobs_config()
+        job.last_error = "".join(traceback.format_exception(exc))[-4000:]
+        if isinstance(exc, PermanentJobError) or job.attempts >= config["MAX_ATTEMPTS"]:
+            job.status, job.dedupe_key = Job.FAILED, None
+            job.locked_by, job.locked_at = "", None
+            job.save(update_fields=["status", "dedupe_key", "last_error", "locked_by", "locked_at", "updated_at"])
+            logger.error("job %s falló definitivamente: %s", job, exc)
+        else:
+            backoff = min(config["BACKOFF_BASE"] * 2 ** (job.attempts - 1), config["BACKOFF_MAX"])
+            _requeue(job, timezone.now() + timedelta(seconds=backoff))
+            logger.warning("job %s falló (intento %s), reintento en %ss: %s", job, job.attempts, backoff, exc)
+        return False
+    job.status, job.dedupe_key = Job.DONE, None
+    job.last_error = ""
+    job.save(update_fields=["status", "dedupe_key", "last_error", "updated_at"])
+    return True
+
+
+def run_pending(worker_id: str = "inline", limit: int = 100) -> int:
+    """Procesa lo que esté listo en este proceso (tests, cron, comandos). Devuelve cuántos corrió."""
+    n = 0
+    while jobs := claim_jobs(worker_id, limit):
+        for job in jobs:
+            run_job(job)
+            n += 1
+    return n
+
+
+# --- handlers ---
+
+def _refresh_valuations(job: Job):
+    from .services import refresh_daily_valuations
+
+    from_date = job.payload.get("from_date")
+    portfolio = job.portfolio
+    refresh_daily_valuations(portfolio, date.fromisoformat(from_date) if from_date else None)
+    last = portfolio.daily_valuations.order_by("-date").values_list("date", flat=True).first()
+    if last and jobs_config()["WARM_AFTER_REFRESH"]:
+        # el rango completo es el que piden los dashboards por defecto
+        enqueue_on_commit(WARM_CACHE, portfolio.id,
+                          {"ranges": [[portfolio.inception_date.isoformat(), last.isoformat(), "json"]]})
+
+
+def _warm_cache(job: Job):
+    """Precalcula payloads de /metrics en la cache compartida (útil con backend file/django)."""
+    from .api.views import build_metrics_payload
+    from .assets import get_asset_registry
+    from .cache import get_metrics_cache, metrics_cache_key
+    from .sampling import default_max_points
+    from .selectors import numeric_backend
+
+    portfolio = job.portfolio
+    portfolio.refresh_from_db()  # data_version vigente
+    cache = get_metrics_cache()
+    max_points = default_max_points()  # la misma variante que pide un request sin freq/max_points/assets
+    version = get_asset_registry().version
+    for start, end, output in job.payload.get("ranges", []):
+        start, end = date.fromisoformat(start), date.fromisoformat(end)
+        key = metrics_cache_key(portfolio, start, end, output, numeric_backend(), "daily", max_points, "names", version)
+        if cache.get(key) is None:
+            cache.set(key, build_metrics_payload(portfolio, start, end, output, "daily", max_points))
+
+
+def _post_trades(job: Job):
+    from .services import BulkTradeError, post_trades_bulk
+
+    trades = [(p_id, a_id, date.fromisoformat(d), amount) for p_id, a_id, d, amount in job.payload["trades"]]
+    try:
+        result = post_trades_bulk(trades, skip_invalid=job.payload.get("skip_invalid", False))
+    except BulkTradeError as exc:
+        raise PermanentJobError(str(exc)) from exc
+    job.payload = {**job.payload, "result": {"created": result["created"], "errors": result["errors"]}}
+    job.save(update_fields=["payload", "updated_at"])
+
+
+HANDLERS = {
+    REFRESH_VALUATIONS: _refresh_valuations,
+    WARM_CACHE: _warm_cache,
+    POST_TRADES: _post_trades,
+}
@@ -0,0 +1,89 @@
+import csv
+import itertools
+import json
+import os
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from portfolios.assets import get_asset_registry
+from portfolios.backtest import SCHEDULES, backtest, sweep
+from portfolios.models import Portfolio
+from portfolios.services import MissingPricesError
+
+
+def _floats(raw: str):
+    return [float(x) for x in raw.split(",") if x.strip()]
+
+
+class Command(BaseCommand):
+    help = ("Backtest de rebalanceo a los InitialWeight sobre la historia de precios (no escribe en la DB). "
+            "Con --sweep corre la grilla schedules × thresholds × costos en paralelo.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("portfolio", type=str, help="Nombre o id del portafolio")
+        parser.add_argument("--schedule", choices=SCHEDULES, default="monthly")
+        parser.add_argument("--threshold", type=float, default=0.05, help="Deriva máxima |w - w_objetivo| (threshold)")
+        parser.add_argument("--cost-bps", type=float, default=0.0, help="Costo por USD transado, en bps")
+        parser.add_argument("--end", type=str, default=None, help="YYYY-MM-DD; por defecto el último precio")
+        parser.add_argument("--trades", type=str, default=None, help="CSV donde guardar los trades implícitos")
+        parser.add_argument("--sweep", action="store_true", help="Barre --schedules × --thresholds × --costs")
+        parser.add_argument("--schedules", type=str, default="none,monthly,quarterly,threshold")
+        parser.add_argument("--thresholds", type=str, default="0.01,0.02,0.05,0.1")
+        parser.add_argument("--costs", type=str, default="0")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Procesos del sweep")
+        parser.add_argument("--output", type=str, default=None, help="Guarda el resultado como JSON")
+
+    def handle(self, *args, **opts):
+        lookup = {"id": int(opts["portfolio"])} if opts["portfolio"].isdigit() else {"name": opts["portfolio"]}
+        portfolio = Portfolio.objects.filter(**lookup).first()
+        if portfolio is None:
+            raise CommandError(f"No existe el portafolio {opts['portfolio']}")
+        end = datetime.strptime(opts["end"], "%Y-%m-%d").date() if opts["end"] else None
+        try:
+            if opts["sweep"]:
+                result = self.run_sweep(portfolio, end, opts)
+            else:
+                result = self.run_one(portfolio, end, opts)
+        except MissingPricesError as exc:
+            raise CommandError(str(exc)) from exc
+        if opts["output"]:
+            with open(opts["output"], "w") as fh:
+                json.dump(result, fh, cls=DjangoJSONEncoder, indent=2)
+            self.stdout.write(f"Resultado guardado en {opts['output']}")
+
+    def run_one(self, portfolio, end, opts):
+        result = backtest(portfolio, opts["schedule"], opts["threshold"], opts["cost_bps"], end)
+        s = result["summary"]
+        self.stdout.write(self.style.SUCCESS(
+            f"{portfolio.name} [{opts['schedule']}]: retorno {s['total_return'] or 0:.2%}, vol {s['annualized_volatility'] or 0:.2%}, "
+            f"max DD {s['max_drawdown'] or 0:.2%}, {s['rebalances']} rebalanceos, {len(result['trades'])} trades"
+        ))
+        if opts["trades"]:
+            names = get_asset_registry().names()
+            with open(opts["trades"], "w", newline="") as fh:
+                # mismo layout que acepta load_trades
+                writer = csv.writer(fh)
+                writer.writerow(["portfolio", "asset", "date", "amount_usd"])
+                for d, a_id, amount in result["trades"]:
+                    writer.writerow([portfolio.name, names[a_id], d.isoformat(), f"{amount:.2f}"])
+            self.stdout.write(f"Trades guardados en {opts['trades']}")
+        return {"summary": s, "rebalances": result["rebalances"],
+                "values": [{"date": d, "value": v} for d, v in result["values"].items()]}
+
+    def run_sweep(self, portfolio, end, opts):
+        grid = []
+        for schedule, cost in itertools.product(opts["schedules"].split(","), _floats(opts["costs"])):
+            if schedule not in SCHEDULES:
+                raise CommandError(f"schedule desconocido: {schedule}")
+            for threshold in (_floats(opts["thresholds"]) if schedule == "threshold" else [None]):
+                params = {"schedule": schedule, "cost_bps": cost}
+                if threshold is not None:
+                    params["threshold"] = threshold
+                grid.append(params)
+        rows = sweep(portfolio, grid, end, opts["workers"])
+        for row in sorted(rows, key=lambda r: -(r["total_return"] or 0)):
+            label = row["schedule"] + (f"@{row['threshold']:g}" if "threshold" in row else "")
+            self.stdout.write(f"{label:<18} {row['cost_bps']:>6g}bps  retorno {row['total_return'] or 0:>8.2%}  "
+                              f"max DD {row['max_drawdown'] or 0:>8.2%}  rebal {row['rebalances']:>4}")
+        return {"results": rows}
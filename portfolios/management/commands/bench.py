@@ -0,0 +1,152 @@
+import io
+import json
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from decimal import Decimal
+from pathlib import Path
+
+import numpy as np
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from portfolios.bench import Timer, compare, generate_trades, generate_workbook, random_weights
+from portfolios.cache import get_metrics_cache
+from portfolios.models import Asset, InitialWeight, Portfolio
+from portfolios.selectors import compute_timeseries_weights_and_value, get_holdings_at
+from portfolios.services import bootstrap_initial_holdings, post_trade_usd_notional
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks sobre un universo sintético: latencia (p50/p90/p99), queries y memoria pico "
+            "de load_datos, bootstrap, trades, get_holdings_at, valorización y /metrics.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--assets", type=int, default=20)
+        parser.add_argument("--years", type=float, default=2, help="Años de precios diarios (hábiles)")
+        parser.add_argument("--portfolios", type=int, default=5, help="Portafolios además de 'Portafolio 1'")
+        parser.add_argument("--trades-per-month", type=float, default=2, help="Trades por portafolio y mes")
+        parser.add_argument("--repeat", type=int, default=10, help="Muestras por portafolio en las lecturas")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--stream", action="store_true", help="Mide load_datos con --stream")
+        parser.add_argument("--output", type=str, default=None, help="Guarda los resultados como baseline JSON")
+        parser.add_argument("--compare", type=str, default=None, help="Baseline JSON contra el que comparar")
+        parser.add_argument("--threshold", type=float, default=0.2, help="Empeoramiento relativo tolerado")
+        parser.add_argument("--fail-on-regression", action="store_true")
+        parser.add_argument("--in-place", action="store_true",
+                            help="Usa la DB configurada en vez de una DB de test desechable")
+
+    def handle(self, *args, **opts):
+        if opts["in_place"]:
+            results = self.run(opts)
+        else:
+            # misma mecánica que `manage.py test`: test_<NAME> en PostgreSQL, memoria en SQLite
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                results = self.run(opts)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        payload = {"meta": self.meta(opts), "results": results}
+        self.report(results)
+        if opts["output"]:
+            Path(opts["output"]).parent.mkdir(parents=True, exist_ok=True)
+            Path(opts["output"]).write_text(json.dumps(payload, indent=2))
+            self.stdout.write(f"Baseline guardada en {opts['output']}")
+        if opts["compare"]:
+            baseline = json.loads(Path(opts["compare"]).read_text())
+            regressions = compare(results, baseline["results"], opts["threshold"])
+            for name, metric, before, now, change in regressions:
+                self.stdout.write(self.style.WARNING(f"REGRESIÓN {name}.{metric}: {before} → {now} ({change:+.0%})"))
+            if not regressions:
+                self.stdout.write(self.style.SUCCESS(f"Sin regresiones contra {opts['compare']}"))
+            elif opts["fail_on_regression"]:
+                raise CommandError(f"{len(regressions)} regresiones contra {opts['compare']}")
+
+    def run(self, opts):
+        rng = np.random.default_rng(opts["seed"])
+        v0 = Decimal("1000000000")
+        timers = {name: Timer(name) for name in (
+            "load_datos", "bootstrap_initial_holdings", "post_trade_usd_notional", "get_holdings_at",
+            "compute_timeseries_weights_and_value", "metrics_request", "metrics_request_cached",
+        )}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = str(Path(tmp) / "datos.xlsx")
+            dates = generate_workbook(path, opts["assets"], opts["years"], seed=opts["seed"])
+            t0, end = dates[0], dates[-1]
+            load_args = ["--stream"] if opts["stream"] else []
+            timers["load_datos"].measure_both(
+                call_command, "load_datos", path, t0.isoformat(), str(v0), "Portafolio 1", *load_args,
+                stdout=io.StringIO(),
+            )
+
+        assets = list(Asset.objects.order_by("id"))
+        asset_ids = [a.id for a in assets]
+        portfolios = [Portfolio.objects.get(name="Portafolio 1")]
+        for i in range(opts["portfolios"]):
+            p = Portfolio.objects.create(name=f"Bench {i}", inception_date=t0, initial_value_usd=v0)
+            InitialWeight.objects.bulk_create([
+                InitialWeight(portfolio=p, asset_id=a_id, weight=w)
+                for a_id, w in random_weights(asset_ids, rng).items()
+            ])
+            boot = timers["bootstrap_initial_holdings"]
+            (boot.measure_both if i == 0 else boot.measure)(bootstrap_initial_holdings, p, t0)
+            portfolios.append(p)
+
+        by_id = {a.id: a for a in assets}
+        skipped = 0
+        for p in portfolios:
+            for a_id, d, amount in generate_trades(asset_ids, dates, t0, v0, opts["trades_per_month"], rng):
+                try:
+                    timers["post_trade_usd_notional"].measure(post_trade_usd_notional, p, by_id[a_id], d, amount)
+                except ValueError:  # venta mayor a la posición
+                    skipped += 1
+        if skipped:
+            self.stdout.write(f"{skipped} trades sintéticos rechazados (cantidad negativa)")
+
+        client = Client()
+        for p in portfolios:
+            p.refresh_from_db()
+            url = f"/api/portfolios/{p.id}/metrics?fecha_inicio={t0}&fecha_fin={end}"
+            for _ in range(opts["repeat"]):
+                d = dates[int(rng.integers(len(dates)))]
+                timers["get_holdings_at"].measure(get_holdings_at, p, d)
+                timers["compute_timeseries_weights_and_value"].measure(compute_timeseries_weights_and_value, p, t0, end)
+                get_metrics_cache().clear()
+                timers["metrics_request"].measure(client.get, url)
+                timers["metrics_request_cached"].measure(client.get, url)
+        p = portfolios[-1]
+        timers["get_holdings_at"].measure_memory(get_holdings_at, p, end)
+        timers["compute_timeseries_weights_and_value"].measure_memory(compute_timeseries_weights_and_value, p, t0, end)
+        get_metrics_cache().clear()
+        timers["metrics_request"].measure_memory(client.get, url)
+        timers["metrics_request_cached"].measure_memory(client.get, url)
+        if timers["post_trade_usd_notional"].times:
+            a_id, d, amount = generate_trades(asset_ids, dates, t0, v0, 1, rng)[0]
+            timers["post_trade_usd_notional"].measure_memory(post_trade_usd_notional, p, by_id[a_id], d, abs(amount))
+
+        return {name: t.summary() for name, t in timers.items() if t.times}
+
+    def meta(self, opts):
+        try:
+            commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                    text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        params = ("assets", "years", "portfolios", "trades_per_month", "repeat", "seed", "stream")
+        return {
+            "commit": commit,
+            "vendor": connection.vendor,
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "params": {k: opts[k] for k in params},
+        }
+
+    def report(self, results):
+        self.stdout.write(f"{'benchmark':<40}{'n':>6}{'p50 ms':>11}{'p90 ms':>11}{'p99 ms':>11}"
+                          f"{'queries':>9}{'peak KB':>11}")
+        for name, r in results.items():
+            peak = "-" if r["peak_kb"] is None else f"{r['peak_kb']:.0f}"
+            self.stdout.write(f"{name:<40}{r['n']:>6}{r['p50_ms']:>11.2f}{r['p90_ms']:>11.2f}"
+                              f"{r['p99_ms']:>11.2f}{r['queries']:>9}{peak:>11}")
@@ -1,35 +1,20 @@
+import os
+
 import pandas as pd
 from decimal import Decimal
 from datetime import datetime
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from portfolios.assets import get_asset_registry
+from portfolios.etl import (
+    DATE_COLS, ensure_assets, get_max_price_dates, iter_price_chunks, melt_prices, pick_col, pick_sheet,
+    upsert_prices, write_prices,
+)
 from portfolios.models import Asset, Portfolio, Price, InitialWeight
-from portfolios.services import bootstrap_initial_holdings
-
-
-def pick_sheet(xls: pd.ExcelFile, *cands: str) -> str:
-    """Devuelve el nombre real de la hoja matcheando por lower() y parcial."""
-    names = [s.strip() for s in xls.sheet_names]
-    lower = {s.lower(): s for s in names}
-    # exactos por lower
-    for c in cands:
-        if c.lower() in lower:
-            return lower[c.lower()]
-    # parciales (e.g. "Sheet - weights")
-    for s in names:
-        sl = s.lower()
-        if any(c.lower() in sl for c in cands):
-            return s
-    raise SystemExit(f"No se encontró ninguna hoja entre {cands}. Hojas: {names}")
-
-
-def pick_col(df: pd.DataFrame, *cands: str) -> str:
-    """Devuelve el nombre real de la columna matcheando por lower(); fallback: primera."""
-    cols = [str(c).strip() for c in df.columns]
-    lower = {c.lower(): c for c in cols}
-    for c in cands:
-        if c.lower() in lower:
-            return lower[c.lower()]
-    return cols[0]
+from portfolios.services import (
+    bootstrap_initial_holdings, bootstrap_initial_holdings_bulk, refresh_daily_valuations_many,
+)
+from portfolios.signals import prices_changed
 
 
 class Command(BaseCommand):
@@ -39,22 +24,36 @@ class Command(BaseCommand):
         parser.add_argument("xlsx_path", type=str)
         parser.add_argument("t0", type=str, help="YYYY-MM-DD, e.g. 2022-02-15")
         parser.add_argument("v0", type=str, help="Initial portfolio value in USD, e.g. 1000000000")
-        parser.add_argument("portfolio_name", type=str)
+        parser.add_argument("portfolio_name", type=str, nargs="?", default=None)
+        parser.add_argument("--all-portfolios", action="store_true",
+                            help="Carga todas las columnas de portafolio de la hoja weights en una pasada")
+        parser.add_argument("--workers", type=int, default=0,
+                            help="Procesos para materializar valorizaciones con --all-portfolios (0 = cores)")
+        parser.add_argument("--stream", action="store_true",
+                            help="Carga precios por bloques (openpyxl read-only + COPY en PostgreSQL)")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="Filas de la hoja por bloque en --stream")
+        parser.add_argument("--incremental", action="store_true",
+                            help="Sólo inserta fechas nuevas y actualiza precios corregidos (upsert)")
+        parser.add_argument("--only-new", action="store_true",
+                            help="Con --incremental, ignora filas ≤ última fecha guardada por asset")
 
     def handle(self, *args, **opts):
         xlsx_path = opts["xlsx_path"]
         t0 = datetime.strptime(opts["t0"], "%Y-%m-%d").date()
         v0 = Decimal(opts["v0"])
-        portfolio_name = opts["portfolio_name"].strip()
-
-        # Crea/actualiza portafolio
-        portfolio, _ = Portfolio.objects.get_or_create(
-            name=portfolio_name,
-            defaults={"inception_date": t0, "initial_value_usd": v0},
-        )
-        if portfolio.initial_value_usd != v0:
-            portfolio.initial_value_usd = v0
-            portfolio.save(update_fields=["initial_value_usd"])
+        if not opts["all_portfolios"] and not opts["portfolio_name"]:
+            raise CommandError("Indique portfolio_name o use --all-portfolios.")
+
+        if not opts["all_portfolios"]:
+            portfolio_name = opts["portfolio_name"].strip()
+            # Crea/actualiza portafolio
+            portfolio, _ = Portfolio.objects.get_or_create(
+                name=portfolio_name,
+                defaults={"inception_date": t0, "initial_value_usd": v0},
+            )
+            if portfolio.initial_value_usd != v0:
+                portfolio.initial_value_usd = v0
+                portfolio.save(update_fields=["initial_value_usd"])
 
         xls = pd.ExcelFile(xlsx_path)
 
@@ -63,35 +62,34 @@ class Command(BaseCommand):
         prices_sheet  = pick_sheet(xls, "Precios", "precios", "Prices", "prices")
 
         df_w = pd.read_excel(xls, sheet_name=weights_sheet)
-        df_p = pd.read_excel(xls, sheet_name=prices_sheet)
 
-        # === Columna fecha en Precios: 'Dates' (tu archivo) ===
-        date_col = pick_col(df_p, "Dates", "Date", "Fecha", "fecha", "date")
-        df_p[date_col] = pd.to_datetime(df_p[date_col]).dt.date
+        counts = None
+        if opts["incremental"]:
+            assets, counts, changes = self._upsert_prices(xls, xlsx_path, prices_sheet, opts)
+            n_prices = counts["inserted"] + counts["updated"]
+        else:
+            if opts["stream"]:
+                assets, n_prices, first_date = self._stream_prices(xlsx_path, prices_sheet, opts["chunk_size"])
+            else:
+                assets, n_prices, first_date = self._load_prices(xls, prices_sheet)
+            changes = {a.id: first_date for a in assets.values()} if n_prices else {}
 
-        # Todas las demás columnas son activos
-        asset_cols = [c for c in df_p.columns if str(c).strip() != date_col]
-
-        # Asegura assets
-        assets = {}
-        for col in asset_cols:
-            name = str(col).strip()
-            a, _ = Asset.objects.get_or_create(name=name)
-            assets[name] = a
-
-        # Carga precios
-        prices_to_create = []
-        for _, row in df_p.iterrows():
-            dt = row[date_col]
-            for col in asset_cols:
-                name = str(col).strip()
-                price = Decimal(str(row[col]))
-                prices_to_create.append(Price(asset=assets[name], date=dt, price=price))
-        Price.objects.bulk_create(prices_to_create, ignore_conflicts=True)
+        # assets nuevos/renombrados: los demás procesos los ven sin esperar el TTL (con CACHE compartido)
+        transaction.on_commit(get_asset_registry().invalidate)
 
         # === Weights ===
         # En tu archivo: columnas 'activos', 'portafolio 1', 'portafolio 2'
         asset_name_col = pick_col(df_w, "activos", "Activo", "Asset", "Nombre", "name")
+        if opts["all_portfolios"]:
+            n_holdings, names = self._load_all_portfolios(df_w, asset_name_col, assets, t0, v0, opts["workers"],
+                                                          changes)
+            if counts is not None:
+                self._write_counts(counts)
+            self.stdout.write(self.style.SUCCESS(
+                f"Cargados {len(assets)} assets, {n_prices} precios y {n_holdings} holdings "
+                f"para {len(names)} portafolios."
+            ))
+            return
         col_p1 = pick_col(df_w, "portafolio 1", "Portfolio 1", "p1", "1")
         col_p2 = pick_col(df_w, "portafolio 2", "Portfolio 2", "p2", "2")
 
@@ -102,6 +100,7 @@ class Command(BaseCommand):
         elif portfolio_name.endswith("2"):
             target_col = col_p2
         if target_col is None:
+            self._send_prices_changed(changes, [])  # los precios ya quedaron cargados
             raise SystemExit(
                 f"No se detectó la columna de weights para '{portfolio_name}'. "
                 f"Columns en weights: {list(df_w.columns)}"
@@ -121,9 +120,128 @@ class Command(BaseCommand):
             to_create_w.append(InitialWeight(portfolio=portfolio, asset=assets[asset_name], weight=w))
         InitialWeight.objects.bulk_create(to_create_w)
 
-        # Calcula C_{i,0} y guarda Holdings
+        self._send_prices_changed(changes, [portfolio.id])
+        # Calcula C_{i,0}, guarda Holdings y recalcula la materialización desde t0
         created = bootstrap_initial_holdings(portfolio, t0)
 
+        if counts is not None:
+            self._write_counts(counts)
         self.stdout.write(self.style.SUCCESS(
-            f"Cargados {len(assets)} assets, {len(prices_to_create)} precios y {len(created)} holdings para {portfolio_name}."
+            f"Cargados {len(assets)} assets, {n_prices} precios y {len(created)} holdings para {portfolio_name}."
         ))
+
+    def _write_counts(self, counts):
+        self.stdout.write(
+            f"Precios: {counts['inserted']} insertados, {counts['updated']} actualizados, "
+            f"{counts['unchanged']} sin cambios."
+        )
+
+    def _send_prices_changed(self, changes: dict, refreshed):
+        # Snapshot, materialización y caches recalculan desde la primera fecha cambiada de cada asset.
+        # Los portafolios del archivo se recalculan después desde t0: el receiver no los refresca dos veces
+        if changes:
+            prices_changed.send(sender=self.__class__, changes=changes, refreshed=refreshed)
+
+    def _load_all_portfolios(self, df_w: pd.DataFrame, asset_name_col: str, assets: dict, t0, v0, workers: int,
+                             changes: dict):
+        """
+        Cada columna numérica de la hoja weights (salvo activos/fecha) es un portafolio: 'portafolio 1' →
+        'Portafolio 1'. Portafolios, InitialWeight y Holding se escriben en bloque y la
+        materialización se reparte en un pool de procesos.
+        """
+        cols = [c for c in df_w.columns
+                if c != asset_name_col and str(c).strip() not in DATE_COLS and pd.api.types.is_numeric_dtype(df_w[c])]
+        names = {c: str(c).strip()[:1].upper() + str(c).strip()[1:] for c in cols}
+
+        existing = Portfolio.objects.in_bulk(list(names.values()), field_name="name")
+        Portfolio.objects.bulk_create([
+            Portfolio(name=n, inception_date=t0, initial_value_usd=v0)
+            for n in names.values() if n not in existing
+        ])
+        Portfolio.objects.filter(name__in=list(names.values())).exclude(initial_value_usd=v0).update(initial_value_usd=v0)
+        portfolios = Portfolio.objects.in_bulk(list(names.values()), field_name="name")
+
+        asset_names = [str(a).strip() for a in df_w[asset_name_col]]
+        assets.update(ensure_assets(n for n in asset_names if n and n not in assets))
+        InitialWeight.objects.filter(portfolio__in=portfolios.values()).delete()
+        InitialWeight.objects.bulk_create([
+            InitialWeight(portfolio=portfolios[names[c]], asset=assets[a_name], weight=Decimal(str(w)))
+            for c in cols
+            for a_name, w in zip(asset_names, df_w[c])
+            if a_name and not pd.isna(w)
+        ], batch_size=5000)
+
+        holdings = bootstrap_initial_holdings_bulk(list(portfolios.values()), t0, refresh=False)
+        ids = [p.id for p in portfolios.values()]
+        self._send_prices_changed(changes, ids)
+        refresh_daily_valuations_many(ids, min([t0, *changes.values()]), workers=workers or os.cpu_count() or 1)
+        return len(holdings), list(names.values())
+
+    def _load_prices(self, xls: pd.ExcelFile, prices_sheet: str):
+        df_p = pd.read_excel(xls, sheet_name=prices_sheet)
+
+        # === Columna fecha en Precios: 'Dates' (tu archivo) ===
+        date_col = pick_col(df_p, *DATE_COLS)
+        df_p[date_col] = pd.to_datetime(df_p[date_col]).dt.date
+
+        # Todas las demás columnas son activos
+        asset_cols = [c for c in df_p.columns if str(c).strip() != date_col]
+
+        # Asegura assets
+        assets = {}
+        for col in asset_cols:
+            name = str(col).strip()
+            a, _ = Asset.objects.get_or_create(name=name)
+            assets[name] = a
+
+        # Carga precios
+        prices_to_create = []
+        for _, row in df_p.iterrows():
+            dt = row[date_col]
+            for col in asset_cols:
+                if pd.isna(row[col]):  # celda vacía: sin precio ese día
+                    continue
+                name = str(col).strip()
+                price = Decimal(str(row[col]))
+                prices_to_create.append(Price(asset=assets[name], date=dt, price=price))
+        Price.objects.bulk_create(prices_to_create, ignore_conflicts=True)
+        first_date = min((p.date for p in prices_to_create), default=None)
+        return assets, len(prices_to_create), first_date
+
+    def _stream_prices(self, xlsx_path: str, prices_sheet: str, chunk_size: int):
+        """Precios por bloques: memoria acotada por chunk_size y sin loops por celda."""
+        assets, asset_ids, n, first_date = None, None, 0, None
+        for names, long in iter_price_chunks(xlsx_path, prices_sheet, chunk_size):
+            if assets is None:
+                assets = ensure_assets(names)
+                asset_ids = {name: a.id for name, a in assets.items()}
+            n += write_prices(long, asset_ids)
+            if not long.empty:
+                d = long["date"].min()
+                first_date = d if first_date is None else min(first_date, d)
+        return assets or {}, n, first_date
+
+    def _upsert_prices(self, xls: pd.ExcelFile, xlsx_path: str, prices_sheet: str, opts):
+        """Carga incremental: fechas nuevas por asset + precios corregidos."""
+        if opts["stream"]:
+            chunks = iter_price_chunks(xlsx_path, prices_sheet, opts["chunk_size"])
+        else:
+            df_p = pd.read_excel(xls, sheet_name=prices_sheet)
+            df_p.columns = [str(c).strip() for c in df_p.columns]
+            date_col = pick_col(df_p, *DATE_COLS)
+            chunks = [([c for c in df_p.columns if c != date_col], melt_prices(df_p, date_col))]
+
+        assets, asset_ids, max_dates = {}, {}, {}
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        changes = {}
+        for names, long in chunks:
+            if not assets:
+                assets = ensure_assets(names)
+                asset_ids = {name: a.id for name, a in assets.items()}
+                max_dates = get_max_price_dates(asset_ids.values())
+            chunk_counts, chunk_changes = upsert_prices(long, asset_ids, max_dates, only_new=opts["only_new"])
+            for k, v in chunk_counts.items():
+                counts[k] += v
+            for a_id, d in chunk_changes.items():
+                changes[a_id] = min(changes.get(a_id, d), d)
+        return assets, counts, changes
@@ -0,0 +1,95 @@
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+from portfolios.etl import find_col
+from portfolios.models import Asset, Portfolio
+from portfolios.services import BulkTradeError, enqueue_trades_bulk, post_trades_bulk
+
+
+class Command(BaseCommand):
+    help = "Carga un blotter CSV/XLSX (portfolio, asset, date, amount_usd) con post_trades_bulk."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", type=str)
+        parser.add_argument("--sheet", type=str, default=None, help="Hoja del XLSX (por defecto la primera)")
+        parser.add_argument("--skip-invalid", action="store_true",
+                            help="Aplica las filas válidas y reporta las inválidas (por defecto, todo o nada)")
+        parser.add_argument("--background", action="store_true",
+                            help="Encola el blotter como job para `run_worker` en lugar de aplicarlo acá")
+
+    def handle(self, *args, **opts):
+        path = Path(opts["path"])
+        if path.suffix.lower() in (".xlsx", ".xls"):
+            df = pd.read_excel(path, sheet_name=opts["sheet"] or 0)
+        else:
+            df = pd.read_csv(path)
+        df.columns = [str(c).strip() for c in df.columns]
+
+        col_p = self._col(df, "portfolio", "portafolio", "Portfolio", "Portafolio")
+        col_a = self._col(df, "asset", "activo", "Asset", "Activo")
+        col_d = self._col(df, "date", "fecha", "trade_date", "Date", "Fecha")
+        col_x = self._col(df, "amount_usd", "amount", "monto", "monto_usd")
+
+        # Resolución por nombre (o id numérico) en 2 queries
+        p_keys = df[col_p].astype(str).str.strip()
+        a_keys = df[col_a].astype(str).str.strip()
+        portfolios = {}
+        for p_id, name in Portfolio.objects.values_list("id", "name"):
+            portfolios[name] = p_id
+            portfolios[str(p_id)] = p_id
+        assets = dict(Asset.objects.filter(name__in=set(a_keys)).values_list("name", "id"))
+        dates = pd.to_datetime(df[col_d], errors="coerce").dt.date
+
+        trades, line_of, errors = [], [], []
+        for i, (p_key, a_key, d, amount) in enumerate(zip(p_keys, a_keys, dates, df[col_x])):
+            line = i + 2  # 1-based + header
+            try:
+                amount = Decimal(str(amount))
+            except InvalidOperation:
+                amount = None
+            if p_key not in portfolios:
+                errors.append((line, f"Portafolio desconocido: {p_key}"))
+            elif a_key not in assets:
+                errors.append((line, f"Asset desconocido: {a_key}"))
+            elif pd.isna(d):
+                errors.append((line, "Fecha inválida"))
+            elif amount is None or not amount.is_finite():
+                errors.append((line, "amount_usd inválido"))
+            else:
+                trades.append((portfolios[p_key], assets[a_key], d, amount))
+                line_of.append(line)
+
+        if errors and not opts["skip_invalid"]:
+            self._report(errors)
+            raise CommandError(f"{len(errors)} filas inválidas; no se aplicó ningún trade.")
+
+        if opts["background"]:
+            self._report(errors)
+            job = enqueue_trades_bulk(trades, skip_invalid=opts["skip_invalid"])
+            self.stdout.write(self.style.SUCCESS(f"Encolados {len(trades)} trades como job #{job.id}."))
+            return
+
+        try:
+            result = post_trades_bulk(trades, skip_invalid=opts["skip_invalid"])
+        except BulkTradeError as exc:
+            self._report([(line_of[idx], msg) for idx, msg in exc.errors])
+            raise CommandError(f"{len(exc.errors)} trades inválidos; no se aplicó ningún trade.")
+
+        errors += [(line_of[idx], msg) for idx, msg in result["errors"]]
+        self._report(sorted(errors))
+        self.stdout.write(self.style.SUCCESS(
+            f"Aplicados {result['created']} trades; {len(errors)} filas con error."
+        ))
+
+    def _col(self, df, *cands):
+        # sin fallback a la primera columna: un blotter sin monto no debe postear trades
+        col = find_col(df, *cands)
+        if col is None:
+            raise CommandError(f"Falta la columna {cands[0]} (acepta {', '.join(cands)}). Columnas: {list(df.columns)}")
+        return col
+
+    def _report(self, errors):
+        for line, msg in errors:
+            self.stderr.write(f"fila {line}: {msg}")
@@ -0,0 +1,28 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from portfolios.partitions import ensure_price_partitions, is_partitioned, price_partitions
+
+
+class Command(BaseCommand):
+    help = ("Crea las particiones anuales de Price que falten hasta --years-ahead años adelante "
+            "(PostgreSQL; correr periódicamente, p. ej. desde cron).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--years-ahead", type=int, default=2, help="Años después del actual a cubrir")
+        parser.add_argument("--from-year", type=int, default=None,
+                            help="Primer año a cubrir (por defecto el actual); útil antes de cargar historia antigua")
+        parser.add_argument("--list", action="store_true", help="Sólo lista las particiones y sus filas estimadas")
+
+    def handle(self, *args, **opts):
+        if not is_partitioned():
+            raise CommandError("Price no está particionada (sólo PostgreSQL, después de la migración 0006).")
+        if not opts["list"]:
+            this_year = date.today().year
+            first = opts["from_year"] or this_year
+            created = ensure_price_partitions(date(first, 1, 1), date(this_year + opts["years_ahead"], 12, 31))
+            self.stdout.write(self.style.SUCCESS(
+                f"Particiones creadas: {', '.join(created)}" if created else "No faltaban particiones."
+            ))
+        for name, rows in price_partitions().items():
+            self.stdout.write(f"{name:<32} ~{rows} filas")
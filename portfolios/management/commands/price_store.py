@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from portfolios.pricestore import get_price_store
+
+
+class Command(BaseCommand):
+    help = "Reconstruye el snapshot de precios mapeado en memoria (settings.PORTFOLIOS_PRICE_STORE)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--invalidate", action="store_true",
+                            help="Deja de servir el snapshot (los selectors vuelven a leer Price)")
+
+    def handle(self, *args, **opts):
+        store = get_price_store()
+        if store is None:
+            raise CommandError("El snapshot de precios está deshabilitado (PRICE_STORE=1 para habilitarlo).")
+        if opts["invalidate"]:
+            store.invalidate()
+            self.stdout.write(self.style.SUCCESS("Snapshot invalidado."))
+            return
+        snap = store.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f"Snapshot {snap.name}: {len(snap.dates)} fechas × {len(snap.asset_ids)} assets en {store.location}."
+        ))
@@ -0,0 +1,25 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from portfolios.models import Portfolio
+from portfolios.services import refresh_daily_valuations
+
+
+class Command(BaseCommand):
+    help = "Recalcula la tabla materializada PortfolioDailyValuation (V_t, x_{i,t}, w_{i,t})."
+
+    def add_arguments(self, parser):
+        parser.add_argument("portfolio_ids", nargs="*", type=int, help="Vacío = todos los portafolios")
+        parser.add_argument("--from", dest="from_date", type=str, default=None,
+                            help="YYYY-MM-DD; por defecto recalcula toda la historia")
+
+    def handle(self, *args, **opts):
+        from_date = None
+        if opts["from_date"]:
+            from_date = datetime.strptime(opts["from_date"], "%Y-%m-%d").date()
+
+        qs = Portfolio.objects.all()
+        if opts["portfolio_ids"]:
+            qs = qs.filter(id__in=opts["portfolio_ids"])
+        for portfolio in qs:
+            n = refresh_daily_valuations(portfolio, from_date)
+            self.stdout.write(self.style.SUCCESS(f"{portfolio.name}: {n} días materializados."))
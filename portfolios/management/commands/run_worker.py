@@ -0,0 +1,47 @@
+import os
+import signal
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from portfolios.jobs import claim_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = ("Procesa la cola de jobs (refresh de valorizaciones, warmup de cache, trades en bloque). "
+            "Se pueden correr varios en paralelo: cada job lo toma un solo worker (SKIP LOCKED).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=1, help="Jobs que toma por vuelta")
+        parser.add_argument("--sleep", type=float, default=1.0, help="Espera (s) cuando la cola está vacía")
+        parser.add_argument("--stale-after", type=float, default=600,
+                            help="Segundos tras los que un job 'running' se considera abandonado")
+        parser.add_argument("--once", action="store_true", help="Procesa lo pendiente y termina")
+
+    def handle(self, *args, **opts):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self.stdout.write(f"Worker {worker_id} iniciado")
+
+        done = failed = 0
+        while not self.stopping:
+            close_old_connections()  # respeta CONN_MAX_AGE / health checks entre vueltas
+            jobs = claim_jobs(worker_id, opts["batch"], opts["stale_after"])
+            if not jobs:
+                if opts["once"]:
+                    break
+                time.sleep(opts["sleep"])
+                continue
+            for job in jobs:
+                ok = run_job(job)
+                done += ok
+                failed += not ok
+                self.stdout.write(f"{job} {'ok' if ok else 'error'}")
+        self.stdout.write(self.style.SUCCESS(f"Worker {worker_id}: {done} jobs ok, {failed} con error."))
+
+    def _stop(self, signum, frame):
+        # termina el job en curso y sale
+        self.stopping = True
@@ -1,13 +1,231 @@
 # portfolios/middleware.py
+import logging
+import re
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+try:
+    import brotli
+except ImportError:  # opcional: sin el paquete, sólo queda gzip (GZipMiddleware)
+    brotli = None
+
+_accepts_br = re.compile(r"\bbr\b")
+
+logger = logging.getLogger("portfolios.queries")
 
-class EasterEggHeaderMiddleware:
+
+# MiddlewareMixin: sirven sync y async, así bajo ASGI las vistas async no caen a un thread.
+
+class EasterEggHeaderMiddleware(MiddlewareMixin):
     """Agrega un header mínimo para nuestro huevo de pascua."""
-    def __init__(self, get_response):
-        self.get_response = get_response
-    def __call__(self, request):
-        response = self.get_response(request)
+    def process_response(self, request, response):
         msg = getattr(settings, "EASTER_EGG_MSG", "")
         if msg:
             response["X-Mat-Egg"] = msg
         return response
+
+
+class BrotliMiddleware(MiddlewareMixin):
+    """
+    Comprime respuestas con brotli (Content-Encoding: br) si el cliente lo acepta y el paquete
+    `brotli` está instalado. Va después de GZipMiddleware en MIDDLEWARE, así br gana y gzip
+    queda como fallback.
+    """
+    min_length = 200
+
+    def process_response(self, request, response):
+        if brotli is None or response.streaming or response.has_header("Content-Encoding"):
+            return response
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if len(response.content) < self.min_length:
+            return response
+        if not _accepts_br.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+            return response
+        response.content = brotli.compress(response.content)
+        response["Content-Length"] = str(len(response.content))
+        response["Content-Encoding"] = "br"
+        if response.get("ETag", "").startswith('"'):
+            response["ETag"] = "W/" + response["ETag"]
+        return response
+
+
+# --- Presupuesto de queries por request ---
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0  # segundos
+
+
+# ContextVar y no thread-local: bajo ASGI las queries corren en el thread de sync_to_async,
+# que hereda el contexto de la request
+_query_stats = ContextVar("portfolios_query_stats", default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    stats = _query_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    t0 = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.count += 1
+        stats.duration += time.perf_counter() - t0
+
+
+def install_query_counter(connection):
+    """Se engancha a cada conexión nueva (ver receivers); fuera de una request no mide nada."""
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class QueryBudgetMiddleware:
+    """
+    Cuenta queries y tiempo de DB por request, los expone en Server-Timing y, si se pasa del
+    presupuesto (settings.PORTFOLIOS_QUERY_BUDGET o el atributo `query_budget` de la vista),
+    lo loguea (ACTION=log) o falla la request (ACTION=raise). Sirve sync y async.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = getattr(settings, "PORTFOLIOS_QUERY_BUDGET", {})
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        stats = QueryStats()
+        token = _query_stats.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_stats.reset(token)
+        return self.finish(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = QueryStats()
+        token = _query_stats.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_stats.reset(token)
+        return self.finish(request, response, stats)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, "view_class", view_func)
+        request.query_budget = {**self.config, **getattr(view, "query_budget", {})}
+
+    def finish(self, request, response, stats):
+        ms = stats.duration * 1000
+        response["Server-Timing"] = f'db;dur={ms:.1f};desc="{stats.count} queries"'
+        budget = getattr(request, "query_budget", self.config)
+        max_queries, max_ms = budget.get("MAX_QUERIES"), budget.get("MAX_DB_MS")
+        if (max_queries and stats.count > max_queries) or (max_ms and ms > max_ms):
+            msg = (f"{request.method} {request.path}: {stats.count} queries / {ms:.1f} ms de DB "
+                   f"(presupuesto: {max_queries} queries / {max_ms} ms)")
+            if budget.get("ACTION") == "raise":
+                raise QueryBudgetExceeded(msg)
+            logger.warning(msg)
+        return response
+
+
+# --- Profiler por request (staff) ---
+
+class ProfilerMiddleware:
+    """
+    Perfil de una request bajo demanda: header `X-Profile: 1|pyinstrument` o `?profile=1|pyinstrument`.
+    Sólo para usuarios staff y si PORTFOLIOS_INSTRUMENTATION["PROFILING"] está activo; en lugar de la
+    respuesta devuelve el reporte (cProfile: texto pstats por tiempo acumulado; pyinstrument: HTML,
+    si el paquete está instalado). Va después de AuthenticationMiddleware.
+    Bajo ASGI cProfile sólo ve el thread del event loop (no las queries en sync_to_async).
+    """
+    sync_capable = True
+    async_capable = True
+    top = 60
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        mode = self.requested_mode(request)
+        if not mode or not request.user.is_staff:
+            return self.get_response(request)
+        profiler = self.start(mode)
+        try:
+            self.get_response(request)
+        finally:
+            profiler.stop()
+        return self.report(profiler)
+
+    async def __acall__(self, request):
+        mode = self.requested_mode(request)
+        if not mode or not (await request.auser()).is_staff:
+            return await self.get_response(request)
+        profiler = self.start(mode)
+        try:
+            await self.get_response(request)
+        finally:
+            profiler.stop()
+        return self.report(profiler)
+
+    @staticmethod
+    def requested_mode(request):
+        if not getattr(settings, "PORTFOLIOS_INSTRUMENTATION", {}).get("PROFILING", False):
+            return None
+        mode = request.headers.get("X-Profile") or request.GET.get("profile")
+        if mode == "pyinstrument":
+            try:
+                import pyinstrument  # noqa: F401
+            except ImportError:
+                mode = "1"
+        return mode if mode in ("1", "pyinstrument") else None
+
+    def start(self, mode):
+        if mode == "pyinstrument":
+            from pyinstrument import Profiler
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+            return profiler
+        return _CProfile()
+
+    def report(self, profiler):
+        if isinstance(profiler, _CProfile):
+            return HttpResponse(profiler.text(self.top), content_type="text/plain; charset=utf-8")
+        return HttpResponse(profiler.output_html(), content_type="text/html; charset=utf-8")
+
+
+class _CProfile:
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def text(self, top: int) -> str:
+        import io
+        import pstats
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(top)
+        return out.getvalue()
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolios', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioDailyValuation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('date', models.DateField()),
+                ('value', models.DecimalField(decimal_places=6, max_digits=30)),
+                ('exposures', models.JSONField(default=dict)),
+                ('weights', models.JSONField(default=dict)),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_valuations', to='portfolios.portfolio')),
+            ],
+            options={
+                'unique_together': {('portfolio', 'date')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolios', '0002_portfoliodailyvaluation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolio',
+            name='data_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
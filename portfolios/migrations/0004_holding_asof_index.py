@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-18 18:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolios', '0003_portfolio_data_version'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='holding',
+            name='portfolios__portfol_dc8d47_idx',
+        ),
+        migrations.AddIndex(
+            model_name='holding',
+            index=models.Index(fields=['portfolio', 'asset', '-effective_from'], name='holding_asof_idx'),
+        ),
+    ]
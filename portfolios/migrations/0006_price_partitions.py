@@ -0,0 +1,97 @@
+"""
+Price particionada por año en PostgreSQL.
+
+- El índice (asset, date) era redundante con el UNIQUE (asset, date): se elimina en todos los motores.
+- PostgreSQL: la tabla se recrea como PARTITION BY RANGE (date) con una partición por año con
+  datos (hasta el año siguiente al actual) y una DEFAULT; el UNIQUE pasa a ser
+  (asset_id, date) INCLUDE (price) para que las lecturas de precios sean index-only scans.
+  La PK es (id, date) porque en una tabla particionada toda llave única incluye la columna de
+  partición; id sigue saliendo de una secuencia y es único en la práctica.
+"""
+from datetime import date
+
+from django.db import migrations
+
+TABLE = "portfolios_price"
+OLD = "portfolios_price_unpartitioned"
+COLUMNS = "id, created_at, updated_at, date, price, asset_id"
+UNIQUE = "portfolios_price_asset_date_uniq"
+DATE_INDEX = "portfolios__date_324b1a_idx"  # el Index(fields=["date"]) del modelo
+
+
+def partition_prices(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    run = schema_editor.execute
+    run(f"ALTER TABLE {TABLE} RENAME TO {OLD}")
+    run(f"ALTER TABLE {OLD} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+    run(f"CREATE SEQUENCE {TABLE}_id_seq AS bigint")
+    run(f"""
+        CREATE TABLE {TABLE} (
+            id bigint NOT NULL DEFAULT nextval('{TABLE}_id_seq'),
+            created_at timestamp with time zone NOT NULL,
+            updated_at timestamp with time zone NOT NULL,
+            date date NOT NULL,
+            price numeric(20, 8) NOT NULL,
+            asset_id bigint NOT NULL REFERENCES portfolios_asset (id) DEFERRABLE INITIALLY DEFERRED
+        ) PARTITION BY RANGE (date)
+    """)
+    run(f"ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id")
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"SELECT min(date) FROM {OLD}")
+        first = cursor.fetchone()[0]
+    this_year = date.today().year
+    for year in range(min(first.year if first else this_year, this_year), this_year + 2):
+        run(f"CREATE TABLE {TABLE}_y{year} PARTITION OF {TABLE} "
+            f"FOR VALUES FROM ('{date(year, 1, 1)}') TO ('{date(year + 1, 1, 1)}')")
+    run(f"CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT")
+
+    run(f"INSERT INTO {TABLE} ({COLUMNS}) SELECT {COLUMNS} FROM {OLD}")
+    run(f"SELECT setval('{TABLE}_id_seq', COALESCE((SELECT max(id) FROM {TABLE}), 0) + 1, false)")
+    run(f"DROP TABLE {OLD}")  # libera los nombres de PK e índices
+    # índices después de la carga: se construyen de una vez en cada partición
+    run(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id, date)")
+    run(f"ALTER TABLE {TABLE} ADD CONSTRAINT {UNIQUE} UNIQUE (asset_id, date) INCLUDE (price)")
+    run(f"CREATE INDEX {DATE_INDEX} ON {TABLE} (date)")
+    run(f"ANALYZE {TABLE}")
+
+
+def unpartition_prices(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    run = schema_editor.execute
+    partitioned = f"{TABLE}_partitioned"
+    run(f"ALTER TABLE {TABLE} RENAME TO {partitioned}")
+    run(f"""
+        CREATE TABLE {TABLE} (
+            id bigint GENERATED BY DEFAULT AS IDENTITY,
+            created_at timestamp with time zone NOT NULL,
+            updated_at timestamp with time zone NOT NULL,
+            date date NOT NULL,
+            price numeric(20, 8) NOT NULL,
+            asset_id bigint NOT NULL REFERENCES portfolios_asset (id) DEFERRABLE INITIALLY DEFERRED
+        )
+    """)
+    run(f"INSERT INTO {TABLE} ({COLUMNS}) SELECT {COLUMNS} FROM {partitioned}")
+    run(f"SELECT setval(pg_get_serial_sequence('{TABLE}', 'id'), "
+        f"COALESCE((SELECT max(id) FROM {TABLE}), 0) + 1, false)")
+    run(f"DROP TABLE {partitioned}")  # con sus particiones y la secuencia
+    run(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id)")
+    run(f"ALTER TABLE {TABLE} ADD CONSTRAINT {UNIQUE} UNIQUE (asset_id, date)")
+    run(f"CREATE INDEX {DATE_INDEX} ON {TABLE} (date)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolios', '0005_job_queue'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='price',
+            name='portfolios__asset_i_2b7aca_idx',
+        ),
+        migrations.RunPython(partition_prices, unpartition_prices),
+    ]
@@ -25,6 +25,11 @@ class Portfolio(TimeStampedModel):
     initial_value_usd = models.DecimalField(
         max_digits=20, decimal_places=2, validators=[MinValueValidator(0)]
     )
+    # sube con cada cambio de holdings/trades/precios; forma parte de las llaves de cache
+    data_version = models.PositiveIntegerField(default=0)
+    # con el refresh en background: PortfolioDailyValuation no es confiable desde esta fecha
+    # hasta que el worker termine (los endpoints calculan en línea mientras tanto)
+    valuations_dirty_from = models.DateField(null=True, blank=True)
 
     def __str__(self) -> str:
         return self.name
@@ -36,11 +41,10 @@ class Price(TimeStampedModel):
     price = models.DecimalField(max_digits=20, decimal_places=8, validators=[MinValueValidator(0)])
 
     class Meta:
+        # PostgreSQL: tabla particionada por año y UNIQUE (asset_id, date) INCLUDE (price)
+        # (migración 0006, ver partitions.py); el UNIQUE ya es el índice de (asset, date)
         unique_together = ("asset", "date")
-        indexes = [
-            models.Index(fields=["asset", "date"]),
-            models.Index(fields=["date"]),
-        ]
+        indexes = [models.Index(fields=["date"])]
 
 
 class InitialWeight(TimeStampedModel):
@@ -61,7 +65,8 @@ class Holding(TimeStampedModel):
     effective_from = models.DateField()
 
     class Meta:
-        indexes = [models.Index(fields=["portfolio", "asset"])]
+        # as-of lookups: "último tramo ≤ d por asset" es un index scan (DISTINCT ON / LIMIT 1)
+        indexes = [models.Index(fields=["portfolio", "asset", "-effective_from"], name="holding_asof_idx")]
 
 
 class Trade(TimeStampedModel):
@@ -73,3 +78,44 @@ class Trade(TimeStampedModel):
 
     class Meta:
         indexes = [models.Index(fields=["portfolio", "trade_date"])]
+
+
+class PortfolioDailyValuation(TimeStampedModel):
+    """V_t, x_{i,t} y w_{i,t} materializados por día (se recalculan desde la fecha afectada)."""
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, related_name="daily_valuations")
+    date = models.DateField()
+    value = models.DecimalField(max_digits=30, decimal_places=6)
+    exposures = models.JSONField(default=dict)  # {asset_id: x_{i,t}}
+    weights = models.JSONField(default=dict)    # {asset_id: w_{i,t}}
+
+    class Meta:
+        # el índice único (portfolio, date) es el que usa el range scan del endpoint
+        unique_together = ("portfolio", "date")
+
+
+class Job(TimeStampedModel):
+    """Cola de trabajos en la DB (ver portfolios.jobs y `manage.py run_worker`)."""
+    QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+    STATUS_CHOICES = [(s, s) for s in (QUEUED, RUNNING, DONE, FAILED)]
+
+    kind = models.CharField(max_length=32)
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, null=True, blank=True, related_name="jobs")
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=QUEUED)
+    # jobs con la misma llave se fusionan mientras están en cola (p.ej. refresh del mismo portafolio)
+    dedupe_key = models.CharField(max_length=64, null=True, blank=True)
+    run_after = models.DateTimeField()
+    attempts = models.PositiveIntegerField(default=0)
+    locked_by = models.CharField(max_length=64, blank=True, default="")
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"], name="job_claim_idx")]
+        constraints = [
+            models.UniqueConstraint(fields=["dedupe_key"], condition=models.Q(status="queued"),
+                                    name="job_queued_dedupe_uniq"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.kind}#{self.id} ({self.status})"
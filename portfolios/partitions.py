@@ -0,0 +1,77 @@
+# portfolios/partitions.py
+"""
+Particiones anuales de Price en PostgreSQL (ver migración 0006 y `manage.py price_partitions`).
+
+portfolios_price es una tabla particionada por rango de date: una partición por año
+(portfolios_price_y2024 = [2024-01-01, 2025-01-01)) y una DEFAULT para fechas sin partición.
+Cada partición tiene un solo índice de (asset_id, date): el UNIQUE ... INCLUDE (price), que
+sirve al upsert del ETL y deja las lecturas de precios como index-only scans, más el de date.
+En otros motores la tabla es normal y estas funciones no hacen nada.
+"""
+from datetime import date
+
+from django.db import connection, transaction
+
+from .models import Price
+
+TABLE = Price._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+
+def partition_name(year: int) -> str:
+    return f"{TABLE}_y{year}"
+
+
+def is_partitioned() -> bool:
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass)", [TABLE])
+        return cursor.fetchone()[0]
+
+
+def price_partitions() -> dict:
+    """{nombre: filas estimadas (pg_class.reltuples)} de las particiones de Price."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname, c.reltuples FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass ORDER BY c.relname", [TABLE])
+        return {name: max(int(rows), 0) for name, rows in cursor.fetchall()}
+
+
+def ensure_price_partitions(first: date, last: date) -> list:
+    """
+    Crea las particiones anuales que falten entre first y last (inclusive) y devuelve sus nombres.
+    Filas que ya hubieran caído en la DEFAULT para esos años se mueven a su partición (la DEFAULT
+    se desacopla mientras tanto: PostgreSQL no deja crear una partición que la contradiga).
+    Cargas en paralelo se serializan con un advisory lock y vuelven a leer las particiones con él.
+    """
+    if not is_partitioned():
+        return []
+    years = range(first.year, last.year + 1)
+    existing = price_partitions()
+    if all(partition_name(y) in existing for y in years):
+        return []
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [TABLE])
+        existing = price_partitions()  # otra carga pudo crearlas mientras esperábamos el lock
+        missing = [y for y in years if partition_name(y) not in existing]
+        if not missing:
+            return []
+        lo, hi = date(missing[0], 1, 1), date(missing[-1] + 1, 1, 1)
+        moving = False
+        if DEFAULT_PARTITION in existing:
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE date >= %s AND date < %s)",
+                           [lo, hi])
+            moving = cursor.fetchone()[0]
+        if moving:
+            cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT_PARTITION}")
+        for year in missing:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {partition_name(year)} PARTITION OF {TABLE} "
+                           f"FOR VALUES FROM ('{date(year, 1, 1)}') TO ('{date(year + 1, 1, 1)}')")
+        if moving:
+            cursor.execute(
+                f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE date >= %s AND date < %s RETURNING *) "
+                f"INSERT INTO {TABLE} SELECT * FROM moved", [lo, hi])
+            cursor.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+    return [partition_name(y) for y in missing]
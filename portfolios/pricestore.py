@@ -0,0 +1,172 @@
+# portfolios/pricestore.py
+"""
+Snapshot de precios en disco para el motor vectorizado.
+
+Matriz densa fechas × assets float64 (NaN = sin precio) en archivos .npy que cada proceso
+mapea en sólo lectura (np.load(mmap_mode="r")): todos los workers comparten una copia de la
+historia en el page cache del SO y las valorizaciones no leen Price en cada request.
+
+Layout en LOCATION:
+  snap-<id>/prices.npy   float64 (fechas × assets)
+  snap-<id>/dates.npy    int32, ordinales de fecha ordenados
+  snap-<id>/assets.npy   int64, asset_id de cada columna
+  CURRENT                nombre del snapshot vigente (se reemplaza atómicamente)
+
+Se mantiene al día con prices_changed (ver receivers): cargas con sólo fechas nuevas se agregan
+al final, el resto reconstruye. Los cambios a Price fuera del ETL (admin, shell) invalidan el
+snapshot y los selectors vuelven a leer de la DB hasta el próximo `manage.py price_store`.
+"""
+import os
+import shutil
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from .arrays import PriceArrays
+from .instrumentation import incr, span
+from .models import Price
+
+
+def store_config() -> dict:
+    return {"ENABLED": False, "LOCATION": "", **getattr(settings, "PORTFOLIOS_PRICE_STORE", {})}
+
+
+class Snapshot:
+    """Un snapshot mapeado: la matriz y sus índices de fecha y asset."""
+    def __init__(self, path: str):
+        self.name = os.path.basename(path)
+        try:
+            self.prices = np.load(os.path.join(path, "prices.npy"), mmap_mode="r")
+        except ValueError:  # matriz vacía: no se puede mapear un archivo sin datos
+            self.prices = np.load(os.path.join(path, "prices.npy"))
+        self.dates = np.load(os.path.join(path, "dates.npy"))
+        self.asset_ids = np.load(os.path.join(path, "assets.npy"))
+        # mismos labels que PriceArrays.to_frame(): fechas como date, columnas asset_id
+        self.date_index = pd.Index([date.fromordinal(int(o)) for o in self.dates], dtype=object)
+        self.columns = pd.Index(self.asset_ids)
+
+    def frame(self, start: date, end: date) -> pd.DataFrame:
+        """Filas [start, end] como DataFrame sobre el mmap (vista, sin copia)."""
+        i0 = np.searchsorted(self.dates, start.toordinal(), side="left")
+        i1 = np.searchsorted(self.dates, end.toordinal(), side="right")
+        return pd.DataFrame(self.prices[i0:i1], index=self.date_index[i0:i1], columns=self.columns, copy=False)
+
+
+class PriceStore:
+    def __init__(self, location: str):
+        self.location = location
+        self._snapshot = None
+        self._stamp = None
+
+    @property
+    def _current_path(self):
+        return os.path.join(self.location, "CURRENT")
+
+    def snapshot(self) -> Snapshot | None:
+        """Snapshot vigente; vuelve a mapear si otro proceso publicó uno nuevo (un stat por llamada)."""
+        try:
+            st = os.stat(self._current_path)
+        except FileNotFoundError:
+            self._snapshot = self._stamp = None
+            return None
+        stamp = (st.st_mtime_ns, st.st_ino)
+        if stamp != self._stamp:
+            with open(self._current_path) as fh:
+                name = fh.read().strip()
+            try:
+                self._snapshot = Snapshot(os.path.join(self.location, name))
+            except FileNotFoundError:  # CURRENT apunta a un snapshot ya limpiado: carrera con un writer
+                return None
+            self._stamp = stamp
+        return self._snapshot
+
+    def frame(self, start: date, end: date) -> pd.DataFrame | None:
+        snap = self.snapshot()
+        return None if snap is None else snap.frame(start, end)
+
+    # --- escritura ---
+
+    def rebuild(self) -> Snapshot:
+        """Reconstruye desde Price (1 query de ejes + 1 pasada sobre las filas)."""
+        with span("price_store.rebuild"):
+            asset_ids = np.array(sorted(Price.objects.values_list("asset_id", flat=True).distinct()), dtype=np.int64)
+            dates = np.array(sorted({d.toordinal() for d in Price.objects.values_list("date", flat=True).distinct()}),
+                             dtype=np.int32)
+            prices = self._fill(np.full((len(dates), len(asset_ids)), np.nan), dates, asset_ids,
+                                Price.objects.all())
+            return self._publish(prices, dates, asset_ids)
+
+    def apply_changes(self, changes: dict) -> Snapshot:
+        """
+        changes = {asset_id: primera fecha cambiada} (payload de prices_changed). Si todas las
+        fechas son posteriores al snapshot y no hay assets nuevos, lee sólo las filas nuevas y las
+        agrega al final; si no, reconstruye.
+        """
+        snap = self.snapshot()
+        if (snap is None or not len(snap.dates)
+                or any(d.toordinal() <= snap.dates[-1] for d in changes.values())
+                or not set(changes) <= set(snap.asset_ids.tolist())):
+            return self.rebuild()
+        with span("price_store.append"):
+            last = date.fromordinal(int(snap.dates[-1]))
+            rows = Price.objects.filter(date__gt=last)
+            new_dates = np.array(sorted({d.toordinal() for d in rows.values_list("date", flat=True).distinct()}),
+                                 dtype=np.int32)
+            block = self._fill(np.full((len(new_dates), len(snap.asset_ids)), np.nan), new_dates, snap.asset_ids, rows)
+            return self._publish(np.vstack([snap.prices, block]), np.concatenate([snap.dates, new_dates]),
+                                 snap.asset_ids)
+
+    def invalidate(self):
+        """Deja de servir el snapshot (los selectors vuelven a la DB)."""
+        try:
+            os.remove(self._current_path)
+        except FileNotFoundError:
+            pass
+        self._snapshot = self._stamp = None
+
+    @staticmethod
+    def _fill(out, dates, asset_ids, qs):
+        n = PriceArrays.from_queryset(qs).scatter(out, dates, asset_ids)
+        incr("price_store_rows_loaded", n)
+        return out
+
+    def _publish(self, prices, dates, asset_ids) -> Snapshot:
+        """Escribe un snapshot nuevo y lo publica reemplazando CURRENT (los lectores nunca ven uno a medias)."""
+        os.makedirs(self.location, exist_ok=True)
+        name = f"snap-{time.time_ns()}-{os.getpid()}"
+        path = os.path.join(self.location, name)
+        os.makedirs(path)
+        np.save(os.path.join(path, "prices.npy"), np.ascontiguousarray(prices, dtype=np.float64))
+        np.save(os.path.join(path, "dates.npy"), dates.astype(np.int32))
+        np.save(os.path.join(path, "assets.npy"), asset_ids.astype(np.int64))
+        tmp = f"{self._current_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fh:
+            fh.write(name)
+        previous = self.snapshot()
+        os.replace(tmp, self._current_path)
+        self._cleanup(keep={name, previous.name if previous else None})
+        return self.snapshot()
+
+    def _cleanup(self, keep):
+        # el anterior se conserva para lectores que aún no vieron CURRENT; en POSIX borrar un
+        # archivo mapeado no afecta a quien ya lo tiene abierto
+        for entry in os.scandir(self.location):
+            if entry.is_dir() and entry.name.startswith("snap-") and entry.name not in keep:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+_price_store = None
+
+def get_price_store() -> PriceStore | None:
+    """Instancia por proceso desde settings.PORTFOLIOS_PRICE_STORE, o None si está deshabilitado."""
+    global _price_store
+    config = store_config()
+    if not config["ENABLED"]:
+        return None
+    location = config["LOCATION"] or os.path.join(settings.BASE_DIR, "var", "price-store")
+    if _price_store is None or _price_store.location != location:
+        _price_store = PriceStore(location)
+    return _price_store
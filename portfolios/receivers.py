@@ -0,0 +1,46 @@
+# portfolios/receivers.py
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .assets import get_asset_registry
+from .middleware import install_query_counter
+from .models import Asset, Price
+from .pricestore import get_price_store
+from .services import refresh_daily_valuations_for_price_changes
+from .signals import prices_changed
+
+
+# el snapshot se actualiza antes que las valorizaciones: el refresh ya lee los precios nuevos de ahí
+@receiver(prices_changed)
+def update_price_store_on_price_changes(sender, changes, **kwargs):
+    store = get_price_store()
+    if store is not None and changes:
+        store.apply_changes(changes)
+
+
+@receiver(prices_changed)
+def refresh_valuations_on_price_changes(sender, changes, refreshed=(), **kwargs):
+    refresh_daily_valuations_for_price_changes(changes, exclude=refreshed)
+
+
+@receiver([post_save, post_delete], sender=Price)
+def invalidate_price_store_on_price_edit(sender, **kwargs):
+    # ediciones sueltas (admin, shell): se vuelve a la DB hasta el próximo `manage.py price_store`
+    store = get_price_store()
+    if store is not None:
+        store.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Asset)
+def invalidate_asset_registry_on_asset_change(sender, **kwargs):
+    registry = get_asset_registry()
+    registry.invalidate()  # este thread ve el cambio dentro de su transacción
+    # y otra vez al confirmar: lo que otro thread/proceso recargó antes del commit trae los nombres viejos
+    transaction.on_commit(registry.invalidate)
+
+
+@receiver(connection_created)
+def count_queries_on_new_connections(sender, connection, **kwargs):
+    install_query_counter(connection)
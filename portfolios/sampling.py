@@ -0,0 +1,94 @@
+# portfolios/sampling.py
+"""
+Muestreo de la serie de valorizaciones para rangos largos (parámetros freq y max_points de /metrics).
+
+Opera sobre las fechas de valorización y V_t antes de serializar: primero la frecuencia (último
+día con valorización de cada semana o mes) y, si aún quedan más de max_points fechas, LTTB
+(Largest-Triangle-Three-Buckets) sobre V_t, que conserva la forma visual de la curva. Los
+weights de las fechas elegidas se entregan completos.
+"""
+import numpy as np
+from django.conf import settings
+
+FREQS = ("daily", "weekly", "monthly")
+
+
+def period_last_indices(dates, freq: str) -> np.ndarray:
+    """Índice de la última fecha de cada semana ISO / mes calendario (fechas ordenadas)."""
+    n = len(dates)
+    if freq == "daily" or n == 0:
+        return np.arange(n)
+    if freq == "weekly":
+        keys = np.fromiter((d.isocalendar()[0] * 100 + d.isocalendar()[1] for d in dates), dtype=np.int64, count=n)
+    elif freq == "monthly":
+        keys = np.fromiter((d.year * 100 + d.month for d in dates), dtype=np.int64, count=n)
+    else:
+        raise ValueError(f"freq debe ser uno de {FREQS}")
+    return np.flatnonzero(np.append(keys[1:] != keys[:-1], True))
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Índices de los n_out puntos elegidos por LTTB (siempre incluye el primero y el último).
+    Un bucket por punto interior; en cada uno gana el que forma el triángulo de mayor área con
+    el punto anterior elegido y el promedio del bucket siguiente.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nhi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[hi:nhi].mean(), y[hi:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+
+def sample_indices(dates, values, freq: str = "daily", max_points: int | None = None) -> np.ndarray:
+    """Posiciones de (dates, values) que sobreviven a freq y después a max_points."""
+    idx = period_last_indices(dates, freq)
+    if max_points and len(idx) > max_points:
+        x = np.fromiter((dates[i].toordinal() for i in idx), dtype=np.float64, count=len(idx))
+        y = np.asarray(values, dtype=np.float64)[idx]
+        idx = idx[lttb_indices(x, y, max_points)]
+    return idx
+
+
+def default_max_points() -> int | None:
+    """Tope de puntos por respuesta (settings.PORTFOLIOS_METRICS_MAX_POINTS; 0 = sin tope)."""
+    return getattr(settings, "PORTFOLIOS_METRICS_MAX_POINTS", 0) or None
+
+
+def is_sampled(freq: str, max_points: int | None, start=None, end=None) -> bool:
+    """
+    Si el muestreo puede descartar fechas. Con el rango conocido, un max_points mayor que los
+    días del rango no descarta nada (hay a lo más una valorización por día).
+    """
+    if freq != "daily":
+        return True
+    if not max_points:
+        return False
+    return start is None or (end - start).days + 1 > max_points
+
+
+def sample_maps(w_map, v_map, freq: str = "daily", max_points: int | None = None):
+    """(w_map, v_map) restringidos a las fechas muestreadas."""
+    if not is_sampled(freq, max_points) or (freq == "daily" and len(v_map) <= max_points):
+        return w_map, v_map
+    dates = sorted(v_map)
+    keep = [dates[i] for i in sample_indices(dates, [float(v_map[d]) for d in dates], freq, max_points)]
+    return {d: w_map[d] for d in keep}, {d: v_map[d] for d in keep}
+
+
+def sample_frame(x, V, freq: str = "daily", max_points: int | None = None):
+    """(x, V) del motor vectorizado restringidos a las fechas muestreadas, antes de armar dicts."""
+    if not is_sampled(freq, max_points) or (freq == "daily" and len(V) <= max_points):
+        return x, V
+    idx = sample_indices(list(V.index), V.to_numpy(dtype=np.float64), freq, max_points)
+    return x.iloc[idx], V.iloc[idx]
@@ -1,36 +1,234 @@
 # portfolios/selectors.py
+from bisect import bisect_right
 from datetime import date
 from decimal import Decimal
-from .models import Price, Holding, Portfolio
+
+import numpy as np
+import pandas as pd
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import F, Min, Q, Window
+from django.db.models.functions import RowNumber
+
+from .arrays import PriceArrays
+from .instrumentation import incr, instrumented, span
+from .models import Price, Holding, Portfolio, PortfolioDailyValuation
+from .pricestore import get_price_store
+from .sampling import is_sampled, sample_frame, sample_indices, sample_maps
 
 def get_portfolio_prices_between(portfolio: Portfolio, start: date, end: date):
     """{date: {asset_id: price}} para los assets presentes en holdings."""
     asset_ids = list(portfolio.holdings.values_list("asset_id", flat=True).distinct())
     qs = (Price.objects
           .filter(asset_id__in=asset_ids, date__gte=start, date__lte=end)
-          .order_by("date", "asset_id"))
+          .order_by("date", "asset_id")
+          .values_list("date", "asset_id", "price"))  # sólo columnas del índice: index-only scan
     out = {}
-    for p in qs.iterator():
-        out.setdefault(p.date, {})[p.asset_id] = p.price
+    for d, a_id, price in qs.iterator():
+        out.setdefault(d, {})[a_id] = price
     return out
 
+def latest_holding_ids(portfolio_ids, at_date: date):
+    """
+    Subquery con el id del último tramo (effective_from ≤ at_date, desempate por id) de cada
+    (portfolio, asset). PostgreSQL: DISTINCT ON sobre el índice (portfolio, asset, -effective_from);
+    resto: ROW_NUMBER().
+    """
+    qs = Holding.objects.filter(portfolio_id__in=list(portfolio_ids), effective_from__lte=at_date)
+    if connection.vendor == "postgresql":
+        return (qs.order_by("portfolio_id", "asset_id", "-effective_from", "-id")
+                  .distinct("portfolio_id", "asset_id")
+                  .values("id"))
+    return (qs.annotate(rn=Window(RowNumber(), partition_by=[F("portfolio_id"), F("asset_id")],
+                                  order_by=[F("effective_from").desc(), F("id").desc()]))
+              .filter(rn=1)
+              .values("id"))
+
 def get_holdings_at(portfolio: Portfolio, at_date: date):
-    """Último lote (efective_from más reciente ≤ at_date) por asset."""
-    latest = {}
-    q = (portfolio.holdings
-         .filter(effective_from__lte=at_date)
-         .order_by("asset_id", "-effective_from"))
-    for h in q:
-        if h.asset_id not in latest:
-            latest[h.asset_id] = h.quantity
-    return latest
-
-def compute_timeseries_weights_and_value(portfolio: Portfolio, start: date, end: date):
-    """Devuelve ({fecha:{asset_id:w}}, {fecha:V_t})."""
-    price_map = get_portfolio_prices_between(portfolio, start, end)
-    result_w, result_V = {}, {}
+    """Último lote (efective_from más reciente ≤ at_date) por asset, en una query sin dedup en Python."""
+    return dict(Holding.objects
+                .filter(id__in=latest_holding_ids([portfolio.id], at_date))
+                .values_list("asset_id", "quantity"))
+
+def get_holding_tranches(portfolio: Portfolio, end: date, start: date | None = None):
+    """
+    [(asset_id, effective_from, quantity)] con effective_from ≤ end, en orden temporal (1 query).
+    Con start, la historia previa se reduce al tramo vigente en start de cada asset: el costo
+    depende de los trades dentro del rango, no de toda la historia del portafolio.
+    """
+    with span("fetch.tranches"):
+        tranches = list(_tranches_qs([portfolio.id], end, start)
+                        .values_list("asset_id", "effective_from", "quantity"))
+    incr("tranche_rows_fetched", len(tranches))
+    return tranches
+
+def get_batch_holding_tranches(portfolio_ids, end: date, start: date | None = None):
+    """{portfolio_id: [(asset_id, effective_from, quantity)]} para varios portafolios (1 query)."""
+    out = {p_id: [] for p_id in portfolio_ids}
+    for p_id, a_id, eff, qty in (_tranches_qs(portfolio_ids, end, start)
+                                 .values_list("portfolio_id", "asset_id", "effective_from", "quantity")):
+        out[p_id].append((a_id, eff, qty))
+    return out
+
+def _tranches_qs(portfolio_ids, end: date, start: date | None):
+    qs = Holding.objects.filter(portfolio_id__in=list(portfolio_ids), effective_from__lte=end)
+    if start is not None:
+        qs = qs.filter(Q(effective_from__gt=start) | Q(id__in=latest_holding_ids(portfolio_ids, start)))
+    return qs.order_by("effective_from", "id")
+
+class HoldingsIndex:
+    """
+    Índice point-in-time en memoria: por asset, fechas (ordinales) ordenadas y cantidades paralelas.
+    quantities_at() resuelve c_{i,t} para muchas fechas en una llamada (bisect vectorizado).
+    """
+    __slots__ = ("_dates", "_qty", "_qty_f")
+
+    def __init__(self, tranches):
+        per_asset = {}
+        for a_id, eff, qty in tranches:  # en orden (effective_from, id)
+            dates, qtys = per_asset.setdefault(a_id, ([], []))
+            dates.append(eff.toordinal())
+            qtys.append(qty)
+        self._dates = {a_id: np.asarray(d, dtype=np.int32) for a_id, (d, _) in per_asset.items()}
+        self._qty = {a_id: q for a_id, (_, q) in per_asset.items()}
+        self._qty_f = {a_id: np.asarray(q, dtype=np.float64) for a_id, q in self._qty.items()}
+
+    @classmethod
+    def for_portfolio(cls, portfolio: Portfolio, end: date, start: date | None = None):
+        return cls(get_holding_tranches(portfolio, end, start))
+
+    @property
+    def asset_ids(self):
+        return sorted(self._dates)
+
+    def quantity_at(self, asset_id, at_date: date):
+        """Cantidad exacta (Decimal) vigente en at_date, o None."""
+        dates = self._dates.get(asset_id)
+        if dates is None:
+            return None
+        pos = bisect_right(dates, at_date.toordinal())
+        return self._qty[asset_id][pos - 1] if pos else None
+
+    def quantities_at(self, dates, asset_ids=None):
+        """Matriz float64 len(dates) × len(asset_ids) de c_{i,t}; NaN donde no hay tramo vigente."""
+        asset_ids = self.asset_ids if asset_ids is None else list(asset_ids)
+        ords = np.fromiter((d.toordinal() for d in dates), dtype=np.int32, count=len(dates))
+        out = np.full((len(ords), len(asset_ids)), np.nan)
+        for j, a_id in enumerate(asset_ids):
+            a_dates = self._dates.get(a_id)
+            if a_dates is None:
+                continue
+            pos = np.searchsorted(a_dates, ords, side="right") - 1
+            valid = pos >= 0
+            out[valid, j] = self._qty_f[a_id][pos[valid]]
+        return out
+
+def get_price_rows_between(asset_ids, start: date, end: date):
+    """[(date, asset_id, price)] ordenado por fecha (1 query)."""
+    with span("fetch.prices"):
+        rows = list(Price.objects
+                    .filter(asset_id__in=asset_ids, date__gte=start, date__lte=end)
+                    .order_by("date", "asset_id")
+                    .values_list("date", "asset_id", "price"))
+    incr("price_rows_fetched", len(rows))
+    return rows
+
+def get_price_arrays_between(asset_ids, start: date, end: date) -> PriceArrays:
+    """Precios del rango como arreglos tipados (1 query, sin Decimal ni tuplas por fila)."""
+    with span("fetch.prices"):
+        arrays = PriceArrays.from_queryset(_prices_qs(asset_ids, start, end))
+    incr("price_rows_fetched", len(arrays))
+    return arrays
+
+def _prices_qs(asset_ids, start: date, end: date):
+    return Price.objects.filter(asset_id__in=asset_ids, date__gte=start, date__lte=end)
+
+def get_price_frame(asset_ids, start: date, end: date) -> pd.DataFrame:
+    """
+    Matriz de precios fechas × asset_id. Con el snapshot mapeado habilitado (ver pricestore) es una
+    vista sobre el mmap sin query ni copia, con todas las columnas (valuate() elige las suyas);
+    si no, 1 query sobre Price leída a arreglos tipados (PriceArrays).
+    """
+    store = get_price_store()
+    if store is not None:
+        with span("fetch.price_store"):
+            px = store.frame(start, end)
+        if px is not None:
+            incr("price_store_hits")
+            return px
+    if not asset_ids:
+        return pd.DataFrame(dtype=float)
+    return get_price_arrays_between(asset_ids, start, end).to_frame()
+
+@instrumented("compute.vectorized")
+def valuate(px: pd.DataFrame, index: "HoldingsIndex"):
+    """(x, V) para un portafolio sobre una matriz de precios (que puede incluir otros assets)."""
+    cols = [a_id for a_id in index.asset_ids if a_id in px.columns]
+    if not cols:
+        return pd.DataFrame(dtype=float), pd.Series(dtype=float)
+    px = px[cols]
+    qty = index.quantities_at(px.index, cols)
+
+    # NaN = sin precio o sin holding vigente ese día → el asset no participa
+    x = px * qty
+    V = x.sum(axis=1, min_count=1)
+    keep = V.notna() & (V != 0)
+    incr("dates_valued", int(keep.sum()))
+    return x[keep], V[keep]
+
+def compute_valuation_frame(portfolio: Portfolio, start: date, end: date):
+    """
+    Motor vectorizado: (x, V) con x = DataFrame fechas × asset_id de x_{i,t} = P_{i,t}·c_{i,t}
+    y V = Series de V_t. Dos queries en total, independiente del largo del rango.
+    Los c_{i,t} se obtienen con un as-of join de los tramos de Holding (HoldingsIndex)
+    sobre las fechas de precio.
+    """
+    index = HoldingsIndex.for_portfolio(portfolio, end, start)
+    return valuate(get_price_frame(index.asset_ids, start, end), index)
+
+def compute_batch_valuation_frames(portfolio_ids, start: date, end: date):
+    """
+    {portfolio_id: (x, V)} para muchos portafolios con 2 queries en total: tramos de todos los
+    portafolios y una sola lectura de precios para la unión de sus assets.
+    """
+    tranches = get_batch_holding_tranches(portfolio_ids, end, start)
+    asset_ids = sorted({a_id for ts in tranches.values() for a_id, _, _ in ts})
+    px = get_price_frame(asset_ids, start, end)
+    return {p_id: valuate(px, HoldingsIndex(ts)) for p_id, ts in tranches.items()}
+
+def get_valuation_inputs(portfolio: Portfolio, start: date, end: date):
+    """
+    (px, qty): precios y c_{i,t} como DataFrames fechas × asset_id alineados, sólo con los assets
+    del portafolio y las fechas con algún precio (insumo de analytics.performance). 2 queries.
+    """
+    index = HoldingsIndex.for_portfolio(portfolio, end, start)
+    px = get_price_frame(index.asset_ids, start, end)
+    cols = [a_id for a_id in index.asset_ids if a_id in px.columns]
+    px = px[cols].dropna(how="all")
+    return px, pd.DataFrame(index.quantities_at(px.index, cols), index=px.index, columns=cols)
+
+def iter_exact_exposures(portfolio: Portfolio, start: date, end: date):
+    """
+    Genera (fecha, {asset_id: x_{i,t}}, V_t) con la misma aritmética Decimal que el cálculo
+    original, pero con un solo fetch de precios y holdings. Omite fechas con V_t = 0.
+    """
+    tranches = get_holding_tranches(portfolio, end, start)
+    asset_ids = sorted({a_id for a_id, _, _ in tranches})
+    rows = get_price_rows_between(asset_ids, start, end) if asset_ids else []
+
+    price_map = {}
+    for d, a_id, p in rows:
+        price_map.setdefault(d, {})[a_id] = p
+
+    c_map, i = {}, 0
     for d, prices in price_map.items():
-        c_map = get_holdings_at(portfolio, d)
+        # avanza el as-of join hasta la fecha d
+        while i < len(tranches) and tranches[i][1] <= d:
+            a_id, _, qty = tranches[i]
+            c_map[a_id] = qty
+            i += 1
         x_sum = Decimal("0")
         x_map = {}
         for a_id, p in prices.items():
@@ -42,6 +240,145 @@ def compute_timeseries_weights_and_value(portfolio: Portfolio, start: date, end:
             x_sum += x
         if x_sum == 0:
             continue
+        yield d, x_map, x_sum
+
+@instrumented("compute.exact")
+def _compute_exact(portfolio: Portfolio, start: date, end: date):
+    result_w, result_V = {}, {}
+    for d, x_map, x_sum in iter_exact_exposures(portfolio, start, end):
         result_V[d] = x_sum
         result_w[d] = {a_id: (x / x_sum) for a_id, x in x_map.items()}
+    incr("dates_valued", len(result_V))
+    return result_w, result_V
+
+NUMERIC_BACKENDS = ("float64", "decimal")
+UNIT_ROUNDOFF = 2.0 ** -53  # float64: |fl(a ∘ b) - a ∘ b| ≤ u·|a ∘ b|
+
+def numeric_backend() -> str:
+    """settings.PORTFOLIOS_NUMERIC_BACKEND: 'float64' (por defecto) o 'decimal'."""
+    backend = getattr(settings, "PORTFOLIOS_NUMERIC_BACKEND", "float64")
+    if backend not in NUMERIC_BACKENDS:
+        raise ImproperlyConfigured(f"PORTFOLIOS_NUMERIC_BACKEND debe ser uno de {NUMERIC_BACKENDS}")
+    return backend
+
+def float64_error_bounds(n_assets: int):
+    """
+    Cotas (a primer orden en u) del error relativo del backend float64 contra el Decimal, con
+    n_assets assets con precio y cantidad > 0 en la fecha:
+      x_{i,t}: conversión de P y c a float + producto → 3u
+      V_t:     suma de n términos positivos → (n + 2)u
+      w_{i,t}: x / V → (n + 6)u
+    Devuelve (cota de V_t, cota de w_{i,t}). Con 100 assets ≈ 1.2e-14: en V_t = 1e9 USD, < 1e-4 USD.
+    El backend Decimal redondea a 28 dígitos significativos (contexto por defecto), muy por debajo.
+    """
+    return (n_assets + 2) * UNIT_ROUNDOFF, (n_assets + 6) * UNIT_ROUNDOFF
+
+def compute_timeseries_weights_and_value(portfolio: Portfolio, start: date, end: date, exact: bool | None = None,
+                                         freq: str = "daily", max_points: int | None = None):
+    """
+    Devuelve ({fecha:{asset_id:w}}, {fecha:V_t}), muestreado según freq/max_points (ver sampling).
+    exact=False usa el motor vectorizado (float64); exact=True conserva la aritmética Decimal;
+    None (por defecto) sigue a settings.PORTFOLIOS_NUMERIC_BACKEND. El motor vectorizado muestrea
+    sobre el frame, así los dicts sólo se arman para las fechas que se entregan.
+    """
+    if exact is None:
+        exact = numeric_backend() == "decimal"
+    if exact:
+        return sample_maps(*_compute_exact(portfolio, start, end), freq, max_points)
+    return frame_to_maps(*sample_frame(*compute_valuation_frame(portfolio, start, end), freq, max_points))
+
+@instrumented("serialize.frame_to_maps")
+def frame_to_maps(x: pd.DataFrame, V: pd.Series):
+    """(x, V) del motor vectorizado → ({fecha:{asset_id:w}}, {fecha:V_t}) en float."""
+    if V.empty:
+        return {}, {}
+    w = x.div(V, axis=0)
+    cols = list(w.columns)
+    result_w = {}
+    for d, row in zip(w.index, w.to_numpy()):
+        result_w[d] = {a_id: float(v) for a_id, v in zip(cols, row) if not np.isnan(v)}
+    result_V = dict(zip(V.index, V.astype(float).tolist()))
     return result_w, result_V
+
+def get_prices_changed_since(since):
+    """{asset_id: primera fecha de precio insertado/corregido desde el instante 'since'} (updated_at)."""
+    return dict(Price.objects.filter(updated_at__gte=since)
+                .values("asset_id").annotate(first=Min("date")).values_list("asset_id", "first"))
+
+def get_daily_valuations(portfolio: Portfolio, start: date, end: date, freq: str = "daily",
+                         max_points: int | None = None):
+    """
+    Lee ({fecha:{asset_id:w}}, {fecha:V_t}) desde PortfolioDailyValuation (un range scan).
+    Con freq/max_points (ver sampling) primero lee sólo (fecha, V_t) del rango, elige las fechas
+    y trae los weights únicamente de ésas.
+    Devuelve None si el portafolio aún no está materializado, o si el rango toca fechas con un
+    refresh pendiente en el worker (valuations_dirty_from).
+    """
+    if portfolio.valuations_dirty_from is not None and end >= portfolio.valuations_dirty_from:
+        return None
+    qs = PortfolioDailyValuation.objects.filter(portfolio=portfolio, date__gte=start, date__lte=end).order_by("date")
+    with span("fetch.daily_valuations"):
+        if is_sampled(freq, max_points, start, end):
+            values = list(qs.values_list("date", "value"))
+            rows = list(qs.filter(date__in=_sampled_dates(values, freq, max_points))
+                        .values_list("date", "value", "weights")) if values else []
+        else:
+            rows = list(qs.values_list("date", "value", "weights"))
+        if not rows and not PortfolioDailyValuation.objects.filter(portfolio=portfolio).exists():
+            return None
+    incr("daily_valuation_rows_fetched", len(rows))
+    return _valuation_maps(rows)
+
+def _sampled_dates(values, freq: str, max_points: int | None):
+    dates = [d for d, _ in values]
+    return [dates[i] for i in sample_indices(dates, [float(v) for _, v in values], freq, max_points)]
+
+def _valuation_maps(rows):
+    result_w, result_V = {}, {}
+    for d, value, weights in rows:
+        result_V[d] = value
+        result_w[d] = {int(a_id): w for a_id, w in weights.items()}
+    return result_w, result_V
+
+# --- Variantes async (ORM async; para las vistas servidas bajo config.asgi) ---
+
+async def aget_daily_valuations(portfolio: Portfolio, start: date, end: date, freq: str = "daily",
+                                max_points: int | None = None):
+    """Igual que get_daily_valuations, con el ORM async."""
+    if portfolio.valuations_dirty_from is not None and end >= portfolio.valuations_dirty_from:
+        return None
+    qs = PortfolioDailyValuation.objects.filter(portfolio=portfolio, date__gte=start, date__lte=end).order_by("date")
+    if is_sampled(freq, max_points, start, end):
+        values = await _alist(qs.values_list("date", "value"))
+        rows = await _alist(qs.filter(date__in=_sampled_dates(values, freq, max_points))
+                            .values_list("date", "value", "weights")) if values else []
+    else:
+        rows = await _alist(qs.values_list("date", "value", "weights"))
+    if not rows and not await PortfolioDailyValuation.objects.filter(portfolio=portfolio).aexists():
+        return None
+    return _valuation_maps(rows)
+
+async def acompute_timeseries_weights_and_value(portfolio: Portfolio, start: date, end: date, freq: str = "daily",
+                                                max_points: int | None = None):
+    """
+    Motor vectorizado con fetch async: tramos y precios se piden uno tras otro por el thread de la
+    conexión (sync_to_async thread_sensitive), sin bloquear el event loop; los assets de los precios
+    salen de una subquery sobre holdings. Con el snapshot de precios habilitado sólo se piden los
+    tramos. Con el backend 'decimal' delega al motor exacto en un thread.
+    """
+    if numeric_backend() == "decimal":
+        return sample_maps(*await sync_to_async(_compute_exact)(portfolio, start, end), freq, max_points)
+    held = Holding.objects.filter(portfolio=portfolio, effective_from__lte=end).values("asset_id")
+    tranches_qs = _tranches_qs([portfolio.id], end, start).values_list("asset_id", "effective_from", "quantity")
+    store = get_price_store()
+    px = store.frame(start, end) if store is not None else None
+    if px is not None:  # snapshot mapeado: sólo falta la query de tramos
+        return frame_to_maps(*sample_frame(*valuate(px, HoldingsIndex(await _alist(tranches_qs))), freq, max_points))
+    tranches = await _alist(tranches_qs)
+    prices = await sync_to_async(PriceArrays.from_queryset)(_prices_qs(held, start, end))
+    return frame_to_maps(*sample_frame(*valuate(prices.to_frame(), HoldingsIndex(tranches)), freq, max_points))
+
+async def _alist(qs):
+    # async for sobre el queryset (un _fetch_all en sync_to_async): aiterator() con values_list
+    # ejecuta la query en el event loop en Django 5.x y falla con SynchronousOnlyOperation
+    return [r async for r in qs]
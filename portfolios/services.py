@@ -1,29 +1,107 @@
 # portfolios/services.py
+import logging
+import os
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
 from decimal import Decimal, ROUND_DOWN
-from django.db import transaction
-from .models import Portfolio, Asset, Price, InitialWeight, Holding, Trade
+from django.db import connection, connections, transaction
+from django.db.models import F, Max, Q
+from .assets import get_asset_registry
+from .models import Portfolio, Asset, Price, InitialWeight, Holding, Trade, PortfolioDailyValuation
+from .instrumentation import incr, instrumented
+from .jobs import POST_TRADES, REFRESH_VALUATIONS, enqueue, enqueue_on_commit, jobs_config
+from .selectors import iter_exact_exposures, latest_holding_ids
+
+logger = logging.getLogger("portfolios.services")
+
+class MissingPricesError(ValueError):
+    """Faltan precios para valorizar: missing = [(nombre del asset, fecha)], todos a la vez."""
+    def __init__(self, missing):
+        self.missing = missing
+        detail = ", ".join(f"{name} el {d}" for name, d in missing[:10])
+        more = f" (y {len(missing) - 10} más)" if len(missing) > 10 else ""
+        super().__init__(f"Faltan {len(missing)} precios: {detail}{more}")
 
-@transaction.atomic
 def bootstrap_initial_holdings(portfolio: Portfolio, t0: date):
     """
     C_{i,0} = w_{i,0} * V0 / P_{i,0}
-    Crea Holding(effective_from=t0) por asset con weight inicial.
-    """
-    prices_t0 = {p.asset_id: p.price for p in Price.objects.filter(date=t0)}
-    weights = InitialWeight.objects.filter(portfolio=portfolio)
-    created = []
-    for w in weights:
-        p = Decimal(prices_t0[w.asset_id])
-        qty = (Decimal(w.weight) * Decimal(portfolio.initial_value_usd) / p)
-        qty = qty.quantize(Decimal("1.000000000000"), rounding=ROUND_DOWN)
-        h = Holding.objects.create(
-            portfolio=portfolio, asset=w.asset, quantity=qty, effective_from=t0
-        )
-        created.append(h)
+    Crea Holding(effective_from=t0) por asset con weight inicial (un bulk_create).
+    """
+    created = bootstrap_initial_holdings_bulk([portfolio], t0)
     print(f"[INFO] Holdings iniciales: {len(created)} en {portfolio.name}")
     return created
 
+@instrumented("services.bootstrap_initial_holdings_bulk")
+def bootstrap_initial_holdings_bulk(portfolios, t0: date, refresh: bool = True):
+    """
+    bootstrap_initial_holdings para muchos portafolios: rebalance_holdings a los InitialWeight
+    con V = initial_value_usd. Con refresh=False no materializa (el llamador puede hacerlo en
+    paralelo con refresh_daily_valuations_many).
+    """
+    targets = {p.id: {} for p in portfolios}
+    for p_id, a_id, w in (InitialWeight.objects.filter(portfolio_id__in=list(targets))
+                          .values_list("portfolio_id", "asset_id", "weight")):
+        targets[p_id][a_id] = w
+    values = {p.id: p.initial_value_usd for p in portfolios}
+    return rebalance_holdings(targets, t0, values=values, record_trades=False, refresh=refresh)
+
+@instrumented("services.rebalance_holdings")
+@transaction.atomic
+def rebalance_holdings(targets: dict, at_date: date, values: dict | None = None,
+                       record_trades: bool = True, refresh: bool = True):
+    """
+    Lleva muchos portafolios a pesos objetivo en at_date en una pasada: c_i = w_i · V / P_{i,at_date}.
+    targets: {portfolio_id: {asset_id: weight}}. values: {portfolio_id: V}; por defecto, el valor de
+    mercado en at_date con los holdings vigentes. Los assets vigentes fuera del objetivo quedan en 0.
+    Sólo se escriben tramos de assets cuya cantidad cambia, más un tramo base (en 0 si el peso es 0)
+    para cada asset objetivo sin tramo vigente, como en el bootstrap. Con record_trades, cada cambio
+    se registra como Trade en USD.
+    Lee holdings vigentes y precios con una query cada uno y escribe con un bulk_create. Si falta
+    algún precio lanza MissingPricesError con todos los faltantes, sin escribir nada.
+    """
+    portfolio_ids = list(targets)
+    current = {p_id: {} for p_id in portfolio_ids}
+    for p_id, a_id, qty in (Holding.objects.filter(id__in=latest_holding_ids(portfolio_ids, at_date))
+                            .values_list("portfolio_id", "asset_id", "quantity")):
+        current[p_id][a_id] = qty
+
+    # precio necesario: peso objetivo ≠ 0, o posición vigente ≠ 0 (valor de mercado / trade)
+    needed = {(p_id, a_id) for p_id, ws in targets.items() for a_id, w in ws.items() if w}
+    if values is None or record_trades:
+        needed |= {(p_id, a_id) for p_id, held in current.items() for a_id, q in held.items() if q}
+    prices = dict(Price.objects.filter(date=at_date, asset_id__in={a_id for _, a_id in needed})
+                  .values_list("asset_id", "price"))
+    missing = sorted({a_id for _, a_id in needed if a_id not in prices})
+    if missing:
+        names = get_asset_registry().legend(missing)
+        raise MissingPricesError([(names[a_id], at_date) for a_id in missing])
+
+    if values is None:
+        values = {p_id: sum((q * prices[a_id] for a_id, q in held.items() if q), Decimal("0"))
+                  for p_id, held in current.items()}
+    holdings, trade_rows = [], []
+    for p_id, weights in targets.items():
+        held = current[p_id]
+        for a_id in weights.keys() | {a_id for a_id, q in held.items() if q}:
+            w = Decimal(weights.get(a_id, 0))
+            qty = w * Decimal(values[p_id]) / Decimal(prices[a_id]) if w else Decimal("0")
+            qty = qty.quantize(Decimal("1.000000000000"), rounding=ROUND_DOWN)
+            delta = qty - held.get(a_id, Decimal("0"))
+            if not delta and a_id in held:  # el tramo vigente ya tiene esta cantidad
+                continue
+            holdings.append(Holding(portfolio_id=p_id, asset_id=a_id, quantity=qty, effective_from=at_date))
+            if record_trades and held and delta:
+                amount = (delta * prices[a_id]).quantize(Decimal("0.01"))
+                trade_rows.append(Trade(portfolio_id=p_id, asset_id=a_id, trade_date=at_date, amount_usd=amount))
+    Holding.objects.bulk_create(holdings, batch_size=1000)
+    Trade.objects.bulk_create(trade_rows, batch_size=1000)
+    if refresh:
+        for p in Portfolio.objects.filter(id__in=portfolio_ids):
+            schedule_valuation_refresh(p, at_date)
+    return holdings
+
+@instrumented("services.post_trade_usd_notional")
 @transaction.atomic
 def post_trade_usd_notional(portfolio: Portfolio, asset: Asset, trade_date: date, amount_usd: Decimal):
     """
@@ -37,7 +115,7 @@ def post_trade_usd_notional(portfolio: Portfolio, asset: Asset, trade_date: date
 
     latest = (Holding.objects
               .filter(portfolio=portfolio, asset=asset, effective_from__lte=trade_date)
-              .order_by("-effective_from")
+              .order_by("-effective_from", "-id")
               .first())
     if not latest:
         raise ValueError("No existe holding previo que ajustar.")
@@ -52,4 +130,208 @@ def post_trade_usd_notional(portfolio: Portfolio, asset: Asset, trade_date: date
     Trade.objects.create(
         portfolio=portfolio, asset=asset, trade_date=trade_date, amount_usd=amount_usd
     )
+    schedule_valuation_refresh(portfolio, trade_date)
     print(f"[INFO] Trade {asset} {amount_usd} USD @ {trade_date} → qty {new_qty}")
+
+class BulkTradeError(ValueError):
+    """Errores de validación por fila: errors = [(índice, mensaje)]."""
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f"{len(errors)} trades inválidos; primero: fila {errors[0][0]}: {errors[0][1]}")
+
+@instrumented("services.post_trades_bulk")
+@transaction.atomic
+def post_trades_bulk(trades, skip_invalid: bool = False):
+    """
+    Aplica muchos trades USD con las mismas reglas que post_trade_usd_notional, en orden de fecha
+    y en memoria: precios y tramos de holdings se leen con unas pocas queries, Holding/Trade se
+    escriben con bulk_create y la materialización se refresca una vez por portafolio.
+
+    trades: secuencia de (portfolio_id, asset_id, trade_date, amount_usd).
+    Con errores lanza BulkTradeError (sin escribir nada), salvo skip_invalid=True, que aplica
+    los válidos y devuelve los errores en el resultado.
+    """
+    trades = [(p_id, a_id, d, Decimal(amount)) for p_id, a_id, d, amount in trades]
+    if not trades:
+        return {"created": 0, "errors": []}
+    portfolio_ids = {t[0] for t in trades}
+    asset_ids = {t[1] for t in trades}
+    max_date = max(t[2] for t in trades)
+
+    portfolios = Portfolio.objects.in_bulk(portfolio_ids)
+    asset_names = dict(Asset.objects.filter(id__in=asset_ids).values_list("id", "name"))
+    prices = {
+        (a_id, d): p for a_id, d, p in Price.objects
+        .filter(asset_id__in=asset_ids, date__in={t[2] for t in trades})
+        .values_list("asset_id", "date", "price")
+    }
+    # tramos por (portfolio, asset) en orden temporal: fechas y cantidades paralelas para bisect
+    tranches = {}
+    for p_id, a_id, eff, qty in (Holding.objects
+                                 .filter(portfolio_id__in=portfolio_ids, asset_id__in=asset_ids,
+                                         effective_from__lte=max_date)
+                                 .order_by("effective_from", "id")
+                                 .values_list("portfolio_id", "asset_id", "effective_from", "quantity")):
+        dates, qtys = tranches.setdefault((p_id, a_id), ([], []))
+        dates.append(eff)
+        qtys.append(qty)
+
+    errors, holdings, trade_rows, first_date = [], [], [], {}
+    for idx in sorted(range(len(trades)), key=lambda i: trades[i][2]):
+        p_id, a_id, trade_date, amount_usd = trades[idx]
+        if p_id not in portfolios or a_id not in asset_names:
+            errors.append((idx, "Portafolio o asset inexistente."))
+            continue
+        price = prices.get((a_id, trade_date))
+        if price is None:
+            errors.append((idx, f"Falta precio para {asset_names[a_id]} el {trade_date}"))
+            continue
+        dates, qtys = tranches.get((p_id, a_id), ([], []))
+        pos = bisect_right(dates, trade_date)
+        if pos == 0:
+            errors.append((idx, "No existe holding previo que ajustar."))
+            continue
+        new_qty = qtys[pos - 1] + amount_usd / Decimal(price)
+        if new_qty < 0:
+            errors.append((idx, "La cantidad resultante quedaría negativa."))
+            continue
+        # misma precisión que persiste la DB, para que los trades siguientes partan del valor guardado
+        new_qty = new_qty.quantize(Decimal("1.000000000000"))
+        dates.insert(pos, trade_date)
+        qtys.insert(pos, new_qty)
+        holdings.append(Holding(portfolio_id=p_id, asset_id=a_id, quantity=new_qty, effective_from=trade_date))
+        trade_rows.append(Trade(portfolio_id=p_id, asset_id=a_id, trade_date=trade_date, amount_usd=amount_usd))
+        first_date[p_id] = min(first_date.get(p_id, trade_date), trade_date)
+
+    errors.sort()
+    if errors and not skip_invalid:
+        raise BulkTradeError(errors)
+
+    Holding.objects.bulk_create(holdings, batch_size=1000)
+    Trade.objects.bulk_create(trade_rows, batch_size=1000)
+    for p_id, d in first_date.items():
+        schedule_valuation_refresh(portfolios[p_id], d)
+    logger.info("trades en bloque: %s aplicados, %s con error, %s portafolios",
+                len(trade_rows), len(errors), len(first_date))
+    return {"created": len(trade_rows), "errors": errors}
+
+@instrumented("services.refresh_daily_valuations")
+@transaction.atomic
+def refresh_daily_valuations(portfolio: Portfolio, from_date: date | None = None):
+    """
+    Recalcula PortfolioDailyValuation desde 'from_date' (inclusive) hasta el último precio.
+    Sin from_date, o si el portafolio aún no está materializado, recalcula toda la historia.
+    También sube data_version, lo que invalida la cache de /metrics del portafolio.
+    """
+    bump_data_version([portfolio.id])
+    first = (portfolio.holdings.order_by("effective_from")
+             .values_list("effective_from", flat=True).first())
+    if from_date is None or not portfolio.daily_valuations.exists():
+        from_date = first
+    # (todo es una transacción) queda al día desde from_date; una marca anterior se mantiene
+    dirty = Portfolio.objects.filter(id=portfolio.id)
+    if from_date != first:
+        dirty = dirty.filter(valuations_dirty_from__gte=from_date)
+    dirty.update(valuations_dirty_from=None)
+    if from_date is None:
+        portfolio.daily_valuations.all().delete()
+        return 0
+
+    asset_ids = list(portfolio.holdings.values_list("asset_id", flat=True).distinct())
+    end = Price.objects.filter(asset_id__in=asset_ids).aggregate(m=Max("date"))["m"]
+    portfolio.daily_valuations.filter(date__gte=from_date).delete()
+    if end is None or end < from_date:
+        return 0
+
+    rows = [
+        PortfolioDailyValuation(
+            portfolio=portfolio, date=d, value=x_sum,
+            exposures={str(a_id): float(x) for a_id, x in x_map.items()},
+            weights={str(a_id): float(x / x_sum) for a_id, x in x_map.items()},
+        )
+        for d, x_map, x_sum in iter_exact_exposures(portfolio, from_date, end)
+    ]
+    PortfolioDailyValuation.objects.bulk_create(rows, batch_size=1000)
+    incr("dates_valued", len(rows))
+    return len(rows)
+
+def schedule_valuation_refresh(portfolio: Portfolio, from_date: date | None = None):
+    """
+    refresh_daily_valuations en línea o, con PORTFOLIOS_JOBS["ASYNC_REFRESH"], como job del
+    worker encolado al confirmar la transacción. Mientras tanto el portafolio queda marcado
+    (valuations_dirty_from) y los endpoints calculan en línea desde esa fecha;
+    data_version sube ya para no servir respuestas cacheadas viejas.
+    Devuelve las filas recalculadas, o None si quedó encolado.
+    """
+    if not jobs_config()["ASYNC_REFRESH"]:
+        return refresh_daily_valuations(portfolio, from_date)
+    bump_data_version([portfolio.id])
+    dirty = from_date or portfolio.inception_date
+    Portfolio.objects.filter(Q(valuations_dirty_from__isnull=True) | Q(valuations_dirty_from__gt=dirty),
+                             id=portfolio.id).update(valuations_dirty_from=dirty)
+    enqueue_on_commit(REFRESH_VALUATIONS, portfolio.id, {"from_date": from_date and from_date.isoformat()})
+    return None
+
+def enqueue_trades_bulk(trades, skip_invalid: bool = False):
+    """
+    post_trades_bulk como job del worker (blotters grandes fuera del request), encolado al
+    confirmar la transacción en curso: si ésta se revierte no queda job. Devuelve el Job, o None
+    si quedó pendiente del commit (dentro de un atomic).
+    """
+    payload = {
+        "trades": [[p_id, a_id, d.isoformat(), str(amount)] for p_id, a_id, d, amount in trades],
+        "skip_invalid": skip_invalid,
+    }
+    jobs = []
+    transaction.on_commit(lambda: jobs.append(enqueue(POST_TRADES, None, payload)))
+    return jobs[0] if jobs else None
+
+
+def refresh_daily_valuations_for_price_changes(changes: dict, exclude=()):
+    """
+    changes = {asset_id: primera fecha con precio nuevo o corregido}.
+    Refresca cada portafolio con holdings en esos assets (salvo los de exclude) desde la menor
+    fecha que lo afecta.
+    """
+    since = {}
+    for p_id, a_id in (Holding.objects.filter(asset_id__in=list(changes)).exclude(portfolio_id__in=list(exclude))
+                       .values_list("portfolio_id", "asset_id").distinct()):
+        since[p_id] = min(since.get(p_id, changes[a_id]), changes[a_id])
+    portfolios = Portfolio.objects.in_bulk(list(since))
+    return {p_id: schedule_valuation_refresh(portfolios[p_id], d) for p_id, d in since.items()}
+
+def refresh_daily_valuations_many(portfolio_ids, from_date: date | None = None, workers: int = 1):
+    """
+    refresh_daily_valuations para muchos portafolios repartidos en un pool de procesos (el cálculo
+    Decimal es CPU puro, un proceso por core). Con workers ≤ 1, SQLite o ASYNC_REFRESH corre/encola
+    en este proceso. Devuelve {portfolio_id: filas recalculadas (None si quedó encolado)}.
+    """
+    portfolio_ids = list(portfolio_ids)
+    workers = min(workers, len(portfolio_ids))
+    if workers <= 1 or connection.vendor == "sqlite" or jobs_config()["ASYNC_REFRESH"]:
+        portfolios = Portfolio.objects.in_bulk(portfolio_ids)
+        return {p_id: schedule_valuation_refresh(portfolios[p_id], from_date) for p_id in portfolio_ids}
+    chunks = [portfolio_ids[i::workers] for i in range(workers)]
+    # los hijos no pueden heredar sockets abiertos del padre: cada proceso abre su conexión
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_pool_init) as pool:
+        results = {}
+        for part in pool.map(_refresh_chunk, chunks, [from_date] * workers):
+            results.update(part)
+    return results
+
+def _pool_init():
+    import django
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+    django.setup()
+
+def _refresh_chunk(portfolio_ids, from_date):
+    portfolios = Portfolio.objects.in_bulk(portfolio_ids)
+    try:
+        return {p_id: refresh_daily_valuations(portfolios[p_id], from_date) for p_id in portfolio_ids}
+    finally:
+        connections.close_all()
+
+def bump_data_version(portfolio_ids):
+    """Invalida las entradas de cache de estos portafolios (la versión es parte de la llave)."""
+    return Portfolio.objects.filter(id__in=list(portfolio_ids)).update(data_version=F("data_version") + 1)
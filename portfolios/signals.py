@@ -0,0 +1,7 @@
+# portfolios/signals.py
+from django.dispatch import Signal
+
+# Enviada tras cargar precios. kwargs: changes = {asset_id: primera fecha insertada o corregida}.
+# Los consumidores (materialización, caches) sólo necesitan recalcular desde esa fecha.
+# refreshed (opcional) = ids de portafolios que quien envía va a recalcular por su cuenta.
+prices_changed = Signal()
@@ -0,0 +1,117 @@
+# portfolios/simulation.py
+"""
+Escenarios what-if sin escrituras (ver /api/portfolios/<id>/simulate).
+
+Cada escenario es una lista de trades hipotéticos en USD y de precios sobrescritos en fechas de
+valorización. Los trades se aplican sobre una copia en memoria de los tramos de Holding con las
+reglas de post_trades_bulk (el resultado es el que dejaría registrarlos de verdad), salvo que una
+compra puede abrir una posición nueva; los precios sobrescritos sólo tocan la copia de la matriz del
+escenario. Todos los escenarios de un batch comparten una sola lectura de tramos y de precios, y se
+valorizan con el motor vectorizado.
+"""
+from bisect import bisect_right
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+
+from .instrumentation import incr, instrumented
+from .models import Portfolio
+from .selectors import HoldingsIndex, get_holding_tranches, get_price_frame, valuate
+
+BASE = "base"
+
+
+class ScenarioError(ValueError):
+    """Errores de validación: errors = {nombre del escenario: [("trade" | "price_override", índice, mensaje)]}."""
+    def __init__(self, errors):
+        self.errors = errors
+        name, rows = next(iter(errors.items()))
+        super().__init__(f"{sum(map(len, errors.values()))} filas inválidas; primero: {name}, "
+                         f"{rows[0][0]} {rows[0][1]}: {rows[0][2]}")
+
+
+@instrumented("simulation.run")
+def simulate_scenarios(portfolio: Portfolio, start: date, end: date, scenarios) -> dict:
+    """
+    scenarios: [{"name", "trades": [{"asset_id", "date", "amount_usd"}],
+                 "price_overrides": [{"asset_id", "date", "price"}]}]
+    Devuelve {nombre: (x, V)} (como compute_valuation_frame) con BASE = el portafolio sin cambios,
+    primero. Lanza ScenarioError con todos los trades y precios inválidos de todos los escenarios
+    (un precio sólo se puede sobrescribir en una fecha que ya tiene precios).
+    2 queries en total, sin importar la cantidad de escenarios.
+    """
+    trade_dates = [t["date"] for s in scenarios for t in s.get("trades", [])]
+    fetch_start = min([start, *trade_dates])
+    # tramos vigentes desde el trade más antiguo: un trade previo al rango parte de la cantidad de su fecha
+    tranches = get_holding_tranches(portfolio, end, fetch_start)
+    extra = {r["asset_id"] for s in scenarios for r in (*s.get("trades", []), *s.get("price_overrides", []))}
+    asset_ids = sorted({a_id for a_id, _, _ in tranches} | extra)
+    px = get_price_frame(asset_ids, fetch_start, end)
+
+    results = {BASE: valuate(_from(px, start), HoldingsIndex(tranches))}
+    errors = {}
+    for scenario in scenarios:
+        px_s, rows = _with_overrides(px, scenario.get("price_overrides", []))
+        if not rows:
+            tranches_s, rows = _apply_trades(tranches, scenario.get("trades", []), px_s)
+        if rows:
+            errors[scenario["name"]] = rows
+            continue
+        results[scenario["name"]] = valuate(_from(px_s, start), HoldingsIndex(tranches_s))
+    incr("scenarios_simulated", len(scenarios))
+    if errors:
+        raise ScenarioError(errors)
+    return results
+
+
+def _from(px, start: date):
+    return px[np.fromiter((d >= start for d in px.index), dtype=bool, count=len(px))]
+
+
+def _with_overrides(px, overrides):
+    """
+    (matriz con los precios sobrescritos, [("price_override", índice, error)]). Una fecha sin fila
+    en px se rechaza: agregarla dejaría al resto de los assets sin precio ese día.
+    """
+    errors = [("price_override", idx, f"No hay precios el {o['date']}: sólo se sobrescriben fechas de valorización")
+              for idx, o in enumerate(overrides) if o["date"] not in px.index]
+    if errors or not overrides:
+        return px, errors  # sin cambios: la matriz compartida (puede ser una vista sobre el snapshot)
+    px = px.copy()
+    for o in overrides:
+        if o["asset_id"] not in px.columns:
+            px[o["asset_id"]] = np.nan
+        px.at[o["date"], o["asset_id"]] = float(o["price"])
+    return px, []
+
+
+def _apply_trades(tranches, trades, px):
+    """(tramos con los trades aplicados, [("trade", índice, error)]). Los tramos originales no se modifican."""
+    per_asset = {}
+    for a_id, eff, qty in tranches:
+        dates, qtys = per_asset.setdefault(a_id, ([], []))
+        dates.append(eff)
+        qtys.append(qty)
+    errors = []
+    for idx in sorted(range(len(trades)), key=lambda i: trades[i]["date"]):
+        a_id, trade_date, amount = trades[idx]["asset_id"], trades[idx]["date"], Decimal(trades[idx]["amount_usd"])
+        price = px.at[trade_date, a_id] if trade_date in px.index and a_id in px.columns else np.nan
+        if np.isnan(price):
+            errors.append(("trade", idx, f"Falta precio para el asset {a_id} el {trade_date}"))
+            continue
+        dates, qtys = per_asset.setdefault(a_id, ([], []))
+        pos = bisect_right(dates, trade_date)
+        # a diferencia de post_trade, una compra puede abrir una posición nueva
+        previous = qtys[pos - 1] if pos else Decimal("0")
+        if pos == 0 and amount < 0:
+            errors.append(("trade", idx, "No existe holding previo que ajustar."))
+            continue
+        new_qty = previous + amount / Decimal(str(price))
+        if new_qty < 0:
+            errors.append(("trade", idx, "La cantidad resultante quedaría negativa."))
+            continue
+        dates.insert(pos, trade_date)
+        qtys.insert(pos, new_qty.quantize(Decimal("1.000000000000")))
+    out = [(a_id, eff, qty) for a_id, (dates, qtys) in per_asset.items() for eff, qty in zip(dates, qtys)]
+    return out, sorted(errors)
@@ -1,5 +1,7 @@
 from datetime import date
 from decimal import Decimal
+from unittest import skipUnless
+from django.db import connection
 from django.test import TestCase
 from .models import Asset, Portfolio, Price, InitialWeight, Holding
 
@@ -38,3 +40,1395 @@ class ModelsSmokeTest(TestCase):
 
     def test_holding_schema(self):
         # No holdings aún (los crea el ETL/servicio)
+        self.assertEqual(Holding.objects.filter(portfolio=self.p).count(), 0)
+
+
+class TimeseriesEngineTest(TestCase):
+    def setUp(self):
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.t0 = date(2022, 2, 15)
+        self.p = Portfolio.objects.create(
+            name="Portafolio 1", inception_date=self.t0, initial_value_usd=Decimal("1000"),
+        )
+        self.dates = [date(2022, 2, d) for d in (15, 16, 17, 18, 21)]
+        for i, d in enumerate(self.dates):
+            Price.objects.create(asset=self.a_us, date=d, price=Decimal("10") + i)
+            if d != date(2022, 2, 17):  # hueco de precio para Europa
+                Price.objects.create(asset=self.a_eu, date=d, price=Decimal("20") - i)
+        Holding.objects.create(portfolio=self.p, asset=self.a_us, quantity=Decimal("60"), effective_from=self.t0)
+        Holding.objects.create(portfolio=self.p, asset=self.a_eu, quantity=Decimal("20"), effective_from=self.t0)
+        # trade: nuevo tramo de EEUU desde el 17
+        Holding.objects.create(portfolio=self.p, asset=self.a_us, quantity=Decimal("30"), effective_from=date(2022, 2, 17))
+
+    def _legacy(self, start, end):
+        from .selectors import get_portfolio_prices_between, get_holdings_at
+        result_w, result_V = {}, {}
+        for d, prices in get_portfolio_prices_between(self.p, start, end).items():
+            c_map = get_holdings_at(self.p, d)
+            x_map = {a: Decimal(px) * Decimal(c_map[a]) for a, px in prices.items() if a in c_map}
+            x_sum = sum(x_map.values(), Decimal("0"))
+            if x_sum == 0:
+                continue
+            result_V[d] = x_sum
+            result_w[d] = {a: x / x_sum for a, x in x_map.items()}
+        return result_w, result_V
+
+    def test_exact_mode_matches_legacy_path(self):
+        from .selectors import compute_timeseries_weights_and_value
+        got = compute_timeseries_weights_and_value(self.p, self.dates[0], self.dates[-1], exact=True)
+        self.assertEqual(got, self._legacy(self.dates[0], self.dates[-1]))
+
+    def test_vectorized_matches_exact(self):
+        from .selectors import compute_timeseries_weights_and_value
+        w_exact, v_exact = compute_timeseries_weights_and_value(self.p, self.dates[0], self.dates[-1], exact=True)
+        w_fast, v_fast = compute_timeseries_weights_and_value(self.p, self.dates[0], self.dates[-1])
+        self.assertEqual(list(v_fast), list(v_exact))
+        for d in v_exact:
+            self.assertAlmostEqual(v_fast[d], float(v_exact[d]), places=6)
+            self.assertEqual(set(w_fast[d]), set(w_exact[d]))
+            for a_id, w in w_exact[d].items():
+                self.assertAlmostEqual(w_fast[d][a_id], float(w), places=12)
+        # el 17 Europa no tiene precio → sólo EEUU con weight 1
+        self.assertEqual(w_fast[date(2022, 2, 17)], {self.a_us.id: 1.0})
+        self.assertEqual(v_fast[date(2022, 2, 17)], 12.0 * 30)
+
+    def test_query_count_is_constant(self):
+        from .selectors import compute_timeseries_weights_and_value
+        for exact in (False, True):
+            with self.assertNumQueries(2):
+                compute_timeseries_weights_and_value(self.p, self.dates[0], self.dates[-1], exact=exact)
+
+    def test_empty_range(self):
+        from .selectors import compute_timeseries_weights_and_value
+        self.assertEqual(compute_timeseries_weights_and_value(self.p, date(2020, 1, 1), date(2020, 1, 2)), ({}, {}))
+
+
+class DailyValuationTest(TestCase):
+    def setUp(self):
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.t0 = date(2022, 2, 15)
+        self.p = Portfolio.objects.create(
+            name="Portafolio 1", inception_date=self.t0, initial_value_usd=Decimal("1000"),
+        )
+        self.dates = [date(2022, 2, d) for d in (15, 16, 17, 18)]
+        for i, d in enumerate(self.dates):
+            Price.objects.create(asset=self.a_us, date=d, price=Decimal("10") + i)
+            Price.objects.create(asset=self.a_eu, date=d, price=Decimal("20"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_us, weight=Decimal("0.5"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_eu, weight=Decimal("0.5"))
+
+    def test_bootstrap_and_trade_refresh_materialization(self):
+        from .models import PortfolioDailyValuation
+        from .selectors import compute_timeseries_weights_and_value, get_daily_valuations
+        from .services import bootstrap_initial_holdings, post_trade_usd_notional
+
+        self.assertIsNone(get_daily_valuations(self.p, self.dates[0], self.dates[-1]))
+        bootstrap_initial_holdings(self.p, self.t0)
+        self.assertEqual(PortfolioDailyValuation.objects.filter(portfolio=self.p).count(), 4)
+
+        first = PortfolioDailyValuation.objects.get(portfolio=self.p, date=self.dates[0])
+        post_trade_usd_notional(self.p, self.a_us, self.dates[2], Decimal("-120"))
+        # filas previas al trade no se tocan; las posteriores reflejan el trade
+        self.assertEqual(PortfolioDailyValuation.objects.get(portfolio=self.p, date=self.dates[0]).pk, first.pk)
+        w_mat, v_mat = get_daily_valuations(self.p, self.dates[0], self.dates[-1])
+        w_live, v_live = compute_timeseries_weights_and_value(self.p, self.dates[0], self.dates[-1], exact=True)
+        self.assertEqual(list(v_mat), list(v_live))
+        for d in v_live:
+            self.assertEqual(v_mat[d], v_live[d].quantize(Decimal("0.000001")))
+            for a_id, w in w_live[d].items():
+                self.assertAlmostEqual(w_mat[d][a_id], float(w), places=12)
+
+    def test_metrics_api_reads_materialized_rows(self):
+        from .cache import get_metrics_cache
+        from .services import bootstrap_initial_holdings
+        get_metrics_cache().clear()
+        bootstrap_initial_holdings(self.p, self.t0)
+        url = f"/api/portfolios/{self.p.id}/metrics?fecha_inicio=2022-02-15&fecha_fin=2022-02-18"
+        with self.assertNumQueries(3):  # portfolio + range scan + nombres de assets
+            res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        body = res.json()
+        self.assertEqual(body["values"][0], {"date": "2022-02-15", "value": 1000.0})
+        self.assertAlmostEqual(body["weights"][0]["weights"]["EEUU"], 0.5)
+
+
+class RebalanceTest(TestCase):
+    def setUp(self):
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.t0 = date(2022, 2, 15)
+        self.portfolios = [
+            Portfolio.objects.create(name=f"Portafolio {i}", inception_date=self.t0, initial_value_usd=Decimal("1000"))
+            for i in (1, 2)
+        ]
+        for i, d in enumerate(date(2022, 2, day) for day in (15, 16, 17)):
+            Price.objects.create(asset=self.a_us, date=d, price=Decimal("10") + i)
+            Price.objects.create(asset=self.a_eu, date=d, price=Decimal("20"))
+        for p in self.portfolios:
+            InitialWeight.objects.create(portfolio=p, asset=self.a_us, weight=Decimal("0.5"))
+            InitialWeight.objects.create(portfolio=p, asset=self.a_eu, weight=Decimal("0.5"))
+
+    def test_bulk_bootstrap_then_rebalance_many(self):
+        from .models import PortfolioDailyValuation, Trade
+        from .services import bootstrap_initial_holdings_bulk, rebalance_holdings
+
+        a_jp = Asset.objects.create(name="Japón")
+        InitialWeight.objects.create(portfolio=self.portfolios[0], asset=a_jp, weight=Decimal("0"))
+        bootstrap_initial_holdings_bulk(self.portfolios, self.t0, refresh=False)
+        self.assertEqual(Trade.objects.count(), 0)
+        for p in self.portfolios:
+            qty = dict(Holding.objects.filter(portfolio=p).values_list("asset_id", "quantity"))
+            expected = {self.a_us.id: Decimal("50"), self.a_eu.id: Decimal("25")}
+            if p == self.portfolios[0]:  # peso inicial 0: tramo base en 0, como antes del rebalance en bloque
+                expected[a_jp.id] = Decimal("0")
+            self.assertEqual(qty, expected)
+
+        d = date(2022, 2, 17)  # V = 50·12 + 25·20 = 1100
+        targets = {p.id: {self.a_us.id: Decimal("0.2"), self.a_eu.id: Decimal("0.8")} for p in self.portfolios}
+        rebalance_holdings(targets, d)
+        for p in self.portfolios:
+            qty = dict(Holding.objects.filter(portfolio=p, effective_from=d).values_list("asset_id", "quantity"))
+            self.assertEqual(qty, {self.a_us.id: Decimal("18.333333333333"), self.a_eu.id: Decimal("44")})
+            amounts = dict(Trade.objects.filter(portfolio=p).values_list("asset_id", "amount_usd"))
+            self.assertEqual(amounts, {self.a_us.id: Decimal("-380.00"), self.a_eu.id: Decimal("380.00")})
+            v = PortfolioDailyValuation.objects.get(portfolio=p, date=d).value
+            self.assertAlmostEqual(float(v), 1100, places=6)
+
+        # mismo objetivo y mismo V otra vez: ninguna cantidad cambia, no se escribe nada
+        n_holdings = Holding.objects.count()
+        self.assertEqual(rebalance_holdings(targets, d, values={p.id: Decimal("1100") for p in self.portfolios}), [])
+        self.assertEqual((Holding.objects.count(), Trade.objects.count()), (n_holdings, 4))
+
+        # Europa sale del objetivo: tramo en 0 (cierra la posición) y venta; EEUU sin cambio no se reescribe
+        p = self.portfolios[0]
+        written = rebalance_holdings({p.id: {self.a_us.id: Decimal("1")}}, date(2022, 2, 16),
+                                     values={p.id: Decimal("550")})
+        self.assertEqual({(h.asset_id, h.quantity) for h in written}, {(self.a_eu.id, Decimal("0"))})
+        self.assertEqual(Trade.objects.get(portfolio=p, trade_date=date(2022, 2, 16)).amount_usd, Decimal("-500.00"))
+
+    def test_missing_prices_are_reported_together(self):
+        from .services import MissingPricesError, bootstrap_initial_holdings_bulk
+        a_jp = Asset.objects.create(name="Japón")
+        InitialWeight.objects.create(portfolio=self.portfolios[0], asset=a_jp, weight=Decimal("0"))
+        a_cl = Asset.objects.create(name="Chile")
+        InitialWeight.objects.create(portfolio=self.portfolios[1], asset=a_cl, weight=Decimal("0.1"))
+        Price.objects.filter(asset=self.a_eu, date=self.t0).delete()
+
+        with self.assertRaises(MissingPricesError) as ctx:
+            bootstrap_initial_holdings_bulk(self.portfolios, self.t0)
+        # Japón tiene peso 0: no necesita precio
+        self.assertEqual(ctx.exception.missing, [("Europa", self.t0), ("Chile", self.t0)])
+        self.assertFalse(Holding.objects.exists())
+
+
+class MetricsCacheTest(TestCase):
+    def setUp(self):
+        from .cache import get_metrics_cache
+        get_metrics_cache().clear()
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.t0 = date(2022, 2, 15)
+        self.p = Portfolio.objects.create(
+            name="Portafolio 1", inception_date=self.t0, initial_value_usd=Decimal("1000"),
+        )
+        for i, d in enumerate((15, 16, 17)):
+            Price.objects.create(asset=self.a_us, date=date(2022, 2, d), price=Decimal("10") + i)
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_us, weight=Decimal("1"))
+        self.url = f"/api/portfolios/{self.p.id}/metrics?fecha_inicio=2022-02-15&fecha_fin=2022-02-17"
+
+    def test_locmem_lru_and_ttl(self):
+        from .cache import LocMemBackend, MetricsCache
+        now = [0.0]
+        cache = MetricsCache(LocMemBackend(max_entries=2, ttl=10, clock=lambda: now[0]))
+        cache.get_or_compute("a", lambda: 1)
+        cache.get_or_compute("b", lambda: 2)
+        cache.get_or_compute("a", lambda: -1)       # hit; "a" pasa a ser el más reciente
+        cache.get_or_compute("c", lambda: 3)        # expulsa "b"
+        self.assertEqual(cache.get_or_compute("b", lambda: 20), 20)
+        now[0] = 11
+        self.assertEqual(cache.get_or_compute("c", lambda: 30), 30)  # expiró
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 5)
+
+    def test_file_backend_roundtrip_and_eviction(self):
+        import tempfile
+        from .cache import FileBackend, MetricsCache
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = MetricsCache(FileBackend(location=tmp, max_entries=1, ttl=60))
+            cache.get_or_compute("a", lambda: {"x": 1})
+            self.assertEqual(cache.get_or_compute("a", lambda: None), {"x": 1})
+            cache.get_or_compute("b", lambda: 2)
+            self.assertEqual(cache.get_or_compute("a", lambda: "recomputed"), "recomputed")
+
+    def test_etag_304_and_version_invalidation(self):
+        from .services import bootstrap_initial_holdings, post_trade_usd_notional
+        bootstrap_initial_holdings(self.p, self.t0)
+
+        first = self.client.get(self.url)
+        etag = first["ETag"]
+        with self.assertNumQueries(1):  # sólo el portfolio
+            res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.content, b"")
+
+        post_trade_usd_notional(self.p, self.a_us, date(2022, 2, 16), Decimal("-55"))
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res["ETag"], etag)
+        self.assertEqual(res.json()["values"][1]["value"], 1000.0 / 10 * 11 - 55)
+
+
+class BulkTradesTest(TestCase):
+    def setUp(self):
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.t0 = date(2022, 2, 15)
+        self.dates = [date(2022, 2, d) for d in (15, 16, 17, 18)]
+        for i, d in enumerate(self.dates):
+            Price.objects.create(asset=self.a_us, date=d, price=Decimal("10") + i)
+            Price.objects.create(asset=self.a_eu, date=d, price=Decimal("3"))
+        self.portfolios = []
+        for name in ("Portafolio 1", "Portafolio 2"):
+            p = Portfolio.objects.create(name=name, inception_date=self.t0, initial_value_usd=Decimal("1000"))
+            InitialWeight.objects.create(portfolio=p, asset=self.a_us, weight=Decimal("0.5"))
+            InitialWeight.objects.create(portfolio=p, asset=self.a_eu, weight=Decimal("0.5"))
+            self.portfolios.append(p)
+
+    def _quantities(self, p):
+        return list(Holding.objects.filter(portfolio=p)
+                    .order_by("asset_id", "effective_from", "id")
+                    .values_list("asset_id", "effective_from", "quantity"))
+
+    def test_bulk_matches_sequential_path(self):
+        from .services import bootstrap_initial_holdings, post_trade_usd_notional, post_trades_bulk
+        p_seq, p_bulk = self.portfolios
+        bootstrap_initial_holdings(p_seq, self.t0)
+        bootstrap_initial_holdings(p_bulk, self.t0)
+        trades = [
+            (self.a_us, self.dates[1], Decimal("-100")),
+            (self.a_eu, self.dates[1], Decimal("100")),
+            (self.a_us, self.dates[2], Decimal("-7.5")),
+            (self.a_us, self.dates[2], Decimal("20")),
+            (self.a_eu, self.dates[3], Decimal("-1")),
+        ]
+        for a, d, amount in trades:
+            post_trade_usd_notional(p_seq, a, d, amount)
+        # desordenado a propósito: el bulk los aplica por fecha
+        result = post_trades_bulk([(p_bulk.id, a.id, d, amount) for a, d, amount in reversed(trades[:2])]
+                                  + [(p_bulk.id, a.id, d, amount) for a, d, amount in trades[2:]])
+        self.assertEqual(result, {"created": 5, "errors": []})
+        self.assertEqual(self._quantities(p_seq), self._quantities(p_bulk))
+        self.assertEqual(list(p_bulk.daily_valuations.order_by("date").values_list("value", flat=True)),
+                         list(p_seq.daily_valuations.order_by("date").values_list("value", flat=True)))
+
+    def test_validation_errors_per_row(self):
+        from .models import Trade
+        from .services import BulkTradeError, bootstrap_initial_holdings, post_trades_bulk
+        p = self.portfolios[0]
+        bootstrap_initial_holdings(p, self.t0)
+        trades = [
+            (p.id, self.a_us.id, self.dates[1], Decimal("10")),
+            (p.id, self.a_us.id, date(2022, 2, 19), Decimal("10")),     # sin precio
+            (p.id, self.a_eu.id, self.dates[1], Decimal("-100000")),    # negativa
+            (self.portfolios[1].id, self.a_us.id, self.dates[1], Decimal("1")),  # sin holdings
+        ]
+        with self.assertRaises(BulkTradeError) as ctx:
+            post_trades_bulk(trades)
+        self.assertEqual([i for i, _ in ctx.exception.errors], [1, 2, 3])
+        self.assertEqual(Trade.objects.count(), 0)
+
+        result = post_trades_bulk(trades, skip_invalid=True)
+        self.assertEqual(result["created"], 1)
+        self.assertEqual(result["errors"][0], (1, "Falta precio para EEUU el 2022-02-19"))
+
+    def test_load_trades_command(self):
+        import io
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from .models import Trade
+        from .services import bootstrap_initial_holdings
+        bootstrap_initial_holdings(self.portfolios[0], self.t0)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "blotter.csv")
+            with open(path, "w") as fh:
+                fh.write("portfolio,asset,date,amount_usd\n")
+                fh.write("Portafolio 1,EEUU,2022-02-16,-50\n")
+                fh.write("Portafolio 1,Narnia,2022-02-16,10\n")
+            err = io.StringIO()
+            call_command("load_trades", path, "--skip-invalid", stdout=io.StringIO(), stderr=err)
+            # sin columna de monto: error, no el id del portafolio como amount_usd
+            with open(path, "w") as fh:
+                fh.write("portfolio,asset,date\n")
+                fh.write(f"{self.portfolios[0].id},EEUU,2022-02-16\n")
+            with self.assertRaisesMessage(CommandError, "Falta la columna amount_usd"):
+                call_command("load_trades", path, stdout=io.StringIO())
+        self.assertEqual(Trade.objects.count(), 1)
+        self.assertIn("fila 3: Asset desconocido: Narnia", err.getvalue())
+
+
+class LoadDatosStreamTest(TestCase):
+    def _workbook(self, tmp, prices=None):
+        import os
+        import pandas as pd
+        path = os.path.join(tmp, "datos.xlsx")
+        prices = pd.DataFrame(prices or {
+            "Dates": pd.to_datetime(["2022-02-15", "2022-02-16", "2022-02-17"]),
+            "EEUU": [9383.57, 9393.09, 9195.35],
+            "Europa": [66.03, 66.25, None],
+        })
+        weights = pd.DataFrame({"activos": ["EEUU", "Europa"], "portafolio 1": [0.6, 0.4], "portafolio 2": [0.5, 0.5]})
+        with pd.ExcelWriter(path) as xw:
+            weights.to_excel(xw, sheet_name="Weights", index=False)
+            prices.to_excel(xw, sheet_name="Precios", index=False)
+        return path
+
+    def test_rerun_all_portfolios_values_each_portfolio_once(self):
+        import io
+        import tempfile
+        import pandas as pd
+        from unittest import mock
+        from django.core.management import call_command
+        from . import services
+        from .models import PortfolioDailyValuation
+        with tempfile.TemporaryDirectory() as tmp:
+            call_command("load_datos", self._workbook(tmp), "2022-02-15", "1000", "--all-portfolios",
+                         stdout=io.StringIO())
+            path = self._workbook(tmp, {
+                "Dates": pd.to_datetime(["2022-02-15", "2022-02-16", "2022-02-17", "2022-02-18"]),
+                "EEUU": [9383.57, 9393.09, 9195.35, 9200.0],
+                "Europa": [66.03, 66.25, 65.5, 65.0],
+            })
+            with mock.patch.object(services, "refresh_daily_valuations",
+                                   wraps=services.refresh_daily_valuations) as refresh:
+                call_command("load_datos", path, "2022-02-15", "1000", "--all-portfolios", "--incremental",
+                             stdout=io.StringIO())
+        # el receiver de prices_changed no los refresca: sólo la pasada en bloque desde t0
+        self.assertEqual(sorted(c.args[0].name for c in refresh.call_args_list), ["Portafolio 1", "Portafolio 2"])
+        self.assertEqual(PortfolioDailyValuation.objects.filter(date=date(2022, 2, 18)).count(), 2)
+
+    def test_stream_mode_loads_same_prices_in_chunks(self):
+        import io
+        import tempfile
+        from django.core.management import call_command
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self._workbook(tmp)
+            call_command("load_datos", path, "2022-02-15", "1000", "Portafolio 1",
+                         "--stream", "--chunk-size", "2", stdout=io.StringIO())
+        rows = list(Price.objects.order_by("asset__name", "date").values_list("asset__name", "date", "price"))
+        self.assertEqual(rows, [
+            ("EEUU", date(2022, 2, 15), Decimal("9383.57")),
+            ("EEUU", date(2022, 2, 16), Decimal("9393.09")),
+            ("EEUU", date(2022, 2, 17), Decimal("9195.35")),
+            ("Europa", date(2022, 2, 15), Decimal("66.03")),
+            ("Europa", date(2022, 2, 16), Decimal("66.25")),
+        ])
+        self.assertEqual(Holding.objects.count(), 2)
+
+    def test_incremental_mode_upserts_and_reports_counts(self):
+        import io
+        import tempfile
+        import pandas as pd
+        from django.core.management import call_command
+        from .models import PortfolioDailyValuation
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self._workbook(tmp)
+            call_command("load_datos", path, "2022-02-15", "1000", "Portafolio 1", stdout=io.StringIO())
+            v_before = PortfolioDailyValuation.objects.get(date=date(2022, 2, 15)).value
+            path = self._workbook(tmp, {
+                "Dates": pd.to_datetime(["2022-02-15", "2022-02-16", "2022-02-17", "2022-02-18"]),
+                "EEUU": [9383.57, 9400.00, 9195.35, 9200.0],   # corrige el 16, agrega el 18
+                "Europa": [66.03, 66.25, 65.5, 65.0],          # rellena el hueco del 17, agrega el 18
+            })
+            out = io.StringIO()
+            for stream in ([], ["--stream", "--chunk-size", "3"]):
+                call_command("load_datos", path, "2022-02-15", "1000", "Portafolio 1",
+                             "--incremental", *stream, stdout=out)
+        lines = [l for l in out.getvalue().splitlines() if l.startswith("Precios:")]
+        self.assertEqual(lines[0], "Precios: 3 insertados, 1 actualizados, 4 sin cambios.")
+        self.assertEqual(lines[1], "Precios: 0 insertados, 0 actualizados, 8 sin cambios.")
+        self.assertEqual(Price.objects.get(asset__name="EEUU", date=date(2022, 2, 16)).price, Decimal("9400"))
+        self.assertEqual(PortfolioDailyValuation.objects.get(date=date(2022, 2, 15)).value, v_before)
+        self.assertTrue(PortfolioDailyValuation.objects.filter(date=date(2022, 2, 18)).exists())
+
+    def test_prices_changed_since(self):
+        from django.utils import timezone
+        from .selectors import get_prices_changed_since
+        a = Asset.objects.create(name="EEUU")
+        Price.objects.create(asset=a, date=date(2022, 2, 15), price=Decimal("1"))
+        mark = timezone.now()
+        Price.objects.create(asset=a, date=date(2022, 2, 17), price=Decimal("1"))
+        Price.objects.create(asset=a, date=date(2022, 2, 16), price=Decimal("1"))
+        self.assertEqual(get_prices_changed_since(mark), {a.id: date(2022, 2, 16)})
+
+    def test_all_portfolios_loads_workbook_once(self):
+        import io
+        import tempfile
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from .models import PortfolioDailyValuation
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self._workbook(tmp)
+            out = io.StringIO()
+            with self.assertRaisesMessage(CommandError, "Indique portfolio_name o use --all-portfolios."):
+                call_command("load_datos", path, "2022-02-15", "1000", stdout=out)
+            call_command("load_datos", path, "2022-02-15", "1000", "--all-portfolios", stdout=out)
+        self.assertEqual(sorted(Portfolio.objects.values_list("name", flat=True)), ["Portafolio 1", "Portafolio 2"])
+        self.assertEqual(Price.objects.count(), 5)
+        self.assertEqual(InitialWeight.objects.count(), 4)
+        p2 = Portfolio.objects.get(name="Portafolio 2")
+        holdings = {h.asset.name: h.quantity for h in Holding.objects.filter(portfolio=p2).select_related("asset")}
+        self.assertEqual(holdings, {"EEUU": Decimal("0.053284624082"), "Europa": Decimal("7.572315614114")})
+        self.assertEqual(PortfolioDailyValuation.objects.filter(portfolio=p2).count(), 3)
+        self.assertIn("para 2 portafolios", out.getvalue())
+
+
+class RefreshManyTest(TestCase):
+    def setUp(self):
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.t0 = date(2022, 2, 15)
+        self.p = Portfolio.objects.create(name="Portafolio 1", inception_date=self.t0, initial_value_usd=Decimal("1000"))
+        for i, d in enumerate(date(2022, 2, day) for day in (15, 16, 17, 18)):
+            Price.objects.create(asset=self.a_us, date=d, price=Decimal("10") + i)
+            Price.objects.create(asset=self.a_eu, date=d, price=Decimal("20"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_us, weight=Decimal("0.5"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_eu, weight=Decimal("0.5"))
+
+    def test_refresh_many_through_the_process_pool(self):
+        from types import SimpleNamespace
+        from unittest import mock
+        from . import services
+        from .models import PortfolioDailyValuation
+
+        class InlinePool:
+            # mismo contrato que ProcessPoolExecutor, en este proceso: los hijos no verían la DB de tests en memoria
+            def __init__(self, max_workers, initializer):
+                self.max_workers = max_workers
+                initializer()
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def map(self, fn, *iterables):
+                return list(map(fn, *iterables))
+
+        p2 = Portfolio.objects.create(name="Portafolio 2", inception_date=self.t0, initial_value_usd=Decimal("2000"))
+        InitialWeight.objects.create(portfolio=p2, asset=self.a_us, weight=Decimal("1"))
+        for p in (self.p, p2):
+            services.bootstrap_initial_holdings(p, self.t0)
+        PortfolioDailyValuation.objects.all().delete()
+
+        self.assertEqual(services._refresh_chunk([p2.id], None), {p2.id: 4})
+        PortfolioDailyValuation.objects.all().delete()
+        with mock.patch.object(services, "connection", SimpleNamespace(vendor="postgresql")), \
+                mock.patch.object(services, "ProcessPoolExecutor", InlinePool):
+            result = services.refresh_daily_valuations_many([self.p.id, p2.id], workers=4)
+        self.assertEqual(result, {self.p.id: 4, p2.id: 4})
+        self.assertEqual(PortfolioDailyValuation.objects.get(portfolio=p2, date=date(2022, 2, 18)).value, Decimal("2600"))
+        self.assertEqual(PortfolioDailyValuation.objects.filter(portfolio=self.p).count(), 4)
+
+
+class PriceArraysTest(TestCase):
+    def test_typed_fetch_builds_the_price_matrix(self):
+        import numpy as np
+        from .arrays import PriceArrays
+        from .selectors import get_price_frame
+        a, b = Asset.objects.create(name="A"), Asset.objects.create(name="B")
+        d1, d2 = date(2022, 1, 3), date(2022, 1, 4)
+        Price.objects.bulk_create([Price(asset=a, date=d1, price=Decimal("10.5")),
+                                   Price(asset=b, date=d2, price=Decimal("2.25")),
+                                   Price(asset=a, date=d2, price=Decimal("11"))])
+        arrays = PriceArrays.from_queryset(Price.objects.all())
+        self.assertEqual((arrays.dates.dtype, arrays.asset_ids.dtype, arrays.prices.dtype),
+                         (np.dtype(np.intc), np.dtype(np.intc), np.dtype(np.float64)))
+        px = get_price_frame([a.id, b.id], d1, d2)
+        self.assertEqual(list(px.index), [d1, d2])
+        self.assertEqual(list(px.columns), [a.id, b.id])
+        np.testing.assert_array_equal(px.to_numpy(), [[10.5, np.nan], [11.0, 2.25]])
+
+        # scatter sobre ejes fijos: filas fuera de los ejes se ignoran
+        out = np.full((1, 1), np.nan)
+        self.assertEqual(arrays.scatter(out, np.array([d2.toordinal()]), np.array([b.id])), 1)
+        self.assertEqual(out[0, 0], 2.25)
+
+
+class PriceStoreTest(TestCase):
+    def setUp(self):
+        import tempfile
+        from django.test import override_settings
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        settings_ctx = override_settings(PORTFOLIOS_PRICE_STORE={"ENABLED": True, "LOCATION": self.tmp.name})
+        settings_ctx.enable()
+        self.addCleanup(settings_ctx.disable)
+
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.t0 = date(2022, 2, 15)
+        self.p = Portfolio.objects.create(name="Portafolio 1", inception_date=self.t0, initial_value_usd=Decimal("1000"))
+        for i, d in enumerate(date(2022, 2, day) for day in (15, 16, 17, 18)):
+            Price.objects.create(asset=self.a_us, date=d, price=Decimal("10") + i)
+            if d != date(2022, 2, 17):
+                Price.objects.create(asset=self.a_eu, date=d, price=Decimal("20"))
+        Holding.objects.create(portfolio=self.p, asset=self.a_us, quantity=Decimal("60"), effective_from=self.t0)
+        Holding.objects.create(portfolio=self.p, asset=self.a_eu, quantity=Decimal("20"), effective_from=self.t0)
+
+    def test_snapshot_matches_db_without_price_query(self):
+        import numpy as np
+        from django.test import override_settings
+        from .pricestore import get_price_store
+        from .selectors import compute_timeseries_weights_and_value
+        start, end = self.t0, date(2022, 2, 18)
+        with override_settings(PORTFOLIOS_PRICE_STORE={"ENABLED": False}):
+            expected = compute_timeseries_weights_and_value(self.p, start, end, exact=False)
+
+        snap = get_price_store().rebuild()
+        with self.assertNumQueries(1):  # sólo los tramos
+            got = compute_timeseries_weights_and_value(self.p, start, end, exact=False)
+        self.assertEqual(got, expected)
+        px = get_price_store().frame(date(2022, 2, 16), date(2022, 2, 17))
+        self.assertEqual(list(px.index), [date(2022, 2, 16), date(2022, 2, 17)])
+        self.assertTrue(np.shares_memory(px.to_numpy(), snap.prices))  # vista sobre el mmap
+
+    def test_prices_changed_appends_and_edits_invalidate(self):
+        from .pricestore import get_price_store
+        from .signals import prices_changed
+        store = get_price_store()
+        first = store.rebuild()
+
+        d = date(2022, 2, 21)
+        Price.objects.bulk_create([Price(asset=self.a_us, date=d, price=Decimal("15"))])  # sin post_save
+        prices_changed.send(sender=None, changes={self.a_us.id: d})
+        snap = store.snapshot()
+        self.assertNotEqual(snap.name, first.name)
+        self.assertEqual(snap.date_index[-1], d)
+        self.assertEqual(store.frame(d, d).loc[d, self.a_us.id], 15.0)
+
+        Price.objects.filter(asset=self.a_us, date=d).get().delete()
+        self.assertIsNone(store.snapshot())
+
+
+class HoldingsIndexTest(TestCase):
+    def setUp(self):
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.p = Portfolio.objects.create(
+            name="Portafolio 1", inception_date=date(2022, 1, 3), initial_value_usd=Decimal("1000"),
+        )
+        Holding.objects.create(portfolio=self.p, asset=self.a_eu, quantity=Decimal("5"), effective_from=date(2022, 1, 3))
+        # historia larga de trades en EEUU: un tramo por día, qty = día del año
+        Holding.objects.bulk_create([
+            Holding(portfolio=self.p, asset=self.a_us, quantity=Decimal(i), effective_from=date.fromordinal(date(2022, 1, 1).toordinal() + i))
+            for i in range(2, 300)
+        ])
+        # dos tramos el mismo día: gana el último creado
+        Holding.objects.create(portfolio=self.p, asset=self.a_us, quantity=Decimal("999"), effective_from=date(2022, 6, 1))
+
+    def test_get_holdings_at(self):
+        from .selectors import get_holdings_at
+        with self.assertNumQueries(1):
+            self.assertEqual(get_holdings_at(self.p, date(2022, 3, 1)), {self.a_us.id: Decimal("59"), self.a_eu.id: Decimal("5")})
+        self.assertEqual(get_holdings_at(self.p, date(2022, 6, 1))[self.a_us.id], Decimal("999"))
+        self.assertEqual(get_holdings_at(self.p, date(2022, 1, 2)), {})
+
+    def test_tranches_are_narrowed_to_range(self):
+        from .selectors import get_holding_tranches
+        tranches = get_holding_tranches(self.p, date(2022, 3, 5), start=date(2022, 3, 1))
+        self.assertEqual(tranches[0], (self.a_eu.id, date(2022, 1, 3), Decimal("5")))
+        self.assertEqual(tranches[1], (self.a_us.id, date(2022, 3, 1), Decimal("59")))
+        self.assertEqual(len(tranches), 6)
+
+    def test_index_quantities_at_many_dates(self):
+        from .selectors import HoldingsIndex
+        index = HoldingsIndex.for_portfolio(self.p, date(2022, 12, 31))
+        dates = [date(2022, 1, 2), date(2022, 1, 3), date(2022, 6, 1), date(2022, 12, 31)]
+        m = index.quantities_at(dates, [self.a_us.id, self.a_eu.id])
+        self.assertTrue((m[0] != m[0]).all())  # NaN: nada vigente aún
+        self.assertEqual(m[1].tolist(), [2.0, 5.0])
+        self.assertEqual(m[2].tolist(), [999.0, 5.0])
+        self.assertEqual(m[3].tolist(), [299.0, 5.0])
+        self.assertEqual(index.quantity_at(self.a_us.id, date(2022, 6, 1)), Decimal("999"))
+        self.assertIsNone(index.quantity_at(self.a_eu.id, date(2021, 1, 1)))
+
+
+class BatchMetricsApiTest(TestCase):
+    def setUp(self):
+        self.assets = [Asset.objects.create(name=n) for n in ("EEUU", "Europa", "UK")]
+        self.t0 = date(2022, 2, 15)
+        self.dates = [date(2022, 2, d) for d in (15, 16, 17)]
+        for i, d in enumerate(self.dates):
+            for j, a in enumerate(self.assets):
+                Price.objects.create(asset=a, date=d, price=Decimal(10 * (j + 1) + i))
+        self.portfolios = []
+        for k, held in enumerate((self.assets[:2], self.assets[1:])):
+            p = Portfolio.objects.create(name=f"Portafolio {k + 1}", inception_date=self.t0, initial_value_usd=Decimal("1000"))
+            for a in held:
+                Holding.objects.create(portfolio=p, asset=a, quantity=Decimal(k + 2), effective_from=self.t0)
+            self.portfolios.append(p)
+        Holding.objects.create(portfolio=self.portfolios[0], asset=self.assets[0], quantity=Decimal("7"), effective_from=self.dates[1])
+
+    def test_batch_matches_single_portfolio_series(self):
+        from .api.views import format_series
+        from .selectors import compute_timeseries_weights_and_value
+        url = "/api/portfolios/metrics?ids=all&fecha_inicio=2022-02-15&fecha_fin=2022-02-17"
+        with self.assertNumQueries(4):  # portafolios + holdings + precios + nombres
+            res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        body = res.json()["portfolios"]
+        self.assertEqual([p["id"] for p in body], [p.id for p in self.portfolios])
+        names = {a.id: a.name for a in self.assets}
+        for p, got in zip(self.portfolios, body):
+            expected = format_series(*compute_timeseries_weights_and_value(p, self.dates[0], self.dates[-1]), names)
+            self.assertEqual([v["value"] for v in got["values"]], [v["value"] for v in expected["values"]])
+            self.assertEqual([w["weights"] for w in got["weights"]], [w["weights"] for w in expected["weights"]])
+
+    def test_batch_subset_and_validation(self):
+        res = self.client.get(f"/api/portfolios/metrics?ids={self.portfolios[1].id}&fecha_inicio=2022-02-15&fecha_fin=2022-02-17")
+        self.assertEqual([p["name"] for p in res.json()["portfolios"]], ["Portafolio 2"])
+        res = self.client.get("/api/portfolios/metrics?ids=a,b&fecha_inicio=2022-02-15&fecha_fin=2022-02-17")
+        self.assertEqual(res.status_code, 400)
+
+
+class MetricsOutputFormatsTest(TestCase):
+    def setUp(self):
+        from .cache import get_metrics_cache
+        get_metrics_cache().clear()
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.p = Portfolio.objects.create(name="Portafolio 1", inception_date=date(2022, 2, 15), initial_value_usd=Decimal("1000"))
+        for i, d in enumerate((15, 16, 17)):
+            Price.objects.create(asset=self.a_us, date=date(2022, 2, d), price=Decimal("10") + i)
+            if d != 16:
+                Price.objects.create(asset=self.a_eu, date=date(2022, 2, d), price=Decimal("5"))
+        Holding.objects.create(portfolio=self.p, asset=self.a_us, quantity=Decimal("10"), effective_from=date(2022, 2, 15))
+        Holding.objects.create(portfolio=self.p, asset=self.a_eu, quantity=Decimal("20"), effective_from=date(2022, 2, 15))
+        self.url = f"/api/portfolios/{self.p.id}/metrics?fecha_inicio=2022-02-15&fecha_fin=2022-02-17"
+
+    def test_columnar(self):
+        body = self.client.get(self.url + "&output=columnar").json()
+        self.assertEqual(body["dates"], ["2022-02-15", "2022-02-16", "2022-02-17"])
+        self.assertEqual(body["values"], [200.0, 110.0, 220.0])
+        self.assertEqual(body["weights"], {"EEUU": [0.5, 1.0, 120 / 220], "Europa": [0.5, None, 100 / 220]})
+
+    def test_ndjson_streaming(self):
+        import json
+        res = self.client.get(self.url + "&output=ndjson")
+        self.assertTrue(res.streaming)
+        self.assertEqual(res["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in b"".join(res.streaming_content).decode().splitlines()]
+        self.assertEqual(rows[1], {"date": "2022-02-16", "value": 110.0, "weights": {"EEUU": 1.0}})
+
+    def test_ndjson_first_rows_go_out_before_the_whole_range_is_valued(self):
+        import json
+        from unittest import mock
+        from .api import views
+        Price.objects.create(asset=self.a_us, date=date(2022, 11, 2), price=Decimal("20"))
+        url = f"/api/portfolios/{self.p.id}/metrics?fecha_inicio=2022-01-01&fecha_fin=2022-12-31&output=ndjson"
+        with mock.patch.object(views, "load_series", wraps=views.load_series) as load_series:
+            res = self.client.get(url + "&assets=ids")
+            self.assertEqual(load_series.call_count, 0)  # nada se valoriza antes de empezar a enviar
+            chunks = iter(res.streaming_content)
+            self.assertEqual(json.loads(next(chunks))["assets"], {str(self.a_us.id): "EEUU", str(self.a_eu.id): "Europa"})
+            self.assertEqual(load_series.call_count, 1)  # sólo la primera ventana (enero-marzo)
+            rows = [json.loads(line) for line in b"".join(chunks).decode().splitlines()]
+            self.assertEqual(load_series.call_count, 4)
+        self.assertEqual([r["date"] for r in rows], ["2022-02-15", "2022-02-16", "2022-02-17", "2022-11-02"])
+        self.assertEqual(rows[-1]["weights"], {str(self.a_us.id): 1.0})  # sin leyenda repetida
+        full = self.client.get(url.replace("ndjson", "columnar")).json()
+        self.assertEqual([r["value"] for r in rows], full["values"])
+
+    def test_arrow_and_parquet(self):
+        import io
+        from .api.formats import pyarrow_available
+        if not pyarrow_available():
+            self.assertEqual(self.client.get(self.url + "&output=arrow").status_code, 406)
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        res = self.client.get(self.url + "&output=arrow")
+        table = pa.ipc.open_stream(res.content).read_all()
+        self.assertEqual(table.column_names, ["date", "value", "EEUU", "Europa"])
+        self.assertEqual(table.column("value").to_pylist(), [200.0, 110.0, 220.0])
+        res = self.client.get(self.url + "&output=parquet")
+        self.assertEqual(pq.read_table(io.BytesIO(res.content)).num_rows, 3)
+
+    def test_compression_negotiation_keeps_weak_etag_revalidation(self):
+        import gzip
+        import json
+        from .middleware import brotli
+        url = self.url + "&output=json"  # > 200 bytes: comprimible
+        res = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(res["Content-Encoding"], "gzip")
+        self.assertEqual(len(json.loads(gzip.decompress(res.content))["values"]), 3)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=res["ETag"]).status_code, 304)
+        if brotli is not None:
+            res = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, br")
+            self.assertEqual(res["Content-Encoding"], "br")
+            self.assertEqual(len(json.loads(brotli.decompress(res.content))["values"]), 3)
+
+    def test_invalid_output(self):
+        self.assertEqual(self.client.get(self.url + "&output=xml").status_code, 400)
+
+
+class SamplingTest(TestCase):
+    def setUp(self):
+        import pandas as pd
+        from .cache import get_metrics_cache
+        get_metrics_cache().clear()
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.dates = [d.date() for d in pd.bdate_range("2022-01-03", "2022-03-31")]
+        self.p = Portfolio.objects.create(name="P", inception_date=self.dates[0], initial_value_usd=Decimal("1000"))
+        Price.objects.bulk_create([
+            Price(asset=self.a_us, date=d, price=Decimal("10") + Decimal(i % 7)) for i, d in enumerate(self.dates)
+        ])
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_us, weight=Decimal("1"))
+        self.url = f"/api/portfolios/{self.p.id}/metrics?fecha_inicio=2022-01-01&fecha_fin=2022-03-31"
+
+    def test_lttb_and_period_ends(self):
+        import numpy as np
+        from .sampling import lttb_indices, period_last_indices
+        x = np.arange(100, dtype=float)
+        y = np.zeros(100)
+        y[37] = 5.0  # el pico sobrevive al downsampling
+        idx = lttb_indices(x, y, 10)
+        self.assertEqual(len(idx), 10)
+        self.assertEqual((idx[0], idx[-1]), (0, 99))
+        self.assertIn(37, idx)
+        month_ends = [self.dates[i] for i in period_last_indices(self.dates, "monthly")]
+        self.assertEqual(month_ends, [date(2022, 1, 31), date(2022, 2, 28), date(2022, 3, 31)])
+
+    def test_metrics_freq_and_max_points(self):
+        from django.test import override_settings
+        from .services import bootstrap_initial_holdings
+        bootstrap_initial_holdings(self.p, self.dates[0])
+
+        # portfolio + (fecha, V_t) del rango + weights de las fechas elegidas + nombres
+        with self.assertNumQueries(4):
+            body = self.client.get(self.url + "&freq=weekly").json()
+        self.assertEqual(len(body["values"]), 13)
+        self.assertEqual(body["values"][0]["date"], "2022-01-07")  # viernes de la primera semana
+
+        body = self.client.get(self.url + "&max_points=20&output=columnar").json()
+        self.assertEqual(len(body["dates"]), 20)
+        self.assertEqual((body["dates"][0], body["dates"][-1]), ("2022-01-03", "2022-03-31"))
+        self.assertEqual(len(body["weights"]["EEUU"]), 20)
+
+        # sin freq/max_points la serie no se muestrea; un tope configurado aplica igual
+        body = self.client.get(self.url + "&output=columnar").json()
+        self.assertEqual(body["dates"], [d.isoformat() for d in self.dates])
+        with override_settings(PORTFOLIOS_METRICS_MAX_POINTS=10):
+            self.assertEqual(len(self.client.get(self.url + "&output=columnar").json()["dates"]), 10)
+            self.assertEqual(len(self.client.get(self.url + "&max_points=20&output=columnar").json()["dates"]), 10)
+
+        self.assertEqual(self.client.get(self.url + "&freq=hourly").status_code, 400)
+        self.assertEqual(self.client.get(self.url + "&max_points=2").status_code, 400)
+
+
+class AnalyticsApiTest(TestCase):
+    def setUp(self):
+        from .cache import get_metrics_cache
+        get_metrics_cache().clear()
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.dates = [date(2022, 2, d) for d in (15, 16, 17, 18)]
+        self.p = Portfolio.objects.create(name="P", inception_date=self.dates[0], initial_value_usd=Decimal("1000"))
+        for d, px in zip(self.dates, (10, 11, 12, 11)):
+            Price.objects.create(asset=self.a_us, date=d, price=Decimal(px))
+            Price.objects.create(asset=self.a_eu, date=d, price=Decimal("20"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_us, weight=Decimal("0.5"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_eu, weight=Decimal("0.5"))
+        self.url = f"/api/portfolios/{self.p.id}/analytics?fecha_inicio=2022-02-15&fecha_fin=2022-02-18&window=2"
+
+    def test_time_weighted_returns_drawdown_and_contribution(self):
+        from .services import bootstrap_initial_holdings, post_trade_usd_notional
+        bootstrap_initial_holdings(self.p, self.dates[0])
+        # compra de 10 EEUU el 17: es un aporte, no rentabilidad
+        post_trade_usd_notional(self.p, self.a_us, self.dates[2], Decimal("120"))
+
+        with self.assertNumQueries(4):
+            res = self.client.get(self.url)
+        body = res.json()
+        returns = [row["return"] for row in body["series"]]
+        for got, expected in zip(returns, (0.05, 1100 / 1050 - 1, 1160 / 1220 - 1)):
+            self.assertAlmostEqual(got, expected, places=12)
+        self.assertIsNone(body["series"][0]["volatility"])  # ventana de 2 retornos aún incompleta
+        self.assertIsNotNone(body["series"][1]["volatility"])
+        summary = body["summary"]
+        self.assertAlmostEqual(summary["max_drawdown"], 1160 / 1220 - 1, places=12)
+        self.assertEqual((summary["max_drawdown_peak"], summary["max_drawdown_trough"]), ("2022-02-17", "2022-02-18"))
+        self.assertAlmostEqual(sum(body["contribution"].values()), sum(returns), places=12)
+        self.assertEqual(body["contribution"]["Europa"], 0.0)
+
+        # cacheado junto a /metrics: el ETag sirve para 304 y cambia con los datos
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=res["ETag"]).status_code, 304)
+        self.assertEqual(self.client.get(self.url.replace("window=2", "window=1")).status_code, 400)
+
+
+class SimulateApiTest(TestCase):
+    def setUp(self):
+        from .services import bootstrap_initial_holdings
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.dates = [date(2022, 2, d) for d in (15, 16, 17, 18)]
+        self.p = Portfolio.objects.create(name="P", inception_date=self.dates[0], initial_value_usd=Decimal("1000"))
+        for d, px in zip(self.dates, (10, 11, 12, 11)):
+            Price.objects.create(asset=self.a_us, date=d, price=Decimal(px))
+            Price.objects.create(asset=self.a_eu, date=d, price=Decimal("20"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_us, weight=Decimal("0.5"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_eu, weight=Decimal("0.5"))
+        bootstrap_initial_holdings(self.p, self.dates[0])
+        self.url = f"/api/portfolios/{self.p.id}/simulate"
+
+    def _post(self, scenarios, **extra):
+        body = {"fecha_inicio": "2022-02-15", "fecha_fin": "2022-02-18", "scenarios": scenarios, **extra}
+        return self.client.post(self.url, body, content_type="application/json")
+
+    def test_scenarios_match_posting_the_trades_without_writing(self):
+        from .models import Trade
+        from .selectors import compute_timeseries_weights_and_value
+        from .services import post_trade_usd_notional
+        switch = [{"asset": "EEUU", "date": "2022-02-17", "amount_usd": "-120"},
+                  {"asset": "Europa", "date": "2022-02-17", "amount_usd": "120"}]
+        with self.assertNumQueries(4):  # portfolio + assets + tramos + precios
+            res = self._post([
+                {"name": "switch", "trades": switch},
+                {"name": "shock", "price_overrides": [{"asset": "EEUU", "date": "2022-02-18", "price": "5"}]},
+            ])
+        self.assertEqual(res.status_code, 200)
+        body = res.json()
+        self.assertEqual(Holding.objects.filter(portfolio=self.p).count(), 2)
+        self.assertFalse(Trade.objects.exists())
+        self.assertEqual([v["value"] for v in body["base"]["values"]], [1000.0, 1050.0, 1100.0, 1050.0])
+        self.assertEqual(body["scenarios"]["shock"]["values"][-1]["value"], 50 * 5 + 25 * 20)
+
+        post_trade_usd_notional(self.p, self.a_us, self.dates[2], Decimal("-120"))
+        post_trade_usd_notional(self.p, self.a_eu, self.dates[2], Decimal("120"))
+        _, v_real = compute_timeseries_weights_and_value(self.p, self.dates[0], self.dates[-1], exact=False)
+        simulated = [v["value"] for v in body["scenarios"]["switch"]["values"]]
+        for got, expected in zip(simulated, v_real.values()):
+            self.assertAlmostEqual(got, expected, places=6)
+
+    def test_invalid_trades_are_reported_per_scenario(self):
+        res = self._post([{"name": "oversell", "trades": [{"asset": "EEUU", "date": "2022-02-16", "amount_usd": "-5000"}]}])
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json()["errors"]["oversell"][0]["error"], "La cantidad resultante quedaría negativa.")
+        res = self._post([{"name": "x", "trades": [{"asset": "Japón", "date": "2022-02-16", "amount_usd": "1"}]}])
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self._post([{"name": "base"}]).status_code, 400)
+
+    def test_price_override_on_a_date_without_prices_is_rejected(self):
+        # 2022-02-19 no tiene precios: una fila nueva dejaría a Europa sin precio ese día
+        res = self._post([
+            {"name": "ok", "price_overrides": [{"asset": "EEUU", "date": "2022-02-18", "price": "5"}]},
+            {"name": "weekend", "price_overrides": [{"asset": "EEUU", "date": "2022-02-19", "price": "5"}]},
+        ], fecha_fin="2022-02-20")
+        self.assertEqual(res.status_code, 400)
+        errors = res.json()["errors"]
+        self.assertEqual(list(errors), ["weekend"])
+        self.assertEqual(errors["weekend"][0]["price_override"], 0)
+        self.assertIn("2022-02-19", errors["weekend"][0]["error"])
+
+
+class PricePartitionsTest(TestCase):
+    def test_noop_outside_postgresql(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from .partitions import ensure_price_partitions, partition_name
+        self.assertEqual(partition_name(2024), "portfolios_price_y2024")
+        with self.assertNumQueries(0):
+            self.assertEqual(ensure_price_partitions(date(2020, 1, 1), date(2030, 1, 1)), [])
+        with self.assertRaises(CommandError):
+            call_command("price_partitions")
+
+    @skipUnless(connection.vendor == "postgresql", "particiones sólo en PostgreSQL")
+    def test_migration_partitions_price_with_covering_unique(self):
+        from .partitions import DEFAULT_PARTITION, is_partitioned, partition_name, price_partitions
+        self.assertTrue(is_partitioned())
+        partitions = price_partitions()
+        self.assertIn(DEFAULT_PARTITION, partitions)
+        self.assertIn(partition_name(date.today().year + 1), partitions)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = %s", ["portfolios_price_asset_date_uniq"])
+            self.assertIn("(asset_id, date) INCLUDE (price)", cursor.fetchone()[0])
+            cursor.execute("SELECT count(*) FROM pg_indexes WHERE tablename = 'portfolios_price'")
+            self.assertEqual(cursor.fetchone()[0], 3)  # PK (id, date), UNIQUE ... INCLUDE y date
+
+    @skipUnless(connection.vendor == "postgresql", "particiones sólo en PostgreSQL")
+    def test_new_partition_takes_rows_from_default(self):
+        from .partitions import DEFAULT_PARTITION, ensure_price_partitions, partition_name
+
+        def rows(table):
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT count(*) FROM {table} WHERE date >= '2100-01-01'")
+                return cursor.fetchone()[0]
+        a = Asset.objects.create(name="EEUU")
+        Price.objects.create(asset=a, date=date(2100, 3, 1), price=Decimal("10"))
+        connection.check_constraints()  # dispara los FK diferidos: ALTER TABLE no acepta eventos pendientes
+        self.assertEqual(rows(DEFAULT_PARTITION), 1)
+
+        self.assertEqual(ensure_price_partitions(date(2100, 1, 1), date(2100, 12, 31)), [partition_name(2100)])
+        self.assertEqual((rows(DEFAULT_PARTITION), rows(partition_name(2100))), (0, 1))
+        self.assertEqual(ensure_price_partitions(date(2100, 1, 1), date(2100, 12, 31)), [])  # idempotente
+        self.assertEqual(Price.objects.get(asset=a).price, Decimal("10"))
+
+    @skipUnless(connection.vendor == "postgresql", "particiones sólo en PostgreSQL")
+    def test_copy_merge_and_upsert_against_covering_unique(self):
+        import pandas as pd
+        from .etl import upsert_prices, write_prices
+        from .partitions import partition_name, price_partitions
+        a = Asset.objects.create(name="EEUU")
+        long = pd.DataFrame({"date": [date(2101, 1, 3), date(2101, 1, 4)], "asset": ["EEUU"] * 2, "price": [10.0, 11.0]})
+        self.assertEqual(write_prices(long, {"EEUU": a.id}), 2)  # crea la partición y hace COPY + ON CONFLICT
+        self.assertIn(partition_name(2101), price_partitions())
+        write_prices(long, {"EEUU": a.id})  # repetida: ON CONFLICT DO NOTHING
+        self.assertEqual(Price.objects.filter(asset=a).count(), 2)
+
+        counts, changes = upsert_prices(long.assign(price=[10.0, 12.0]), {"EEUU": a.id}, {a.id: date(2101, 1, 4)})
+        self.assertEqual(counts, {"inserted": 0, "updated": 1, "unchanged": 1})
+        self.assertEqual(changes, {a.id: date(2101, 1, 4)})
+        self.assertEqual(list(Price.objects.filter(asset=a).order_by("date").values_list("price", flat=True)),
+                         [Decimal("10"), Decimal("12")])
+
+
+class BacktestTest(TestCase):
+    def setUp(self):
+        import pandas as pd
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.dates = [d.date() for d in pd.bdate_range("2022-01-03", "2022-03-31")]
+        self.p = Portfolio.objects.create(name="P", inception_date=self.dates[0], initial_value_usd=Decimal("1000"))
+        Price.objects.bulk_create(
+            [Price(asset=self.a_us, date=d, price=Decimal("10") + Decimal(i) / 10) for i, d in enumerate(self.dates)]
+            + [Price(asset=self.a_eu, date=d, price=Decimal("20")) for d in self.dates]
+        )
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_us, weight=Decimal("0.5"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_eu, weight=Decimal("0.5"))
+
+    def test_monthly_rebalance_matches_posting_the_implied_trades(self):
+        from .backtest import backtest
+        from .selectors import compute_timeseries_weights_and_value
+        from .services import bootstrap_initial_holdings, post_trades_bulk
+
+        result = backtest(self.p, "monthly")
+        self.assertEqual(result["rebalances"], [date(2022, 1, 31), date(2022, 2, 28)])
+        self.assertEqual(result["summary"]["rebalances"], 2)
+        for d in result["rebalances"]:  # autofinanciado: compras = ventas
+            self.assertAlmostEqual(sum(a for t, _, a in result["trades"] if t == d), 0, places=9)
+
+        bootstrap_initial_holdings(self.p, self.dates[0])
+        post_trades_bulk([(self.p.id, a_id, d, Decimal(f"{amount:.2f}")) for d, a_id, amount in result["trades"]])
+        _, v_real = compute_timeseries_weights_and_value(self.p, self.dates[0], self.dates[-1], exact=False)
+        self.assertEqual(list(v_real), list(result["values"].index))
+        for got, expected in zip(result["values"], v_real.values()):
+            self.assertAlmostEqual(got, expected, delta=0.05)  # montos redondeados a centavos
+
+    def test_threshold_and_parallel_sweep(self):
+        from .backtest import backtest, sweep
+        result = backtest(self.p, "threshold", threshold=0.02)
+        first = result["rebalances"][0]
+        # primer día en que w_EEUU se aleja más de 2 puntos de 0.5: 50·P/(50·P + 500) > 0.52
+        expected = next(d for i, d in enumerate(self.dates) if 50 * (10 + i / 10) / (50 * (10 + i / 10) + 500) > 0.52)
+        self.assertEqual(first, expected)
+
+        grid = [{"schedule": s} for s in ("none", "monthly", "quarterly")] + [
+            {"schedule": "threshold", "threshold": t, "cost_bps": 10} for t in (0.01, 0.02)
+        ]
+        serial = sweep(self.p, grid, workers=1)
+        self.assertEqual(serial, sweep(self.p, grid, workers=2))
+        self.assertEqual([r["rebalances"] for r in serial[:3]], [0, 2, 0])
+        self.assertGreater(serial[3]["costs_usd"], 0)
+
+    def test_command_exports_trades_loadable_by_load_trades(self):
+        import io
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from .models import Trade
+        from .services import bootstrap_initial_holdings
+        bootstrap_initial_holdings(self.p, self.dates[0])
+        out = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trades.csv")
+            call_command("backtest", "P", "--schedule", "monthly", "--trades", path, stdout=out)
+            call_command("load_trades", path, stdout=io.StringIO())
+        self.assertIn("2 rebalanceos, 4 trades", out.getvalue())
+        self.assertEqual(Trade.objects.count(), 4)
+        self.assertEqual(set(Trade.objects.values_list("trade_date", flat=True)), {date(2022, 1, 31), date(2022, 2, 28)})
+
+
+    def test_command_with_a_single_date_history(self):
+        import io
+        from django.core.management import call_command
+        out = io.StringIO()  # un solo precio: total_return es None, no rompe el formato
+        call_command("backtest", "P", "--end", self.dates[0].isoformat(), stdout=out)
+        call_command("backtest", "P", "--end", self.dates[0].isoformat(), "--sweep", "--workers", "1", stdout=out)
+        self.assertIn("retorno 0.00%", out.getvalue())
+        self.assertIn("monthly", out.getvalue())
+
+class AsyncMetricsApiTest(TestCase):
+    def setUp(self):
+        from .cache import get_metrics_cache
+        get_metrics_cache().clear()
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.p = Portfolio.objects.create(name="Portafolio 1", inception_date=date(2022, 2, 15), initial_value_usd=Decimal("1000"))
+        for i, d in enumerate((15, 16, 17)):
+            Price.objects.create(asset=self.a_us, date=date(2022, 2, d), price=Decimal("10") + i)
+            Price.objects.create(asset=self.a_eu, date=date(2022, 2, d), price=Decimal("5"))
+        Holding.objects.create(portfolio=self.p, asset=self.a_us, quantity=Decimal("10"), effective_from=date(2022, 2, 15))
+        Holding.objects.create(portfolio=self.p, asset=self.a_eu, quantity=Decimal("20"), effective_from=date(2022, 2, 15))
+        self.qs = "?fecha_inicio=2022-02-15&fecha_fin=2022-02-17"
+
+    async def test_async_matches_sync(self):
+        from asgiref.sync import sync_to_async
+        from .services import refresh_daily_valuations
+        sync_body = (await self.async_client.get(f"/api/portfolios/{self.p.id}/metrics{self.qs}")).json()
+        res = await self.async_client.get(f"/api/portfolios/{self.p.id}/metrics/async{self.qs}&output=json")
+        self.assertEqual(res.json(), sync_body)
+        self.assertEqual(res.json()["values"][2], {"date": "2022-02-17", "value": 220.0})
+        # 304 con el mismo ETag y, ya materializado, misma serie por el range scan
+        self.assertEqual((await self.async_client.get(
+            f"/api/portfolios/{self.p.id}/metrics/async{self.qs}", headers={"if-none-match": res["ETag"]}
+        )).status_code, 304)
+        await sync_to_async(refresh_daily_valuations)(self.p)
+        res = await self.async_client.get(f"/api/portfolios/{self.p.id}/metrics/async{self.qs}&output=columnar")
+        self.assertEqual(res.json()["values"], [200.0, 210.0, 220.0])
+
+    async def test_async_ndjson_and_errors(self):
+        import json
+        res = await self.async_client.get(f"/api/portfolios/{self.p.id}/metrics/async{self.qs}&output=ndjson")
+        lines = b"".join([chunk async for chunk in res.streaming_content]).decode().splitlines()
+        self.assertEqual(json.loads(lines[0])["weights"], {"EEUU": 0.5, "Europa": 0.5})
+        self.assertEqual((await self.async_client.get(f"/api/portfolios/999/metrics/async{self.qs}")).status_code, 404)
+        self.assertEqual((await self.async_client.get(
+            f"/api/portfolios/{self.p.id}/metrics/async?fecha_inicio=x&fecha_fin=y")).status_code, 400)
+
+
+class QueryBudgetMiddlewareTest(TestCase):
+    def setUp(self):
+        from .cache import get_metrics_cache
+        get_metrics_cache().clear()
+        a = Asset.objects.create(name="EEUU")
+        self.p = Portfolio.objects.create(name="P", inception_date=date(2022, 2, 15), initial_value_usd=Decimal("1000"))
+        Price.objects.create(asset=a, date=date(2022, 2, 15), price=Decimal("10"))
+        Holding.objects.create(portfolio=self.p, asset=a, quantity=Decimal("10"), effective_from=date(2022, 2, 15))
+        self.url = f"/api/portfolios/{self.p.id}/metrics?fecha_inicio=2022-02-15&fecha_fin=2022-02-15"
+
+    def test_server_timing_counts_queries(self):
+        import re
+        res = self.client.get(self.url)
+        m = re.fullmatch(r'db;dur=[\d.]+;desc="(\d+) queries"', res["Server-Timing"])
+        self.assertTrue(m)
+        self.assertTrue(1 <= int(m.group(1)) <= 8)
+
+    def test_over_budget_logs_or_fails(self):
+        from unittest import mock
+        from django.test import override_settings
+        from .api.views import PortfolioMetricsApi
+        from .cache import get_metrics_cache
+        from .middleware import QueryBudgetExceeded
+        with mock.patch.object(PortfolioMetricsApi, "query_budget", {"MAX_QUERIES": 1}):
+            with self.assertLogs("portfolios.queries", "WARNING"):
+                self.assertEqual(self.client.get(self.url).status_code, 200)
+            with override_settings(PORTFOLIOS_QUERY_BUDGET={"ACTION": "raise"}):
+                get_metrics_cache().clear()
+                self.client = self.client_class()  # middleware relee la config
+                with self.assertRaises(QueryBudgetExceeded):
+                    self.client.get(self.url)
+
+
+class BenchCommandTest(TestCase):
+    def test_bench_writes_baseline_and_flags_regressions(self):
+        import io
+        import json
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from .bench import compare
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "baseline.json")
+            call_command("bench", "--in-place", "--assets", "3", "--years", "0.1", "--portfolios", "1",
+                         "--repeat", "2", "--output", out, stdout=io.StringIO())
+            with open(out) as fh:
+                results = json.load(fh)["results"]
+        self.assertEqual(results["compute_timeseries_weights_and_value"]["queries"], 2)
+        self.assertEqual(results["get_holdings_at"]["n"], 4)
+        self.assertIsNotNone(results["load_datos"]["peak_kb"])
+        worse = {"metrics_request": {**results["metrics_request"], "queries": results["metrics_request"]["queries"] + 1}}
+        self.assertEqual([r[:2] for r in compare(worse, results)], [("metrics_request", "queries")])
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        from .cache import get_metrics_cache
+        from .instrumentation import registry
+        get_metrics_cache().clear()
+        registry.clear()
+        a = Asset.objects.create(name="EEUU")
+        self.p = Portfolio.objects.create(name="P", inception_date=date(2022, 2, 15), initial_value_usd=Decimal("1000"))
+        Price.objects.create(asset=a, date=date(2022, 2, 15), price=Decimal("10"))
+        Holding.objects.create(portfolio=self.p, asset=a, quantity=Decimal("10"), effective_from=date(2022, 2, 15))
+        self.url = f"/api/portfolios/{self.p.id}/metrics?fecha_inicio=2022-02-15&fecha_fin=2022-02-15"
+
+    def test_prometheus_exposes_spans_and_counters(self):
+        from django.test import override_settings
+        self.assertEqual(self.client.get("/metrics/prometheus").status_code, 404)
+        with override_settings(PORTFOLIOS_INSTRUMENTATION={"ENABLED": True}):
+            self.client.get(self.url)
+            self.client.get(self.url)
+            body = self.client.get("/metrics/prometheus").content.decode()
+        self.assertIn('portfolios_stage_seconds_count{stage="fetch.prices"} 1', body)
+        self.assertIn('portfolios_stage_seconds_count{stage="metrics.render"} 2', body)
+        self.assertIn("portfolios_dates_valued_total 1", body)
+        self.assertIn("portfolios_metrics_cache_hits_total 1", body)
+
+    def test_profiler_is_staff_only_and_opt_in(self):
+        from django.contrib.auth.models import User
+        from django.test import override_settings
+        user = User.objects.create_user("u", password="x", is_staff=True)
+        self.client.force_login(user)
+        res = self.client.get(self.url, HTTP_X_PROFILE="1")  # PROFILING=0 por defecto
+        self.assertEqual(res["Content-Type"], "application/json")
+        with override_settings(PORTFOLIOS_INSTRUMENTATION={"PROFILING": True}):
+            user.is_staff = False
+            user.save()
+            res = self.client.get(self.url + "&profile=1")
+            self.assertEqual(res["Content-Type"], "application/json")
+            user.is_staff = True
+            user.save()
+            res = self.client.get(self.url, HTTP_X_PROFILE="1")
+        self.assertTrue(res["Content-Type"].startswith("text/plain"))
+        self.assertIn("cumulative", res.content.decode())
+
+
+class NumericBackendTest(TestCase):
+    def setUp(self):
+        import random
+        rng = random.Random(7)
+        assets = [Asset.objects.create(name=f"A{i}") for i in range(40)]
+        self.p = Portfolio.objects.create(name="P", inception_date=date(2022, 1, 3), initial_value_usd=Decimal("1000000000"))
+        self.dates = [date(2022, 1, 3 + i) for i in range(20)]
+        Price.objects.bulk_create([
+            Price(asset=a, date=d, price=Decimal(str(round(rng.uniform(1, 20000), 8))))
+            for a in assets for d in self.dates
+        ])
+        Holding.objects.bulk_create([
+            Holding(portfolio=self.p, asset=a, effective_from=d,
+                    quantity=Decimal(str(round(rng.uniform(1, 1e6), 12))).quantize(Decimal("1.000000000000")))
+            for a in assets for d in (self.dates[0], self.dates[rng.randrange(20)])
+        ])
+        self.n_assets = len(assets)
+
+    def test_float64_within_documented_bounds(self):
+        from .selectors import compute_timeseries_weights_and_value, float64_error_bounds
+        w_dec, v_dec = compute_timeseries_weights_and_value(self.p, self.dates[0], self.dates[-1], exact=True)
+        w_f, v_f = compute_timeseries_weights_and_value(self.p, self.dates[0], self.dates[-1], exact=False)
+        v_bound, w_bound = float64_error_bounds(self.n_assets)
+        self.assertEqual(list(v_f), list(v_dec))
+        for d, v in v_dec.items():
+            self.assertLessEqual(abs(Decimal(v_f[d]) - v) / v, v_bound)
+            for a_id, w in w_dec[d].items():
+                self.assertLessEqual(abs(Decimal(w_f[d][a_id]) - w) / w, w_bound)
+
+    def test_setting_selects_backend(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from django.test import override_settings
+        from .selectors import compute_timeseries_weights_and_value
+        args = (self.p, self.dates[0], self.dates[-1])
+        self.assertIsInstance(next(iter(compute_timeseries_weights_and_value(*args)[1].values())), float)
+        with override_settings(PORTFOLIOS_NUMERIC_BACKEND="decimal"):
+            self.assertIsInstance(next(iter(compute_timeseries_weights_and_value(*args)[1].values())), Decimal)
+        with override_settings(PORTFOLIOS_NUMERIC_BACKEND="float32"):
+            with self.assertRaises(ImproperlyConfigured):
+                compute_timeseries_weights_and_value(*args)
+
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        from .cache import get_metrics_cache
+        from .services import bootstrap_initial_holdings
+        get_metrics_cache().clear()
+        self.a = Asset.objects.create(name="EEUU")
+        self.p = Portfolio.objects.create(name="P", inception_date=date(2022, 2, 15), initial_value_usd=Decimal("1000"))
+        for i, d in enumerate((15, 16, 17)):
+            Price.objects.create(asset=self.a, date=date(2022, 2, d), price=Decimal("10") + i)
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a, weight=Decimal("1"))
+        bootstrap_initial_holdings(self.p, date(2022, 2, 15))  # refresh en línea (por defecto)
+        self.url = f"/api/portfolios/{self.p.id}/metrics?fecha_inicio=2022-02-15&fecha_fin=2022-02-17&output=columnar"
+
+    def test_async_refresh_coalesces_and_serves_live_until_done(self):
+        from django.test import override_settings
+        from .jobs import run_pending
+        from .models import Job
+        from .services import post_trade_usd_notional
+        with override_settings(PORTFOLIOS_JOBS={"ASYNC_REFRESH": True, "WARM_AFTER_REFRESH": False}):
+            with self.captureOnCommitCallbacks(execute=True):
+                post_trade_usd_notional(self.p, self.a, date(2022, 2, 17), Decimal("120"))
+            with self.captureOnCommitCallbacks(execute=True):
+                post_trade_usd_notional(self.p, self.a, date(2022, 2, 16), Decimal("110"))
+            job = Job.objects.get()
+            self.assertEqual((job.kind, job.status, job.payload), ("refresh_valuations", "queued", {"from_date": "2022-02-16"}))
+            self.p.refresh_from_db()
+            self.assertEqual(self.p.valuations_dirty_from, date(2022, 2, 16))
+            # pendiente: se calcula en línea con los trades ya aplicados
+            live = self.client.get(self.url).json()["values"]
+            self.assertEqual(live, [1000.0, 1210.0, 1320.0])  # el tramo del 17 no cambia
+            self.assertEqual(run_pending(), 1)
+        job.refresh_from_db()
+        self.p.refresh_from_db()
+        self.assertEqual(job.status, "done")
+        self.assertIsNone(self.p.valuations_dirty_from)
+        self.assertEqual(self.p.daily_valuations.get(date=date(2022, 2, 17)).value, Decimal("1320"))
+        self.assertEqual(self.client.get(self.url).json()["values"], live)
+
+    def test_retry_with_backoff_then_fail(self):
+        from unittest import mock
+        from django.test import override_settings
+        from django.utils import timezone
+        from . import jobs
+        from .models import Job
+
+        def boom(job):
+            raise RuntimeError("db caída")
+        job = jobs.enqueue("refresh_valuations", self.p.id, {"from_date": None})
+        with mock.patch.dict(jobs.HANDLERS, {"refresh_valuations": boom}), self.assertLogs("portfolios.jobs"), \
+                override_settings(PORTFOLIOS_JOBS={"MAX_ATTEMPTS": 2, "BACKOFF_BASE": 30}):
+            self.assertEqual(jobs.run_pending(), 1)
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), ("queued", 1))
+            self.assertGreater(job.run_after, timezone.now() + timezone.timedelta(seconds=25))
+            self.assertEqual(jobs.run_pending(), 0)  # todavía no le toca
+            Job.objects.update(run_after=timezone.now())
+            jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("failed", 2))
+        self.assertIn("db caída", job.last_error)
+
+    def test_retry_merges_with_a_refresh_enqueued_while_running(self):
+        from unittest import mock
+        from django.utils import timezone
+        from . import jobs
+        from .models import Job
+
+        first = jobs.enqueue("refresh_valuations", self.p.id, {"from_date": "2022-02-17"})
+        [claimed] = jobs.claim_jobs("w1")
+        self.assertEqual(claimed.dedupe_key, f"refresh_valuations:{self.p.id}")
+        # llega otro refresh mientras corre: job nuevo, que ningún worker toma hasta que el primero termine
+        second = jobs.enqueue("refresh_valuations", self.p.id, {"from_date": "2022-02-16"})
+        self.assertNotEqual(second.id, first.id)
+        self.assertEqual(jobs.claim_jobs("w2", limit=10), [])
+
+        def boom(job):
+            raise RuntimeError("db caída")
+        with mock.patch.dict(jobs.HANDLERS, {"refresh_valuations": boom}), self.assertLogs("portfolios.jobs"):
+            self.assertFalse(jobs.run_job(claimed))
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.status, first.dedupe_key), ("failed", None))
+        self.assertIn(f"#{second.id}", first.last_error)
+        self.assertEqual((second.status, second.attempts), ("queued", 1))
+        self.assertEqual(second.payload, {"from_date": "2022-02-16"})
+        self.assertEqual(Job.objects.filter(status="queued").count(), 1)
+
+        Job.objects.update(run_after=timezone.now())
+        [claimed] = jobs.claim_jobs("w2")
+        self.assertEqual(claimed.id, second.id)
+        self.assertTrue(jobs.run_job(claimed))
+        second.refresh_from_db()
+        self.assertEqual((second.status, second.dedupe_key), ("done", None))
+
+    def test_background_trades_are_enqueued_on_commit(self):
+        from django.db import transaction
+        from .models import Job
+        from .services import enqueue_trades_bulk
+        trades = [(self.p.id, self.a.id, date(2022, 2, 16), Decimal("110"))]
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.assertIsNone(enqueue_trades_bulk(trades))  # pendiente del commit
+                raise RuntimeError("request revertido")
+        self.assertFalse(Job.objects.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue_trades_bulk(trades)
+        self.assertEqual(Job.objects.get().kind, "post_trades")
+
+    def test_run_worker_once_posts_background_trades(self):
+        import io
+        from django.core.management import call_command
+        from .models import Job, Trade
+        from .services import enqueue_trades_bulk
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue_trades_bulk([(self.p.id, self.a.id, date(2022, 2, 16), Decimal("110"))])
+        out = io.StringIO()
+        call_command("run_worker", "--once", stdout=out)
+        self.assertIn("1 jobs ok", out.getvalue().splitlines()[-1])
+        self.assertEqual(Trade.objects.count(), 1)
+        self.assertEqual(Job.objects.get(kind="post_trades").payload["result"], {"created": 1, "errors": []})
+
+
+class AssetRegistryTest(TestCase):
+    def setUp(self):
+        self.a_us = Asset.objects.create(name="EEUU")
+        self.a_eu = Asset.objects.create(name="Europa")
+        self.t0 = date(2022, 2, 15)
+        self.p = Portfolio.objects.create(name="Portafolio 1", inception_date=self.t0, initial_value_usd=Decimal("1000"))
+        for i, d in enumerate(date(2022, 2, day) for day in (15, 16, 17, 18)):
+            Price.objects.create(asset=self.a_us, date=d, price=Decimal("10") + i)
+            Price.objects.create(asset=self.a_eu, date=d, price=Decimal("20"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_us, weight=Decimal("0.5"))
+        InitialWeight.objects.create(portfolio=self.p, asset=self.a_eu, weight=Decimal("0.5"))
+
+    def test_asset_registry_legend_and_invalidation(self):
+        import json
+        from .assets import get_asset_registry
+        from .cache import get_metrics_cache
+        from .services import bootstrap_initial_holdings
+        get_metrics_cache().clear()
+        bootstrap_initial_holdings(self.p, self.t0)
+        url = f"/api/portfolios/{self.p.id}/metrics?fecha_inicio=2022-02-15&fecha_fin=2022-02-18&assets=ids"
+        self.client.get(url)
+        with self.assertNumQueries(2):  # registro caliente: portfolio + range scan, sin nombres
+            body = self.client.get(url.replace("2022-02-18", "2022-02-17")).json()
+        self.assertEqual(body["assets"], {str(self.a_us.id): "EEUU", str(self.a_eu.id): "Europa"})
+        self.assertAlmostEqual(body["weights"][0]["weights"][str(self.a_us.id)], 0.5)
+
+        # renombrar invalida el registro (post_save) y cambia el ETag de las respuestas con nombres
+        etag = self.client.get(url).headers["ETag"]
+        self.a_us.name = "USA"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.a_us.save()
+            # recargado antes del commit (otro thread vería los nombres viejos): se descarta al confirmar
+            self.assertEqual(get_asset_registry().names()[self.a_us.id], "USA")
+        with self.assertNumQueries(1):
+            get_asset_registry().names()
+        res = self.client.get(url)
+        self.assertNotEqual(res.headers["ETag"], etag)
+        self.assertEqual(res.json()["assets"][str(self.a_us.id)], "USA")
+        lines = b"".join(self.client.get(url + "&output=ndjson").streaming_content).decode().splitlines()
+        self.assertEqual(json.loads(lines[0]), {"assets": {str(self.a_us.id): "USA", str(self.a_eu.id): "Europa"}})
+        self.assertIn(str(self.a_eu.id), json.loads(lines[1])["weights"])
+        self.assertEqual(self.client.get(url + "&assets=x").status_code, 400)
+
+    def test_asset_registry_ttl_and_shared_generation(self):
+        from .assets import AssetRegistry
+        now = [0.0]
+        registry = AssetRegistry(ttl=60, cache_alias="default", clock=lambda: now[0])
+        other = AssetRegistry(cache_alias="default")
+        self.assertEqual(registry.names()[self.a_us.id], "EEUU")
+        with self.assertNumQueries(0):
+            registry.names()
+        Asset.objects.filter(id=self.a_us.id).update(name="USA")  # sin señales: otro proceso
+        other.invalidate()  # publica una generación nueva en el cache compartido
+        with self.assertNumQueries(1):
+            self.assertEqual(registry.names()[self.a_us.id], "USA")
+        now[0] = 61.0
+        with self.assertNumQueries(1):  # TTL vencido
+            registry.names()
+        a_new = Asset.objects.create(name="Japón")
+        with self.assertNumQueries(1):  # id desconocido: recarga una vez
+            self.assertEqual(registry.legend([a_new.id]), {a_new.id: "Japón"})